@@ -0,0 +1,159 @@
+'''
+Общий клиент API Яндекс.Директа для облачных функций: HTTP-сессия с keep-alive и лимитер запросов
+на пару (токен, Client-Login). Исходник — backend/_shared; в каталог функции модуль копирует
+backend/_shared/sync.py при деплое, функции импортируют его как `direct_client`.
+'''
+import threading
+import time
+from typing import Dict, Any
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DIRECT_RATE_LIMIT = 20  # Лимит API: 20 запросов к Директу на токен...
+DIRECT_RATE_PERIOD = 10  # ...за 10 секунд
+DIRECT_UNITS_RESERVE = 0.05  # Остаток баллов ниже 5% суточного лимита — режим экономии
+DIRECT_LOW_UNITS_INTERVAL = 2.0  # Пауза между запросами в режиме экономии баллов, сек
+DIRECT_BACKOFF_MAX = 60  # Максимальная пауза после 429 / ошибок лимита, сек
+DIRECT_LIMIT_ERROR_CODES = {'56', '152'}  # 56 — превышен лимит запросов, 152 — недостаточно баллов
+HTTP_POOL_MAXSIZE = 10  # Соединений на хост в пуле сессии по умолчанию
+
+
+def build_http_session(pool_maxsize: int = HTTP_POOL_MAXSIZE) -> requests.Session:
+    '''
+    Сессия с keep-alive для API Яндекса: живёт между вызовами тёплого контейнера,
+    при обрыве соединения (connection reset) запрос повторяется, HTTP-статусы не ретраятся.
+    '''
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=1,
+        status=0,
+        backoff_factor=0.3,
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    return session
+
+
+class DirectRateLimiter:
+    '''
+    Темп запросов к Директу для пары (токен, Client-Login): token bucket 20 req / 10 sec,
+    замедление по заголовку Units и нарастающая пауза после 429 / ошибок 56, 152.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = float(DIRECT_RATE_LIMIT)
+        self.updated = time.monotonic()
+        self.last_request = 0.0
+        self.cooldown_until = 0.0
+        self.backoff = 0.0
+        self.units_spent = None
+        self.units_available = None
+        self.units_daily = None
+        self.units_login = None
+
+    def low_on_units(self) -> bool:
+        return (
+            self.units_available is not None
+            and bool(self.units_daily)
+            and self.units_available < self.units_daily * DIRECT_UNITS_RESERVE
+        )
+
+    def acquire(self) -> None:
+        rate = DIRECT_RATE_LIMIT / DIRECT_RATE_PERIOD
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(float(DIRECT_RATE_LIMIT), self.tokens + (now - self.updated) * rate)
+                self.updated = now
+                wait = self.cooldown_until - now
+                if self.low_on_units():
+                    wait = max(wait, self.last_request + DIRECT_LOW_UNITS_INTERVAL - now)
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.last_request = now
+                    return
+                if wait <= 0:
+                    wait = (1 - self.tokens) / rate
+            time.sleep(wait)
+
+    def observe(self, response) -> None:
+        '''Учитывает ответ Директа: заголовки Units / Units-Used-Login и сигналы превышения лимита.'''
+        units = response.headers.get('Units')
+        if units:
+            try:
+                spent, available, daily = (int(part) for part in units.split('/'))
+                with self.lock:
+                    self.units_spent, self.units_available, self.units_daily = spent, available, daily
+                    self.units_login = response.headers.get('Units-Used-Login') or self.units_login
+            except ValueError:
+                pass
+
+        if response.status_code == 429 or direct_error_code(response) in DIRECT_LIMIT_ERROR_CODES:
+            backoff = self.penalize()
+            print(f'🐢 Direct limit signal (HTTP {response.status_code}), pausing this token for {backoff:.0f}s', flush=True)
+        elif response.status_code < 400:
+            with self.lock:
+                self.backoff = 0.0
+
+    def penalize(self) -> float:
+        with self.lock:
+            self.backoff = min(float(DIRECT_BACKOFF_MAX), max(1.0, self.backoff * 2))
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + self.backoff)
+            return self.backoff
+
+    def budget(self) -> Dict[str, Any]:
+        '''Текущий бюджет токена для вызывающего кода (и планировщика).'''
+        with self.lock:
+            return {
+                'units_spent': self.units_spent,
+                'units_available': self.units_available,
+                'units_daily': self.units_daily,
+                'units_login': self.units_login,
+                'cooldown_sec': max(0.0, self.cooldown_until - time.monotonic()),
+                'low_on_units': self.low_on_units(),
+            }
+
+
+_direct_limiters: Dict[Any, DirectRateLimiter] = {}
+_direct_limiters_lock = threading.Lock()
+
+
+def get_direct_limiter(yandex_token: str, client_login: str = '') -> DirectRateLimiter:
+    key = (yandex_token, client_login or '')
+    with _direct_limiters_lock:
+        limiter = _direct_limiters.get(key)
+        if limiter is None:
+            limiter = _direct_limiters[key] = DirectRateLimiter()
+        return limiter
+
+
+def direct_limiter_for_headers(headers: Dict[str, str]) -> DirectRateLimiter:
+    authorization = headers.get('Authorization', '')
+    token = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    return get_direct_limiter(token, headers.get('Client-Login', ''))
+
+
+def direct_error_code(response) -> str:
+    '''error_code из JSON-ошибки Директа ('' если ответ не ошибка).'''
+    if response.status_code == 200 and 'json' not in response.headers.get('Content-Type', 'json'):
+        # Готовый TSV-отчёт: тело не трогаем, оно читается потоком
+        return ''
+    if response.status_code == 200 and not response.text[:32].lstrip().startswith('{"error"'):
+        return ''
+    try:
+        return str((response.json().get('error') or {}).get('error_code') or '')
+    except Exception:
+        return ''
+
+
+def wait_direct_rate_limit(headers: Dict[str, str]) -> DirectRateLimiter:
+    '''Ждёт свободный слот лимита Директа для токена / Client-Login из заголовков запроса.'''
+    limiter = direct_limiter_for_headers(headers)
+    limiter.acquire()
+    return limiter
@@ -0,0 +1,80 @@
+'''
+Потоковое чтение TSV-отчётов Яндекс.Директа (Reports API): строки читаются из сокета по мере прихода,
+текст отчёта целиком в памяти не держится.
+'''
+from typing import Any, Dict, Iterable, Iterator
+
+REPORT_STREAM_CHUNK = 64 * 1024  # Чанк потокового чтения TSV-отчёта, байт
+
+
+def iter_report_lines(response) -> Iterator[str]:
+    '''Строки готового отчёта по мере чтения из сокета: текст отчёта целиком в памяти не держится.'''
+    try:
+        for line in response.iter_lines(chunk_size=REPORT_STREAM_CHUNK):
+            if line:
+                yield line.decode('utf-8', errors='replace').rstrip('\r')
+    finally:
+        response.close()
+
+
+def iter_tsv_rows(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    '''Строки TSV как dict по заголовку (первая строка); неполные строки пропускаются.'''
+    header = None
+    for line in lines:
+        parts = line.split('\t')
+        if header is None:
+            header = parts
+            continue
+        if len(parts) < len(header):
+            continue
+        yield dict(zip(header, parts))
+
+
+def parse_tsv_report(lines: Iterable[str], lower_domains: bool = False) -> Iterator[Dict[str, Any]]:
+    '''
+    Площадки отчёта по одной, по мере чтения строк (в т.ч. поток iter_report_lines).
+    Колонки Conversions_<цель>_<модель> суммируются в goal_conversions, их сумма заменяет Conversions;
+    Date и CampaignId (если есть в отчёте) попадают в date / campaign_id.
+    '''
+    if isinstance(lines, str):
+        lines = lines.strip().split('\n')
+
+    for row in iter_tsv_rows(lines):
+        domain = (row['Placement'] if 'Placement' in row else next(iter(row.values()), '')).strip()
+        if lower_domains:
+            domain = domain.lower()
+        if ' ' in domain or not domain:
+            continue
+
+        goal_conversions = {}
+        for key, value in row.items():
+            if not key.startswith('Conversions_'):
+                continue
+            key_parts = key.split('_')
+            if len(key_parts) >= 3:
+                goal_id = key_parts[1]
+                goal_conversions[goal_id] = goal_conversions.get(goal_id, 0) + int(float(value or 0))
+
+        conversions = int(float(row.get('Conversions') or 0))
+        if goal_conversions:
+            conversions = sum(goal_conversions.values())
+
+        clicks = int(float(row.get('Clicks') or 0))
+        cost = float(row.get('Cost') or 0)
+        impressions = int(float(row.get('Impressions') or 0))
+        platform = {
+            'domain': domain,
+            'clicks': clicks,
+            'cost': cost,
+            'conversions': conversions,
+            'goal_conversions': goal_conversions,
+            'impressions': impressions,
+            'cpc': cost / clicks if clicks else 0,
+            'cpa': cost / conversions if conversions else 0,
+            'ctr': clicks / impressions * 100 if impressions else 0,
+        }
+        if row.get('Date'):
+            platform['date'] = row['Date'].strip()
+        if row.get('CampaignId'):
+            platform['campaign_id'] = row['CampaignId'].strip()
+        yield platform
@@ -0,0 +1,64 @@
+'''
+Копирует общие модули backend/_shared в каталоги облачных функций, которые их импортируют.
+Каждая функция деплоится архивом своего каталога, поэтому модуль должен лежать рядом с index.py;
+копии — артефакт сборки и в git не хранятся (см. .gitignore).
+Запуск перед деплоем: python backend/_shared/sync.py [--check]
+--check — только проверить, что копии есть и совпадают с исходником (код возврата 1, если нет).
+'''
+import os
+import re
+import sys
+from typing import Dict, List
+
+SHARED_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(SHARED_DIR)
+
+
+def shared_modules() -> List[str]:
+    return sorted(
+        name[:-3] for name in os.listdir(SHARED_DIR)
+        if name.endswith('.py') and name != 'sync.py' and not name.startswith('test_')
+    )
+
+
+def find_consumers() -> Dict[str, List[str]]:
+    '''Модуль → каталоги функций, в index.py которых есть `import <модуль>` или `from <модуль> import`.'''
+    modules = shared_modules()
+    consumers: Dict[str, List[str]] = {module: [] for module in modules}
+    for function_name in sorted(os.listdir(BACKEND_DIR)):
+        index_path = os.path.join(BACKEND_DIR, function_name, 'index.py')
+        if function_name.startswith('_') or not os.path.isfile(index_path):
+            continue
+        with open(index_path, encoding='utf-8') as index_file:
+            source = index_file.read()
+        for module in modules:
+            if re.search(rf'^\s*(from {module} import|import {module}\b)', source, re.MULTILINE):
+                consumers[module].append(function_name)
+    return consumers
+
+
+def sync(check: bool = False) -> int:
+    stale = 0
+    for module, functions in find_consumers().items():
+        with open(os.path.join(SHARED_DIR, f'{module}.py'), encoding='utf-8') as source_file:
+            source = source_file.read()
+        for function_name in functions:
+            target = os.path.join(BACKEND_DIR, function_name, f'{module}.py')
+            current = None
+            if os.path.isfile(target):
+                with open(target, encoding='utf-8') as target_file:
+                    current = target_file.read()
+            if current == source:
+                continue
+            if check:
+                print(f'❌ {function_name}/{module}.py is missing or differs from _shared/{module}.py')
+                stale += 1
+                continue
+            with open(target, 'w', encoding='utf-8') as target_file:
+                target_file.write(source)
+            print(f'📦 {function_name}/{module}.py')
+    return stale
+
+
+if __name__ == '__main__':
+    sys.exit(1 if sync(check='--check' in sys.argv[1:]) else 0)
@@ -0,0 +1,129 @@
+'''
+Фильтр площадок задачи автоматизации — общий для rsya-batch-worker, rsya-async-poller и rsya-preview,
+чтобы превью, асинхронный поллер и основной воркер блокировали по одному правилу.
+'''
+import re
+from typing import Any, Dict, List
+
+METRIC_THRESHOLDS = (
+    ('min_impressions', 'impressions', True),
+    ('max_impressions', 'impressions', False),
+    ('min_clicks', 'clicks', True),
+    ('max_clicks', 'clicks', False),
+    ('min_cpc', 'cpc', True),
+    ('max_cpc', 'cpc', False),
+    ('min_ctr', 'ctr', True),
+    ('max_ctr', 'ctr', False),
+    ('min_conversions', 'conversions', True),
+    ('min_cpa', 'cpa', True),
+    ('max_cpa', 'cpa', False),
+)
+
+
+def normalize_list(value, lower: bool = False) -> List[str]:
+    if not value:
+        return []
+    items = value.split(',') if isinstance(value, str) else value
+    result = [str(item).strip() for item in items if str(item).strip()]
+    return [item.lower() for item in result] if lower else result
+
+
+def normalize_goal_ids(config: Dict[str, Any]) -> List[str]:
+    goal_ids = normalize_list(config.get('goal_ids'))
+    if goal_ids:
+        return goal_ids[:10]
+
+    goal_id = str(config.get('goal_id') or '').strip()
+    if goal_id and goal_id not in ('all', 'selected'):
+        return [goal_id]
+
+    return []
+
+
+def keywords_regex(keywords: List[str], anchored: bool):
+    '''
+    Одно регулярное выражение на весь список слов.
+    anchored: 'name.' — префикс домена, '.ru' — суффикс, остальное — подстрока.
+    '''
+    parts = []
+    for keyword in dict.fromkeys(keywords):
+        pattern = re.escape(keyword)
+        if anchored and '.' in keyword:
+            if keyword.endswith('.') and not keyword.startswith('.'):
+                pattern = '^' + pattern
+            elif keyword.startswith('.') and not keyword.endswith('.'):
+                pattern = pattern + r'\Z'
+        parts.append(pattern)
+    return re.compile('|'.join(parts)) if parts else None
+
+
+class CompiledTaskFilter:
+    '''
+    Фильтр задачи, разобранный один раз: исключения и ключевые слова — по одному regex,
+    пороги метрик — плоский список (поле, min/max, значение).
+    Исключения и защита конверсий всегда сильнее любых условий.
+    AND: все активные условия должны совпасть.
+    OR: достаточно любого активного условия.
+    use_goals=False — цели задачи не учитываются (отчёт без колонок по целям, как в rsya-async-poller):
+    конверсии и защита — по общим полям площадки, защита только по флагу protect_conversions.
+    '''
+
+    def __init__(self, config: Dict[str, Any], combine_operator: str = 'AND', use_goals: bool = True):
+        config = config or {}
+        self.combine_or = (combine_operator or config.get('combine_operator') or 'AND').upper() == 'OR'
+        self.exceptions_re = keywords_regex(normalize_list(config.get('exceptions', []), lower=True), anchored=False)
+        self.keywords_re = keywords_regex(normalize_list(config.get('keywords', []), lower=True), anchored=True)
+        self.goal_ids = normalize_goal_ids(config) if use_goals else []
+        self.protect_conversions = bool(config.get('protect_conversions') or self.goal_ids)
+        self.thresholds = [
+            (field, is_min, float(config[key]))
+            for key, field, is_min in METRIC_THRESHOLDS
+            if config.get(key) is not None
+        ]
+        self.needs_conversions = self.protect_conversions or any(
+            field in ('conversions', 'cpa') for field, _, _ in self.thresholds
+        )
+
+    def conversions(self, platform: Dict[str, Any]) -> int:
+        '''Конверсии площадки по целям задачи (без целей — общие конверсии).'''
+        if self.goal_ids:
+            goal_conversions = platform.get('goal_conversions') or {}
+            if goal_conversions:
+                return int(sum(goal_conversions.get(goal_id, 0) or 0 for goal_id in self.goal_ids))
+        return int(platform.get('conversions', 0) or 0)
+
+    def matches(self, platform: Dict[str, Any]) -> bool:
+        domain = platform['domain'].lower()
+        if self.exceptions_re is not None and self.exceptions_re.search(domain):
+            return False
+
+        conversions = self.conversions(platform) if self.needs_conversions else 0
+        if self.protect_conversions and conversions > 0:
+            return False
+
+        # Условия проверяются с коротким замыканием: OR — до первого совпадения, AND — до первого промаха
+        has_conditions = False
+        if self.keywords_re is not None:
+            has_conditions = True
+            if (self.keywords_re.search(domain) is not None) == self.combine_or:
+                return self.combine_or
+
+        for field, is_min, threshold in self.thresholds:
+            has_conditions = True
+            if field == 'conversions':
+                value = conversions
+            elif field == 'cpa':
+                value = float(platform.get('cost', 0) or 0) / conversions if conversions > 0 else 0
+            else:
+                value = platform.get(field, 0)
+            if (value >= threshold if is_min else value <= threshold) == self.combine_or:
+                return self.combine_or
+
+        return has_conditions and not self.combine_or
+
+
+def matches_task_filters(
+    platform: Dict[str, Any], config: Dict[str, Any], combine_operator: str = 'AND', use_goals: bool = True
+) -> bool:
+    '''Проверяет соответствие площадки фильтрам задачи (для разовых проверок; в цикле — CompiledTaskFilter).'''
+    return CompiledTaskFilter(config, combine_operator, use_goals).matches(platform)
@@ -0,0 +1,44 @@
+from direct_reports import iter_report_lines, iter_tsv_rows, parse_tsv_report
+
+
+def test_iter_report_lines_decodes_skips_empty_and_closes(fake_response):
+    response = fake_response(lines=[b'Placement\tClicks\r', b'', 'сайт.рф\t3'.encode('utf-8')])
+    assert list(iter_report_lines(response)) == ['Placement\tClicks', 'сайт.рф\t3']
+    assert response.closed
+
+
+def test_iter_tsv_rows_skips_short_rows():
+    rows = list(iter_tsv_rows(['Placement\tClicks', 'a.ru\t1', 'b.ru', 'c.ru\t2']))
+    assert rows == [{'Placement': 'a.ru', 'Clicks': '1'}, {'Placement': 'c.ru', 'Clicks': '2'}]
+
+
+def test_parse_tsv_report_sums_goal_columns_into_conversions():
+    lines = [
+        'Date\tCampaignId\tPlacement\tClicks\tCost\tConversions\tImpressions\tConversions_11_AUTO\tConversions_12_AUTO',
+        '2026-10-17\t5\tGame.net\t10\t50.5\t0\t200\t1\t2',
+        '2026-10-17\t5\tbad domain\t1\t1\t0\t1\t0\t0',
+        '2026-10-17\t5\t\t1\t1\t0\t1\t0\t0',
+    ]
+    platforms = list(parse_tsv_report(lines))
+    assert platforms == [{
+        'domain': 'Game.net',
+        'clicks': 10,
+        'cost': 50.5,
+        'conversions': 3,
+        'goal_conversions': {'11': 1, '12': 2},
+        'impressions': 200,
+        'cpc': 5.05,
+        'cpa': 50.5 / 3,
+        'ctr': 5.0,
+        'date': '2026-10-17',
+        'campaign_id': '5',
+    }]
+
+
+def test_parse_tsv_report_accepts_text_and_lowers_domains():
+    text = 'Placement\tClicks\tCost\tConversions\tImpressions\nNews.RU\t0\t0\t2\t0\n'
+    platform, = parse_tsv_report(text, lower_domains=True)
+    assert platform['domain'] == 'news.ru'
+    assert platform['conversions'] == 2
+    assert (platform['cpc'], platform['ctr'], platform['cpa']) == (0, 0, 0)
+    assert 'date' not in platform and 'campaign_id' not in platform
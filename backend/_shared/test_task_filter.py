@@ -0,0 +1,153 @@
+import random
+
+import pytest
+
+from task_filter import CompiledTaskFilter, matches_task_filters, normalize_goal_ids
+
+METRIC_KEYS = (
+    'min_impressions', 'max_impressions', 'min_clicks', 'max_clicks', 'min_cpc', 'max_cpc',
+    'min_ctr', 'max_ctr', 'min_conversions', 'min_cpa', 'max_cpa',
+)
+WORDS = ('casino', 'game', 'vpn', '.ru', '.com', 'news.', 'app.', 'mail', 'x', '.io.')
+DOMAINS = ('Casino.ru', 'news.example.com', 'vpn-app.com', 'game.net', 'mail.ru', 'app.store.io', 'x.org', 'ru.casino')
+
+
+def reference_matches(platform, config, combine_operator='AND', use_goals=True):
+    '''Прямой разбор конфига на каждую площадку — правило до компиляции фильтра (эталон для сравнения).'''
+    def normalize(value):
+        if not value:
+            return []
+        items = value.split(',') if isinstance(value, str) else value
+        return [str(item).strip().lower() for item in items if str(item).strip()]
+
+    def keyword_matches(domain, keyword):
+        if '.' in keyword:
+            if keyword.endswith('.') and not keyword.startswith('.'):
+                return domain.startswith(keyword)
+            if keyword.startswith('.') and not keyword.endswith('.'):
+                return domain.endswith(keyword)
+        return keyword in domain
+
+    goal_ids = normalize_goal_ids(config) if use_goals else []
+
+    def conversions():
+        goal_conversions = platform.get('goal_conversions') or {}
+        if goal_ids and goal_conversions:
+            return int(sum(goal_conversions.get(goal_id, 0) or 0 for goal_id in goal_ids))
+        return int(platform.get('conversions', 0) or 0)
+
+    def cpa():
+        return float(platform.get('cost', 0) or 0) / conversions() if conversions() > 0 else 0
+
+    domain = platform['domain'].lower()
+    combine_operator = (combine_operator or config.get('combine_operator') or 'AND').upper()
+    if any(exception in domain for exception in normalize(config.get('exceptions'))):
+        return False
+    if (config.get('protect_conversions') or goal_ids) and conversions() > 0:
+        return False
+
+    conditions = []
+    keywords = normalize(config.get('keywords'))
+    if keywords:
+        conditions.append(any(keyword_matches(domain, keyword) for keyword in keywords))
+    values = {
+        'impressions': lambda: platform.get('impressions', 0),
+        'clicks': lambda: platform.get('clicks', 0),
+        'cpc': lambda: platform.get('cpc', 0),
+        'ctr': lambda: platform.get('ctr', 0),
+        'conversions': conversions,
+        'cpa': cpa,
+    }
+    for key in METRIC_KEYS:
+        if config.get(key) is not None:
+            value = values[key.split('_', 1)[1]]()
+            conditions.append(value >= config[key] if key.startswith('min_') else value <= config[key])
+
+    if not conditions:
+        return False
+    return any(conditions) if combine_operator == 'OR' else all(conditions)
+
+
+def random_config(rng: random.Random):
+    config = {}
+    for key in ('keywords', 'exceptions'):
+        if rng.random() < 0.5:
+            words = rng.sample(WORDS, rng.randint(0, 3))
+            config[key] = ','.join(words) if rng.random() < 0.3 else words
+    for key in METRIC_KEYS:
+        if rng.random() < 0.25:
+            config[key] = rng.choice([0, 1, 5, 10, 50.5, 100])
+    if rng.random() < 0.3:
+        config['protect_conversions'] = True
+    roll = rng.random()
+    if roll < 0.3:
+        config['goal_ids'] = rng.sample(['1', '2', '3'], rng.randint(1, 2))
+    elif roll < 0.4:
+        config['goal_id'] = rng.choice(['1', 'all', 'selected'])
+    return config
+
+
+def random_platform(rng: random.Random):
+    clicks = rng.randint(0, 100)
+    impressions = rng.randint(0, 2000)
+    cost = rng.choice([0, rng.uniform(0, 500)])
+    goal_conversions = {goal_id: rng.randint(0, 2) for goal_id in rng.sample(['1', '2', '3'], rng.randint(0, 3))}
+    conversions = sum(goal_conversions.values()) if goal_conversions else rng.randint(0, 3)
+    return {
+        'domain': rng.choice(DOMAINS),
+        'clicks': clicks,
+        'impressions': impressions,
+        'cost': cost,
+        'conversions': conversions,
+        'goal_conversions': goal_conversions,
+        'cpc': cost / clicks if clicks else 0,
+        'ctr': clicks / impressions * 100 if impressions else 0,
+        'cpa': cost / conversions if conversions else 0,
+    }
+
+
+@pytest.mark.parametrize('use_goals', [True, False])
+def test_compiled_filter_matches_reference_on_random_pairs(use_goals):
+    rng = random.Random(20261018)
+    for _ in range(5000):
+        config = random_config(rng)
+        combine_operator = rng.choice(['AND', 'OR', None])
+        task_filter = CompiledTaskFilter(config, combine_operator, use_goals)
+        for platform in (random_platform(rng) for _ in range(4)):
+            expected = reference_matches(platform, config, combine_operator, use_goals)
+            assert task_filter.matches(platform) == expected, (config, combine_operator, platform)
+
+
+def test_exceptions_and_conversion_protection_beat_or_conditions():
+    platform = {'domain': 'casino.ru', 'clicks': 50, 'conversions': 1}
+    assert matches_task_filters(platform, {'keywords': ['casino'], 'min_clicks': 1}, 'OR')
+    assert not matches_task_filters(platform, {'keywords': ['casino'], 'exceptions': ['.ru']}, 'OR')
+    assert not matches_task_filters(platform, {'keywords': ['casino'], 'protect_conversions': True}, 'OR')
+
+
+def test_anchored_keywords():
+    task_filter = CompiledTaskFilter({'keywords': ['news.', '.com']}, 'OR')
+    assert task_filter.matches({'domain': 'news.example.org'})
+    assert task_filter.matches({'domain': 'example.com'})
+    assert not task_filter.matches({'domain': 'fakenews.org'})
+    assert not task_filter.matches({'domain': 'example.com.ru'})
+
+
+def test_goal_conversions_protect_only_with_goals_enabled():
+    platform = {'domain': 'game.net', 'clicks': 20, 'conversions': 0, 'goal_conversions': {'7': 2}}
+    config = {'goal_ids': ['7'], 'min_clicks': 10}
+    assert not CompiledTaskFilter(config).matches(platform)
+    assert CompiledTaskFilter(config, use_goals=False).matches(platform)
+
+
+def test_no_conditions_never_match():
+    assert not CompiledTaskFilter({'exceptions': ['x']}).matches({'domain': 'game.net'})
+    assert not CompiledTaskFilter({}, 'OR').matches({'domain': 'game.net'})
+
+
+def test_normalize_goal_ids():
+    assert normalize_goal_ids({'goal_ids': [' 1 ', 2, '', 3]}) == ['1', '2', '3']
+    assert normalize_goal_ids({'goal_ids': '4, 5'}) == ['4', '5']
+    assert normalize_goal_ids({'goal_ids': list(range(15))}) == [str(goal_id) for goal_id in range(10)]
+    assert normalize_goal_ids({'goal_id': 'all'}) == []
+    assert normalize_goal_ids({'goal_id': 9}) == ['9']
@@ -0,0 +1,57 @@
+'''
+Общая настройка pytest для облачных функций: python -m pytest -q backend
+Каталоги функций — не пакеты (дефис в имени), поэтому index.py загружается по пути под уникальным именем,
+а общие модули backend/_shared импортируются напрямую, без копий sync.py.
+'''
+import importlib.util
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_DIR = os.path.join(BACKEND_DIR, '_shared')
+
+if SHARED_DIR not in sys.path:
+    sys.path.insert(0, SHARED_DIR)
+
+
+def _load_function(function_name: str):
+    module_name = f"{function_name.replace('-', '_')}_index"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(BACKEND_DIR, function_name, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+@pytest.fixture(scope='session')
+def load_function():
+    '''load_function('rsya-scheduler') → модуль index.py функции (один раз за сессию).'''
+    return _load_function
+
+
+class FakeResponse:
+    '''Ответ requests для подмены HTTP-вызовов к Директу.'''
+
+    def __init__(self, data=None, status_code: int = 200, lines=None):
+        self.data = data
+        self.status_code = status_code
+        self.lines = lines or []
+        self.text = '' if data is None else str(data)
+        self.closed = False
+
+    def json(self):
+        return self.data
+
+    def iter_lines(self, chunk_size=None):
+        yield from self.lines
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_response():
+    return FakeResponse
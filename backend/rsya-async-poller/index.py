@@ -1,10 +1,35 @@
 import json
 import os
 import time
-from typing import Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterable, List, Optional
 import psycopg2
 import psycopg2.extras
 import requests
+from direct_client import (
+    build_http_session,
+    get_direct_limiter,
+    direct_limiter_for_headers,
+    direct_error_code,
+    DIRECT_LIMIT_ERROR_CODES,
+)
+from direct_reports import iter_report_lines, iter_tsv_rows
+from task_filter import CompiledTaskFilter
+
+
+http_session = build_http_session()
+
+
+# Каждый отчёт проверяется в свой next_check_at: retryIn от Директа или экспоненциальный backoff
+POLL_CONCURRENCY = max(1, int(os.environ.get('RSYA_POLL_CONCURRENCY', '4')))  # Параллельных запросов к reports
+POLL_TIME_BUDGET_SEC = int(os.environ.get('RSYA_POLL_TIME_BUDGET_SEC', '240'))  # CRON раз в 5 минут — укладываемся до следующего
+POLL_CHUNK = POLL_CONCURRENCY * 5  # Сколько готовых к проверке отчётов выбираем за раз
+POLL_BACKOFF_BASE_SEC = 30
+POLL_BACKOFF_MAX_SEC = 1800
+POLL_IDLE_WAIT_MAX_SEC = 30  # Ближайшая проверка раньше этого — дожидаемся её в текущем вызове
+REPORT_MAX_AGE_HOURS = 24  # Отчёт, не готовый за сутки, снимается с проверки
+MQ_BATCH_LIMIT = 10  # Лимит записей в одном send_message_batch
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -38,43 +63,46 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         conn.autocommit = False
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        # Получаем pending отчёты (не старше 24 часов)
+        # Отчёты, не готовые за сутки, больше не проверяем
         cursor.execute("""
-            SELECT pr.id, pr.project_id, pr.task_id, pr.campaign_ids, 
-                   pr.date_from::text, pr.date_to::text, pr.report_name,
-                   p.yandex_token, p.client_login
-            FROM t_p97630513_yandex_cleaning_serv.rsya_pending_reports pr
-            JOIN t_p97630513_yandex_cleaning_serv.rsya_projects p ON p.id = pr.project_id
-            WHERE pr.status = 'pending'
-              AND pr.created_at > NOW() - INTERVAL '24 hours'
-            ORDER BY pr.created_at ASC
-            LIMIT 20
-        """)
-        
-        pending_reports = cursor.fetchall()
-        
-        if not pending_reports:
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'message': 'No pending reports',
-                    'checked': 0
-                })
-            }
-        
-        print(f'📊 Found {len(pending_reports)} pending reports')
+            UPDATE t_p97630513_yandex_cleaning_serv.rsya_pending_reports
+            SET status = 'expired', updated_at = NOW()
+            WHERE status = 'pending'
+              AND created_at < NOW() - make_interval(hours => %s)
+        """, (REPORT_MAX_AGE_HOURS,))
+        if cursor.rowcount:
+            print(f'⌛ Expired {cursor.rowcount} reports older than {REPORT_MAX_AGE_HOURS}h')
+        conn.commit()
         
+        deadline = time.monotonic() + POLL_TIME_BUDGET_SEC
         processed = 0
         ready = 0
         still_pending = 0
         failed = 0
         
-        for report in pending_reports:
-            try:
-                result = check_and_process_report(report, cursor, conn)
+        # Без общего LIMIT: выбираем отчёты, у которых подошёл next_check_at, пачками до исчерпания бюджета времени
+        while time.monotonic() < deadline:
+            due_reports = load_due_reports(cursor)
+            if not due_reports:
+                wait = seconds_until_next_check(cursor)
+                if wait is None or wait > min(POLL_IDLE_WAIT_MAX_SEC, deadline - time.monotonic()):
+                    break
+                time.sleep(max(wait, 0.5))
+                continue
+            
+            # HTTP — параллельно под лимитером токена, разбор и запись в БД — последовательно
+            responses = run_concurrently(fetch_report, due_reports)
+            for report, response in zip(due_reports, responses):
+                try:
+                    result = process_report_response(report, response, cursor)
+                    conn.commit()
+                except Exception as e:
+                    print(f'❌ Error processing report {report["id"]}: {str(e)}')
+                    conn.rollback()
+                    # Каждая проверка сдвигает next_check_at, иначе отчёт выбирался бы снова в этом же проходе
+                    schedule_next_check(report, cursor)
+                    conn.commit()
+                    result = 'failed'
                 
                 if result == 'ready':
                     ready += 1
@@ -82,20 +110,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     still_pending += 1
                 elif result == 'failed':
                     failed += 1
-                
                 processed += 1
-                
-                # Задержка между запросами (лимит API)
-                time.sleep(0.6)
-                
-            except Exception as e:
-                print(f'❌ Error processing report {report["id"]}: {str(e)}')
-                failed += 1
         
-        conn.commit()
         cursor.close()
         conn.close()
         
+        if ready:
+            # Готовые отчёты сразу уходят на блокировку — один вызов block worker на весь проход
+            trigger_block_worker()
+        
         print(f'✅ Processed {processed} reports: ready={ready}, pending={still_pending}, failed={failed}')
         
         return {
@@ -119,14 +142,64 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
 
 
-def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
+def load_due_reports(cursor) -> List[Dict[str, Any]]:
     '''
-    Проверяет готовность отчёта и обрабатывает его
-    Returns: 'ready', 'pending', 'failed'
+    Pending отчёты, у которых наступил next_check_at (каждая проверка сдвигает его вперёд).
+    Параметры запроса из rsya_report_registry — чтобы повторить заказ отчёта один в один.
+    '''
+    cursor.execute("""
+        SELECT pr.id, pr.project_id, pr.task_id, pr.campaign_ids, 
+               pr.date_from::text, pr.date_to::text, pr.report_name, pr.check_attempts,
+               p.yandex_token, p.client_login, rr.request_headers, rr.request_params
+        FROM t_p97630513_yandex_cleaning_serv.rsya_pending_reports pr
+        JOIN t_p97630513_yandex_cleaning_serv.rsya_projects p ON p.id = pr.project_id
+        LEFT JOIN t_p97630513_yandex_cleaning_serv.rsya_report_registry rr ON rr.report_name = pr.report_name
+        WHERE pr.status = 'pending'
+          AND pr.next_check_at <= NOW()
+        ORDER BY pr.next_check_at ASC
+        LIMIT %s
+    """, (POLL_CHUNK,))
+    return cursor.fetchall()
+
+
+def seconds_until_next_check(cursor) -> Optional[float]:
+    '''Через сколько секунд наступит ближайший next_check_at (None — pending отчётов нет).'''
+    cursor.execute("""
+        SELECT EXTRACT(EPOCH FROM MIN(next_check_at) - NOW()) AS wait
+        FROM t_p97630513_yandex_cleaning_serv.rsya_pending_reports
+        WHERE status = 'pending'
+    """)
+    row = cursor.fetchone()
+    return float(row['wait']) if row and row['wait'] is not None else None
+
+
+def run_concurrently(func, items: List[Any]) -> List[Any]:
+    '''Выполняет func(item) для каждого элемента в пуле потоков (POLL_CONCURRENCY), сохраняя порядок.'''
+    if POLL_CONCURRENCY <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(POLL_CONCURRENCY, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def schedule_next_check(report: Dict[str, Any], cursor, delay_sec: Optional[float] = None) -> None:
+    '''Откладывает проверку отчёта: retryIn / пауза токена, иначе экспоненциальный backoff по числу проверок.'''
+    attempts = int(report.get('check_attempts') or 0)
+    if delay_sec is None:
+        delay_sec = min(POLL_BACKOFF_MAX_SEC, POLL_BACKOFF_BASE_SEC * 2 ** attempts)
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_pending_reports
+        SET next_check_at = NOW() + make_interval(secs => %s),
+            check_attempts = check_attempts + 1,
+            updated_at = NOW()
+        WHERE id = %s
+    """, (max(1.0, float(delay_sec)), report['id']))
+
+
+def fetch_report(report: Dict[str, Any]) -> Any:
+    '''
+    Запрашивает отчёт у Яндекса (потокобезопасно: только HTTP и лимитер токена).
+    Returns: requests.Response, None — токен в паузе / без баллов, Exception — сетевая ошибка
     '''
-    report_id = report['id']
-    project_id = report['project_id']
-    task_id = report['task_id']
     token = report['yandex_token']
     client_login = (report.get('client_login') or '').strip()
     campaign_ids = json.loads(report['campaign_ids']) if isinstance(report['campaign_ids'], str) else report['campaign_ids']
@@ -134,8 +207,13 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
     date_to = report['date_to']
     report_name = report['report_name']
     
-    print(f'🔍 Checking report {report_name} (id={report_id})')
+    budget = get_direct_limiter(token, client_login).budget()
+    if budget['cooldown_sec'] > 0 or budget['low_on_units']:
+        # Токен в паузе после 429 или без баллов — отчёт проверим позже
+        return None
     
+    print(f'🔍 Checking report {report_name} (id={report["id"]})')
+
     # Запрашиваем отчёт у Яндекса
     headers = {
         'Authorization': f'Bearer {token}',
@@ -149,53 +227,90 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
         headers['Client-Login'] = client_login
         print(f'🔐 Using Client-Login for async report: {client_login}')
     
-    report_data = {
-        'params': {
-            'SelectionCriteria': {
-                'DateFrom': date_from,
-                'DateTo': date_to,
-                'Filter': [
-                    {
-                        'Field': 'CampaignId',
-                        'Operator': 'IN',
-                        'Values': [str(cid) for cid in campaign_ids]
-                    }
-                ]
-            },
-            'FieldNames': [
-                'CampaignId',
-                'Placement',
-                'Cost',
-                'Impressions',
-                'Clicks',
-                'Conversions',
-                'Ctr',
-                'AvgCpc'
-            ],
-            'ReportName': report_name,
-            'ReportType': 'CUSTOM_REPORT',
-            'DateRangeType': 'CUSTOM_DATE',
-            'Format': 'TSV',
-            'IncludeVAT': 'NO',
-            'IncludeDiscount': 'NO'
+    if report.get('request_params'):
+        # Отчёт заказан через реестр: тот же ReportName с другими параметрами Директ не примет
+        headers = {**(report.get('request_headers') or {}), 'Authorization': f'Bearer {token}'}
+        report_data = {'params': report['request_params']}
+    else:
+        report_data = {
+            'params': {
+                'SelectionCriteria': {
+                    'DateFrom': date_from,
+                    'DateTo': date_to,
+                    'Filter': [
+                        {
+                            'Field': 'CampaignId',
+                            'Operator': 'IN',
+                            'Values': [str(cid) for cid in campaign_ids]
+                        }
+                    ]
+                },
+                'FieldNames': [
+                    'CampaignId',
+                    'Placement',
+                    'Cost',
+                    'Impressions',
+                    'Clicks',
+                    'Conversions',
+                    'Ctr',
+                    'AvgCpc'
+                ],
+                'ReportName': report_name,
+                'ReportType': 'CUSTOM_REPORT',
+                'DateRangeType': 'CUSTOM_DATE',
+                'Format': 'TSV',
+                'IncludeVAT': 'NO',
+                'IncludeDiscount': 'NO'
+            }
         }
-    }
     
-    response = requests.post(
-        'https://api.direct.yandex.com/json/v5/reports',
-        json=report_data,
-        headers=headers,
-        timeout=30
-    )
+    limiter = direct_limiter_for_headers(headers)
+    limiter.acquire()
+    try:
+        response = http_session.post(
+            'https://api.direct.yandex.com/json/v5/reports',
+            json=report_data,
+            headers=headers,
+            timeout=30,
+            stream=True
+        )
+        limiter.observe(response)
+        if response.status_code != 200:
+            # Тела 201/202 и ошибок короткие — дочитываем здесь, готовый отчёт читается потоком при разборе
+            response.content
+    except requests.RequestException as e:
+        return e
+    return response
+
+
+def process_report_response(report: Dict[str, Any], response: Any, cursor) -> str:
+    '''
+    Обрабатывает ответ reports для отчёта: готовый — в block_queue, неготовый — следующая проверка по backoff
+    Returns: 'ready', 'pending', 'failed'
+    '''
+    report_id = report['id']
+    project_id = report['project_id']
+    task_id = report['task_id']
+    report_name = report['report_name']
     
-    print(f'📥 Response status: {response.status_code}')
+    if response is None:
+        budget = get_direct_limiter(report['yandex_token'], (report.get('client_login') or '').strip()).budget()
+        schedule_next_check(report, cursor, max(budget['cooldown_sec'], POLL_BACKOFF_BASE_SEC))
+        return 'pending'
+    if isinstance(response, Exception):
+        print(f'❌ Report {report_name}: request failed: {response}')
+        schedule_next_check(report, cursor)
+        return 'pending'
     
+    print(f'📥 Response status: {response.status_code}')
+
     # Статус 200 — отчёт готов
     if response.status_code == 200:
         print(f'✅ Report {report_name} ready! Processing...')
         
         # Парсим TSV
-        placements = parse_tsv_report(response.text)
+        campaign_ids = json.loads(report['campaign_ids']) if isinstance(report['campaign_ids'], str) else report['campaign_ids']
+        placements = parse_tsv_report(iter_report_lines(response), campaign_ids[0] if len(campaign_ids) == 1 else None)
         print(f'📊 Found {len(placements)} placements in report')
         
         if placements:
@@ -225,26 +340,36 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
             # Добавляем в block_queue
             added = 0
             for placement in matched:
+                metrics = (
+                    placement.get('clicks', 0),
+                    placement.get('cost', 0),
+                    placement.get('conversions', 0),
+                    placement.get('cpa', 0)
+                )
                 try:
                     cursor.execute("""
                         INSERT INTO t_p97630513_yandex_cleaning_serv.block_queue 
-                        (task_id, campaign_id, domain, status, attempts, project_id, clicks, cost, conversions, cpa)
-                        VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s, %s, %s)
+                        (task_id, campaign_id, domain, status, attempts, project_id, clicks, cost, conversions, cpa,
+                         priority_score, priority_version)
+                        VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s, %s, %s,
+                                t_p97630513_yandex_cleaning_serv.block_queue_priority_score(%s, %s, %s, %s, %s),
+                                t_p97630513_yandex_cleaning_serv.block_queue_priority_version())
                         ON CONFLICT (task_id, campaign_id, domain) DO UPDATE
                         SET clicks = EXCLUDED.clicks,
                             cost = EXCLUDED.cost,
                             conversions = EXCLUDED.conversions,
                             cpa = EXCLUDED.cpa,
+                            priority_score = EXCLUDED.priority_score,
+                            priority_version = EXCLUDED.priority_version,
                             attempts = 0
                     """, (
                         task_id,
                         placement['campaign_id'],
                         placement['domain'],
                         project_id,
-                        placement.get('clicks', 0),
-                        placement.get('cost', 0),
-                        placement.get('conversions', 0),
-                        placement.get('cpa', 0)
+                        *metrics,
+                        placement['domain'],
+                        *metrics
                     ))
                     added += 1
                 except Exception as e:
@@ -252,17 +377,9 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
             
             print(f'✅ Added {added} placements to block_queue')
             
-            # Отправляем в MQ
+            # Отправляем в MQ (block worker вызывается один раз в конце прохода)
             if added > 0:
                 send_to_message_queue(matched, project_id)
-                
-                # Запускаем worker
-                try:
-                    worker_url = os.environ.get('RSYA_BLOCK_WORKER_URL', 'https://functions.yandexcloud.net/d4ecp99plhc7m6v6h0n6')
-                    requests.post(worker_url, json={}, timeout=1)
-                    print('🚀 Triggered worker')
-                except:
-                    pass
         
         # Помечаем отчёт как completed
         cursor.execute("""
@@ -275,7 +392,20 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
     
     # Статус 201/202 — отчёт ещё формируется
     elif response.status_code in [201, 202]:
-        print(f'⏳ Report {report_name} still pending (status {response.status_code})')
+        # retryIn — рекомендованная Директом пауза до следующей проверки
+        try:
+            retry_in = float(response.headers.get('retryIn') or 0)
+        except ValueError:
+            retry_in = 0
+        schedule_next_check(report, cursor, retry_in or None)
+        print(f'⏳ Report {report_name} still pending (status {response.status_code}, retryIn={retry_in or "-"})')
+        return 'pending'
+
+    # 429 / ошибка лимита — не ошибка отчёта, limiter уже поставил токен на паузу
+    elif response.status_code == 429 or direct_error_code(response) in DIRECT_LIMIT_ERROR_CODES:
+        print(f'🐢 Report {report_name}: Direct limit hit, will retry later')
+        budget = get_direct_limiter(report['yandex_token'], (report.get('client_login') or '').strip()).budget()
+        schedule_next_check(report, cursor, max(budget['cooldown_sec'], POLL_BACKOFF_BASE_SEC))
         return 'pending'
     
     # Другие ошибки
@@ -288,159 +418,150 @@ def check_and_process_report(report: Dict[str, Any], cursor, conn) -> str:
             SET status = 'failed', updated_at = NOW()
             WHERE id = %s AND created_at < NOW() - INTERVAL '3 hours'
         """, (report_id,))
+        if not cursor.rowcount:
+            schedule_next_check(report, cursor)
         
         return 'failed'
 
 
-def parse_tsv_report(tsv_data: str) -> List[Dict]:
-    '''Парсит TSV отчёт в список площадок'''
-    lines = tsv_data.strip().split('\n')
-    if not lines:
-        return []
-    
-    # Первая строка - заголовки
-    headers_line = lines[0].split('\t')
+def _tsv_number(value: Optional[str]) -> float:
+    '''Число из TSV ('--' и пустые значения — 0)'''
+    if not value or value == '--':
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def parse_tsv_report(lines: Iterable[str], default_campaign_id: Optional[Any] = None) -> List[Dict]:
+    '''
+    Парсит TSV отчёт (строки, в т.ч. поток iter_report_lines) в список площадок.
+    Понимает и отчёты rsya-batch-worker из реестра: без CampaignId (одна кампания — default_campaign_id),
+    с колонками Conversions_<цель>_<модель> и построчно по дням (Date) — строки суммируются по площадке.
+    '''
+    columns: List[str] = []
+    conversion_columns: List[str] = []
     
-    placements = []
-    for line in lines[1:]:
-        values = line.split('\t')
-        if len(values) != len(headers_line):
-            continue
-        
-        row = dict(zip(headers_line, values))
+    aggregated: Dict[tuple, Dict[str, Any]] = {}
+    for row in iter_tsv_rows(lines):
+        if not columns:
+            columns = list(row)
+            conversion_columns = [h for h in columns if h == 'Conversions' or h.startswith('Conversions_')]
         
         # Пропускаем пустые площадки
         if not row.get('Placement') or row['Placement'] == '--':
             continue
         
-        ctr_value = float(row.get('Ctr', 0)) if row.get('Ctr') and row.get('Ctr') != '--' else 0.0
-        cpc_micro = float(row.get('AvgCpc', 0)) if row.get('AvgCpc') and row.get('AvgCpc') != '--' else 0.0
-        cpc_value = cpc_micro / 1_000_000
-        cost = float(row.get('Cost', 0))
-        conversions = int(row.get('Conversions', 0))
+        campaign_id = row.get('CampaignId') or default_campaign_id
+        if campaign_id is None:
+            continue
         
-        placement = {
-            'campaign_id': int(row['CampaignId']),
-            'domain': row['Placement'],
-            'cost': cost,
-            'impressions': int(row.get('Impressions', 0)),
-            'clicks': int(row.get('Clicks', 0)),
-            'conversions': conversions,
-            'ctr': ctr_value,
-            'cpc': cpc_value,
-            'cpa': cost / conversions if conversions else 0
-        }
+        key = (int(campaign_id), row['Placement'])
+        placement = aggregated.get(key)
+        if placement is None:
+            placement = {
+                'campaign_id': key[0],
+                'domain': key[1],
+                'cost': 0.0,
+                'impressions': 0,
+                'clicks': 0,
+                'conversions': 0,
+                'api_ctr': row.get('Ctr'),
+                'api_cpc': row.get('AvgCpc'),
+            }
+            aggregated[key] = placement
         
+        placement['cost'] += _tsv_number(row.get('Cost'))
+        placement['impressions'] += int(_tsv_number(row.get('Impressions')))
+        placement['clicks'] += int(_tsv_number(row.get('Clicks')))
+        placement['conversions'] += int(sum(_tsv_number(row.get(column)) for column in conversion_columns))
+    
+    placements = []
+    for placement in aggregated.values():
+        api_ctr = placement.pop('api_ctr')
+        api_cpc = placement.pop('api_cpc')
+        cost = placement['cost']
+        clicks = placement['clicks']
+        impressions = placement['impressions']
+        conversions = placement['conversions']
+        if 'Ctr' in columns and 'Date' not in columns:
+            # Одна строка на площадку — берём CTR / CPC Директа как есть
+            placement['ctr'] = _tsv_number(api_ctr)
+            placement['cpc'] = _tsv_number(api_cpc) / 1_000_000
+        else:
+            placement['ctr'] = clicks / impressions * 100 if impressions else 0.0
+            placement['cpc'] = cost / clicks if clicks else 0.0
+        placement['cpa'] = cost / conversions if conversions else 0
         placements.append(placement)
     
     return placements
 
 
-def _normalize_list(value) -> List[str]:
-    if not value:
-        return []
-    if isinstance(value, str):
-        return [item.strip().lower() for item in value.split(',') if item.strip()]
-    return [str(item).strip().lower() for item in value if str(item).strip()]
-
-
-def _domain_matches_keyword(domain: str, keyword: str) -> bool:
-    if '.' in keyword:
-        if keyword.endswith('.') and not keyword.startswith('.'):
-            return domain.startswith(keyword)
-        if keyword.startswith('.') and not keyword.endswith('.'):
-            return domain.endswith(keyword)
-        return keyword in domain
-    return keyword in domain
-
-
-def matches_task_filters(platform: Dict, config: Dict, combine_operator: str = 'AND') -> bool:
-    '''Та же логика, что в rsya-batch-worker: exceptions/protect first, затем AND/OR условия.'''
-    domain = platform['domain'].lower()
-    combine_operator = (combine_operator or config.get('combine_operator') or 'AND').upper()
-
-    exceptions = _normalize_list(config.get('exceptions', []))
-    if exceptions and any(exc in domain for exc in exceptions):
-        return False
-
-    if config.get('protect_conversions') and platform.get('conversions', 0) > 0:
-        return False
-
-    conditions = []
-
-    keywords = _normalize_list(config.get('keywords', []))
-    if keywords:
-        conditions.append(any(_domain_matches_keyword(domain, kw) for kw in keywords))
-
-    metric_rules = [
-        ('min_impressions', lambda value: platform.get('impressions', 0) >= value),
-        ('max_impressions', lambda value: platform.get('impressions', 0) <= value),
-        ('min_clicks', lambda value: platform.get('clicks', 0) >= value),
-        ('max_clicks', lambda value: platform.get('clicks', 0) <= value),
-        ('min_cpc', lambda value: platform.get('cpc', 0) >= value),
-        ('max_cpc', lambda value: platform.get('cpc', 0) <= value),
-        ('min_ctr', lambda value: platform.get('ctr', 0) >= value),
-        ('max_ctr', lambda value: platform.get('ctr', 0) <= value),
-        ('min_conversions', lambda value: platform.get('conversions', 0) >= value),
-        ('min_cpa', lambda value: platform.get('cpa', 0) >= value),
-        ('max_cpa', lambda value: platform.get('cpa', 0) <= value),
-    ]
-
-    for key, predicate in metric_rules:
-        value = config.get(key)
-        if value is not None:
-            conditions.append(predicate(value))
+def filter_placements(placements: List[Dict], config: Dict, combine_operator: str = 'AND') -> List[Dict]:
+    '''Фильтрация площадок единым правилом с batch worker (фильтр компилируется один раз на отчёт).'''
+    task_filter = CompiledTaskFilter(config, combine_operator, use_goals=False)
+    return [placement for placement in placements if task_filter.matches(placement)]
 
-    if not conditions:
-        return False
 
-    if combine_operator == 'OR':
-        return any(conditions)
-    return all(conditions)
+_sqs_client = None
 
 
-def filter_placements(placements: List[Dict], config: Dict, combine_operator: str = 'AND') -> List[Dict]:
-    '''Фильтрация площадок единым правилом с batch worker.'''
-    matched = []
-    for placement in placements:
-        if matches_task_filters(placement, config, combine_operator):
-            matched.append(placement)
-    return matched
+def get_sqs_client():
+    '''SQS-клиент Message Queue живёт между вызовами тёплого контейнера.'''
+    global _sqs_client
+    if _sqs_client is None:
+        import boto3
+        
+        access_key = os.environ.get('YANDEX_MQ_ACCESS_KEY_ID')
+        secret_key = os.environ.get('YANDEX_MQ_SECRET_KEY')
+        if not access_key or not secret_key:
+            return None
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url='https://message-queue.api.cloud.yandex.net',
+            region_name='ru-central1',
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key
+        )
+    return _sqs_client
 
 
 def send_to_message_queue(placements: List[Dict], project_id: int):
-    '''Отправка в MQ'''
-    import boto3
-    
+    '''Отправка в MQ: сообщения по 10 площадок, send_message_batch по MQ_BATCH_LIMIT сообщений'''
     queue_url = 'https://message-queue.api.cloud.yandex.net/b1gga4kkbv0csaelq94p/dj60000000b1egur05em/rsyacleaner'
-    access_key = os.environ.get('YANDEX_MQ_ACCESS_KEY_ID')
-    secret_key = os.environ.get('YANDEX_MQ_SECRET_KEY')
-    
-    if not access_key or not secret_key:
+    sqs = get_sqs_client()
+    if sqs is None:
         print('❌ MQ credentials not configured')
         return
     
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key
-    )
-    
     # Батчами по 10
     batch_size = 10
-    for i in range(0, len(placements), batch_size):
-        batch = placements[i:i + batch_size]
-        
-        message_body = json.dumps({
-            'project_id': project_id,
-            'placements': batch
-        })
-        
-        sqs.send_message(
-            QueueUrl=queue_url,
-            MessageBody=message_body
-        )
+    entries = [
+        {
+            'Id': str(index),
+            'MessageBody': json.dumps({
+                'project_id': project_id,
+                'placements': placements[i:i + batch_size]
+            })
+        }
+        for index, i in enumerate(range(0, len(placements), batch_size))
+    ]
+    failed = 0
+    for i in range(0, len(entries), MQ_BATCH_LIMIT):
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries[i:i + MQ_BATCH_LIMIT])
+        failed += len(response.get('Failed') or [])
     
+    if failed:
+        print(f'⚠️ MQ rejected {failed} of {len(entries)} messages')
     print(f'✅ Sent {len(placements)} placements to MQ')
+
+
+def trigger_block_worker() -> None:
+    '''Запускает block worker сразу после прохода поллера, не дожидаясь его CRON.'''
+    try:
+        worker_url = os.environ.get('RSYA_BLOCK_WORKER_URL', 'https://functions.yandexcloud.net/d4ecp99plhc7m6v6h0n6')
+        requests.post(worker_url, json={}, timeout=1)
+        print('🚀 Triggered worker')
+    except Exception:
+        pass
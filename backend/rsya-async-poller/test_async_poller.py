@@ -0,0 +1,52 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def poller(load_function):
+    return load_function('rsya-async-poller')
+
+
+def test_parse_tsv_report_sums_daily_rows_per_placement(poller):
+    lines = [
+        'Date\tPlacement\tClicks\tCost\tImpressions\tConversions_11_AUTO\tConversions_12_AUTO',
+        '2026-10-17\ta.ru\t10\t20\t100\t1\t0',
+        '2026-10-18\ta.ru\t30\t40\t300\t0\t2',
+        '2026-10-18\t--\t5\t5\t5\t0\t0',
+        '2026-10-18\tb.ru\t1',
+    ]
+    placements = poller.parse_tsv_report(lines, default_campaign_id='42')
+    assert placements == [{
+        'campaign_id': 42,
+        'domain': 'a.ru',
+        'cost': 60.0,
+        'impressions': 400,
+        'clicks': 40,
+        'conversions': 3,
+        'ctr': 10.0,
+        'cpc': 1.5,
+        'cpa': 20.0,
+    }]
+
+
+def test_parse_tsv_report_uses_direct_ctr_without_date(poller):
+    lines = [
+        'CampaignId\tPlacement\tClicks\tCost\tImpressions\tCtr\tAvgCpc\tConversions',
+        '7\ta.ru\t3\t9\t200\t1.5\t3000000\t0',
+        '8\ta.ru\t1\t0\t10\t10\t0\t1',
+    ]
+    placements = {(p['campaign_id'], p['domain']): p for p in poller.parse_tsv_report(lines)}
+    assert (placements[(7, 'a.ru')]['ctr'], placements[(7, 'a.ru')]['cpc']) == (1.5, 3.0)
+    assert placements[(8, 'a.ru')]['conversions'] == 1
+    # Без CampaignId и без кампании по умолчанию строки не к чему отнести
+    assert poller.parse_tsv_report(['Placement\tClicks', 'a.ru\t1']) == []
+
+
+def test_filter_placements_ignores_task_goals(poller):
+    placements = [
+        {'domain': 'game.net', 'clicks': 20, 'conversions': 0, 'cpc': 1, 'ctr': 1, 'cpa': 0, 'impressions': 100},
+        {'domain': 'mail.ru', 'clicks': 20, 'conversions': 2, 'cpc': 1, 'ctr': 1, 'cpa': 5, 'impressions': 100},
+    ]
+    config = {'goal_ids': ['5'], 'min_clicks': 10}
+    assert [p['domain'] for p in poller.filter_placements(placements, config)] == ['game.net', 'mail.ru']
+    config['protect_conversions'] = True
+    assert [p['domain'] for p in poller.filter_placements(placements, config)] == ['game.net']
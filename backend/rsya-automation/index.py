@@ -1,13 +1,25 @@
+import hashlib
 import json
 import os
-from typing import Dict, Any, List, Optional
+import time
+from typing import Dict, Any, Iterable, Iterator, List, Optional
 from datetime import datetime, timedelta
 import psycopg2
 import psycopg2.extras
 import requests
 import boto3
+from direct_client import build_http_session, get_direct_limiter, direct_limiter_for_headers
+from direct_reports import iter_report_lines
+
+
+http_session = build_http_session()
+
 
 BATCH_SIZE = 2  # Обрабатываем 2 проекта за раз (быстрее, избегаем таймаута)
+# Общий реестр отчётов (rsya_report_registry): тот же запрос в пределах TTL переиспользует ReportName
+REPORT_REUSE_TTL_SEC = int(os.environ.get('RSYA_REPORT_REUSE_TTL_SEC', '1800'))  # Отчёт, включающий сегодня
+REPORT_REUSE_HISTORY_TTL_SEC = 6 * 3600  # Отчёт только за прошедшие дни
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -321,23 +333,35 @@ def process_task(task: Dict[str, Any], project: Dict[str, Any], cursor, conn, co
         # Добавляем в очередь блокировки
         added_count = 0
         for placement in placements_to_queue:
+            metrics = (
+                placement.get('clicks', 0),
+                placement.get('cost', 0),
+                placement.get('conversions', 0),
+                placement.get('cpa')
+            )
             try:
                 cursor.execute("""
-                    INSERT INTO block_queue (task_id, campaign_id, domain, status, attempts, project_id, clicks, cost, conversions)
-                    VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s, %s)
+                    INSERT INTO block_queue (task_id, campaign_id, domain, status, attempts, project_id, clicks, cost, conversions, cpa,
+                                             priority_score, priority_version)
+                    VALUES (%s, %s, %s, 'pending', 0, %s, %s, %s, %s, %s,
+                            t_p97630513_yandex_cleaning_serv.block_queue_priority_score(%s, %s, %s, %s, %s),
+                            t_p97630513_yandex_cleaning_serv.block_queue_priority_version())
                     ON CONFLICT (task_id, campaign_id, domain) DO UPDATE
                     SET clicks = EXCLUDED.clicks,
                         cost = EXCLUDED.cost,
                         conversions = EXCLUDED.conversions,
+                        cpa = EXCLUDED.cpa,
+                        priority_score = EXCLUDED.priority_score,
+                        priority_version = EXCLUDED.priority_version,
                         attempts = 0
                 """, (
                     task_id,
                     placement['campaign_id'],
                     placement['domain'],
                     project_id,
-                    placement.get('clicks', 0),
-                    placement.get('cost', 0),
-                    placement.get('conversions', 0)
+                    *metrics,
+                    placement['domain'],
+                    *metrics
                 ))
                 added_count += 1
             except Exception as e:
@@ -391,6 +415,81 @@ def process_task(task: Dict[str, Any], project: Dict[str, Any], cursor, conn, co
         raise
 
 
+def report_request_hash(headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''Канонический ключ отчёта: параметры без ReportName, заголовки формата и аккаунт (Client-Login, иначе токен).'''
+    account = headers.get('Client-Login') or hashlib.sha256(headers.get('Authorization', '').encode('utf-8')).hexdigest()
+    canonical = {
+        'account': account,
+        'headers': {key: value for key, value in headers.items() if key not in ('Authorization', 'Client-Login', 'Accept-Language')},
+        'params': {key: value for key, value in params.items() if key != 'ReportName'},
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def registry_report_name(cursor, prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''
+    ReportName из общего реестра rsya_report_registry: одинаковый запрос (тот же хэш) в пределах TTL
+    получает то же имя — Директ отдаёт уже заказанный или готовый отчёт, а не ставит новый в очередь.
+    Изменения в реестре коммитит вызывающий код; при ошибке реестра — новое имя с меткой времени.
+    '''
+    report_hash = report_request_hash(headers, params)
+    report_name = f'{prefix}_{report_hash[:16]}_{int(time.time())}'
+    date_to = (params.get('SelectionCriteria') or {}).get('DateTo') or ''
+    # Отчёт только за прошедшие дни не меняется — его можно переиспользовать дольше
+    ttl = REPORT_REUSE_HISTORY_TTL_SEC if date_to and date_to < datetime.now().strftime('%Y-%m-%d') else REPORT_REUSE_TTL_SEC
+    try:
+        cursor.execute("SAVEPOINT report_registry")
+        cursor.execute("""
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_report_registry AS r
+                (report_hash, report_name, request_headers, request_params, created_at, last_used_at)
+            VALUES (%s, %s, %s, %s, NOW(), NOW())
+            ON CONFLICT (report_hash) DO UPDATE SET
+                report_name = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                   THEN EXCLUDED.report_name ELSE r.report_name END,
+                request_params = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                      THEN EXCLUDED.request_params ELSE r.request_params END,
+                created_at = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                  THEN NOW() ELSE r.created_at END,
+                last_used_at = NOW()
+            RETURNING report_name
+        """, (
+            report_hash,
+            report_name,
+            json.dumps({key: value for key, value in headers.items() if key != 'Authorization'}),
+            json.dumps({**params, 'ReportName': report_name}, ensure_ascii=False),
+            ttl,
+            ttl,
+            ttl,
+        ))
+        row = cursor.fetchone()
+        cursor.execute("RELEASE SAVEPOINT report_registry")
+        return (row['report_name'] if isinstance(row, dict) else row[0]) or report_name
+    except Exception as e:
+        print(f"⚠️ Report registry unavailable, using a fresh report name: {e}", flush=True)
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT report_registry")
+        except Exception:
+            pass
+        return report_name
+
+
+def resolve_report_name(prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''ReportName через общий реестр отчётов; без БД — новое имя с меткой времени'''
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return f'{prefix}_{report_request_hash(headers, params)[:16]}_{int(time.time())}'
+    
+    conn = psycopg2.connect(dsn)
+    try:
+        cursor = conn.cursor()
+        report_name = registry_report_name(cursor, prefix, headers, params)
+        conn.commit()
+        cursor.close()
+        return report_name
+    finally:
+        conn.close()
+
+
 def save_pending_report(project_id: int, task_id: int, campaign_ids: List[int], date_from: str, date_to: str, report_name: str):
     '''Сохранение pending отчёта в БД для async обработки'''
     dsn = os.environ.get('DATABASE_URL')
@@ -425,6 +524,48 @@ def save_pending_report(project_id: int, task_id: int, campaign_ids: List[int],
         print(f'❌ Error saving async reports: {str(e)}')
 
 
+def parse_placements_tsv(lines: Iterable[str]) -> Iterator[Dict]:
+    '''Площадки TSV-отчёта по одной, по мере чтения строк (первая строка — заголовки)'''
+    headers_line = None
+    for line in lines:
+        values = line.split('\t')
+        if headers_line is None:
+            headers_line = values
+            continue
+        if len(values) != len(headers_line):
+            continue
+        
+        row = dict(zip(headers_line, values))
+        
+        # Пропускаем строки с пустыми площадками
+        if not row.get('Placement') or row['Placement'] == '--':
+            continue
+        
+        # Парсим CPC и CTR из API (уже в нормальных единицах)
+        ctr_value = float(row.get('Ctr', 0)) if row.get('Ctr') and row.get('Ctr') != '--' else 0.0
+        cpc_micro = float(row.get('AvgCpc', 0)) if row.get('AvgCpc') and row.get('AvgCpc') != '--' else 0.0
+        cpc_value = cpc_micro / 1_000_000  # Конвертируем из микро-единиц в рубли
+        
+        placement = {
+            'campaign_id': int(row['CampaignId']),
+            'domain': row['Placement'],
+            'cost': float(row.get('Cost', 0)),
+            'impressions': int(row.get('Impressions', 0)),
+            'clicks': int(row.get('Clicks', 0)),
+            'conversions': int(row.get('Conversions', 0)),
+            'ctr': ctr_value,
+            'cpc': cpc_value
+        }
+        
+        # Добавляем goal conversions если есть
+        if 'GoalConversions' in row:
+            placement['goal_conversions'] = int(row.get('GoalConversions', 0))
+        if 'GoalCost' in row:
+            placement['goal_cost'] = float(row.get('GoalCost', 0))
+        
+        yield placement
+
+
 def fetch_placements_from_yandex(token: str, campaign_ids: List[int], goals: List[Dict], config: Dict) -> List[Dict]:
     '''Получение площадок из Яндекс.Директ API Reports v5 (батчами по 5 кампаний)'''
     
@@ -481,7 +622,6 @@ def fetch_placements_from_yandex(token: str, campaign_ids: List[int], goals: Lis
                     ]
                 },
                 'FieldNames': columns,
-                'ReportName': f'RSYAPlacements_{datetime.now().strftime("%Y%m%d_%H%M%S")}_batch{i // batch_size + 1}',
                 'ReportType': 'CUSTOM_REPORT',
                 'DateRangeType': 'CUSTOM_DATE',
                 'Format': 'TSV',
@@ -503,18 +643,29 @@ def fetch_placements_from_yandex(token: str, campaign_ids: List[int], goals: Lis
             'skipColumnHeader': 'false'
         }
         
+        try:
+            report_data['params']['ReportName'] = resolve_report_name('RSYAPlacements', headers, report_data['params'])
+        except Exception as e:
+            print(f'⚠️ Report registry connection failed: {e}')
+            report_data['params']['ReportName'] = f'RSYAPlacements_{datetime.now().strftime("%Y%m%d_%H%M%S")}_batch{i // batch_size + 1}'
+        
         print(f'📤 Sending batch {i // batch_size + 1} request to Yandex API...')
-        response = requests.post(
+        limiter = direct_limiter_for_headers(headers)
+        limiter.acquire()
+        response = http_session.post(
             'https://api.direct.yandex.com/json/v5/reports',
             json=report_data,
-            headers=headers
+            headers=headers,
+            stream=True
         )
+        limiter.observe(response)
         
         print(f'📥 Batch {i // batch_size + 1} response status: {response.status_code}')
         
         if response.status_code == 201 or response.status_code == 202:
             # Сохраняем запрос в БД для async обработки
             report_name = report_data['params']['ReportName']
+            response.close()
             status_msg = 'being created (201)' if response.status_code == 201 else 'still processing (202)'
             print(f'⏳ Batch {i // batch_size + 1}: Report {status_msg}. Saving to pending_reports table')
             
@@ -533,50 +684,13 @@ def fetch_placements_from_yandex(token: str, campaign_ids: List[int], goals: Lis
             print(f'❌ Response text: {response.text[:1000]}')
             continue
         
-        print(f'✅ Batch {i // batch_size + 1}: Report ready! Response length: {len(response.text)} bytes')
-        
-        # Парсим TSV ответ
-        lines = response.text.strip().split('\n')
-        if not lines:
-            continue
-        
-        # Первая строка - заголовки
-        headers_line = lines[0].split('\t')
+        print(f'✅ Batch {i // batch_size + 1}: Report ready! Streaming rows...')
         
-        for line in lines[1:]:
-            values = line.split('\t')
-            if len(values) != len(headers_line):
-                continue
-            
-            row = dict(zip(headers_line, values))
-            
-            # Пропускаем строки с пустыми площадками
-            if not row.get('Placement') or row['Placement'] == '--':
-                continue
-            
-            # Парсим CPC и CTR из API (уже в нормальных единицах)
-            ctr_value = float(row.get('Ctr', 0)) if row.get('Ctr') and row.get('Ctr') != '--' else 0.0
-            cpc_micro = float(row.get('AvgCpc', 0)) if row.get('AvgCpc') and row.get('AvgCpc') != '--' else 0.0
-            cpc_value = cpc_micro / 1_000_000  # Конвертируем из микро-единиц в рубли
-            
-            placement = {
-                'campaign_id': int(row['CampaignId']),
-                'domain': row['Placement'],
-                'cost': float(row.get('Cost', 0)),
-                'impressions': int(row.get('Impressions', 0)),
-                'clicks': int(row.get('Clicks', 0)),
-                'conversions': int(row.get('Conversions', 0)),
-                'ctr': ctr_value,
-                'cpc': cpc_value
-            }
-            
-            # Добавляем goal conversions если есть
-            if 'GoalConversions' in row:
-                placement['goal_conversions'] = int(row.get('GoalConversions', 0))
-            if 'GoalCost' in row:
-                placement['goal_cost'] = float(row.get('GoalCost', 0))
-            
+        batch_placements = 0
+        for placement in parse_placements_tsv(iter_report_lines(response)):
             all_placements.append(placement)
+            batch_placements += 1
+        print(f'📊 Batch {i // batch_size + 1}: {batch_placements} placements')
     
     print(f'✅ Total placements collected from all batches: {len(all_placements)}')
     return all_placements
@@ -707,7 +821,7 @@ def fetch_metrika_goals(token: str, counter_ids: List[int]) -> List[Dict]:
     
     for counter_id in counter_ids:
         try:
-            response = requests.get(
+            response = http_session.get(
                 f'https://api-metrika.yandex.net/management/v1/counter/{counter_id}/goals',
                 headers={'Authorization': f'OAuth {token}'}
             )
@@ -728,7 +842,9 @@ def fetch_already_blocked_placements(token: str, campaign_ids: List[int]) -> set
     
     for campaign_id in campaign_ids:
         try:
-            response = requests.post(
+            limiter = get_direct_limiter(token)
+            limiter.acquire()
+            response = http_session.post(
                 'https://api.direct.yandex.com/json/v5/campaigns',
                 json={
                     'method': 'get',
@@ -741,6 +857,7 @@ def fetch_already_blocked_placements(token: str, campaign_ids: List[int]) -> set
                 },
                 headers={'Authorization': f'Bearer {token}'}
             )
+            limiter.observe(response)
             
             if response.status_code == 200:
                 data = response.json()
@@ -6,19 +6,55 @@ import time
 import io
 import hashlib
 import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 import boto3  # нужен в рантайме при вызове по триггеру MQ
 import psycopg2
 import psycopg2.extras
 import requests
+try:
+    import numpy as np  # опционально: векторная проверка порогов метрик на больших кампаниях
+except ImportError:
+    np = None
+from direct_client import (
+    build_http_session,
+    get_direct_limiter,
+    direct_error_code,
+    wait_direct_rate_limit,
+    DIRECT_LIMIT_ERROR_CODES,
+)
+from direct_reports import iter_report_lines, parse_tsv_report
+from task_filter import CompiledTaskFilter, normalize_goal_ids
 
 # Retry настройки
 RETRY_DELAYS = [5, 10, 20, 40, 60]  # Exponential backoff
 MAX_WAIT_FOR_429 = 60  # Максимум ждём 60 сек при 429
-API_DELAY = 0.6  # Задержка между API запросами (лимит: 20 req / 10 sec)
+# Сколько кампаний батча параллельно тянут отчёты из Директа (1 — строго по очереди)
+CAMPAIGN_CONCURRENCY = max(1, int(os.environ.get('RSYA_CAMPAIGN_CONCURRENCY', '4')))
+# Аренда батча: воркер продлевает её между кампаниями, просроченную аренду (воркер упал / 499) забирает другой
+BATCH_LEASE_SEC = int(os.environ.get('RSYA_BATCH_LEASE_SEC', '300'))
 DIRECT_CAMPAIGNS_TIMEOUT = 60
 DIRECT_CAMPAIGNS_RETRY_DELAYS = [3, 8, 15, 30]
+CAMPAIGNS_GET_CHUNK = 1000  # Лимит Ids в SelectionCriteria campaigns.get
+CAMPAIGNS_UPDATE_CHUNK = 10  # Лимит кампаний в одном campaigns.update
+# daily — один отчёт за 7 дней с полем Date, периоды (сегодня/вчера/7 дней) собираются локально
+# periods — старый режим: отдельный отчёт на каждый период
+REPORT_MODE = os.environ.get('RSYA_REPORT_MODE', 'daily').strip().lower()
+# Один отчёт на весь батч (CampaignId IN [...]) вместо отчёта на каждую кампанию
+BATCH_REPORTS = os.environ.get('RSYA_BATCH_REPORTS', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+# С какого числа кандидатов пороги метрик считаются массивами NumPy (0 — всегда построчно)
+COLUMNAR_MIN_ROWS = int(os.environ.get('RSYA_COLUMNAR_MIN_ROWS', '2000'))
+# Общий реестр отчётов (rsya_report_registry): тот же запрос в пределах TTL переиспользует ReportName
+REPORT_REUSE_TTL_SEC = int(os.environ.get('RSYA_REPORT_REUSE_TTL_SEC', '1800'))  # Отчёт, включающий сегодня
+REPORT_REUSE_HISTORY_TTL_SEC = 6 * 3600  # Отчёт только за прошедшие дни
+HTTP_POOL_MAXSIZE = max(10, CAMPAIGN_CONCURRENCY * 2)  # Соединений на хост: параллельные отчёты батча
+
+
+http_session = build_http_session(HTTP_POOL_MAXSIZE)
+
 
 IMPORTANT_PLATFORMS = {
     'yandex.ru', 'ya.ru', 'dzen.ru', 'kinopoisk.ru', 'mail.ru', 'vk.com', 'ok.ru',
@@ -34,19 +70,121 @@ def is_important_platform(domain: str) -> bool:
     return any(domain == important or domain.endswith('.' + important) for important in IMPORTANT_PLATFORMS)
 
 
+# Снимок Campaign.ExcludedSites в рамках одного вызова: campaign_id → список доменов или 'UNMODIFIABLE'.
+# Общий для get_blocked_sites / block_sites / unblock_sites, обновляется после успешного update.
+_excluded_sites_cache: Dict[str, Any] = {}
+
+
+def reset_excluded_sites_cache() -> None:
+    _excluded_sites_cache.clear()
+
+
+def _cached_excluded_sites(campaign_id: str):
+    cached = _excluded_sites_cache.get(str(campaign_id))
+    if isinstance(cached, list):
+        return list(cached)
+    return cached
+
+
+def save_direct_budget(yandex_token: str, client_login: str, cursor) -> None:
+    '''Сохраняет последний известный бюджет баллов токена в rsya_direct_api_budget.'''
+    budget = get_direct_limiter(yandex_token, client_login).budget()
+    if budget['units_available'] is None and budget['cooldown_sec'] <= 0:
+        return
+    try:
+        # Savepoint: ошибка записи бюджета не должна откатывать результаты батча
+        cursor.execute("SAVEPOINT direct_budget")
+        cursor.execute("""
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_direct_api_budget
+                (token_hash, client_login, units_spent, units_available, units_daily, units_login, cooldown_until, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, NOW() + make_interval(secs => %s), NOW())
+            ON CONFLICT (token_hash, client_login) DO UPDATE SET
+                units_spent = COALESCE(EXCLUDED.units_spent, rsya_direct_api_budget.units_spent),
+                units_available = COALESCE(EXCLUDED.units_available, rsya_direct_api_budget.units_available),
+                units_daily = COALESCE(EXCLUDED.units_daily, rsya_direct_api_budget.units_daily),
+                units_login = COALESCE(EXCLUDED.units_login, rsya_direct_api_budget.units_login),
+                cooldown_until = EXCLUDED.cooldown_until,
+                updated_at = NOW()
+        """, (
+            hashlib.sha256(yandex_token.encode('utf-8')).hexdigest(),
+            client_login or '',
+            budget['units_spent'],
+            budget['units_available'],
+            budget['units_daily'],
+            budget['units_login'],
+            budget['cooldown_sec'],
+        ))
+        cursor.execute("RELEASE SAVEPOINT direct_budget")
+        print(f"💰 Direct units: {budget['units_available']}/{budget['units_daily']} (login {budget['units_login'] or '-'})", flush=True)
+    except Exception as e:
+        print(f"⚠️ Failed to save Direct budget: {e}", flush=True)
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT direct_budget")
+        except Exception:
+            pass
+
+
+def save_campaign_watermarks(
+    project_id: int,
+    results: List[Dict[str, Any]],
+    changes_timestamp: Optional[str],
+    tasks_fingerprint: Optional[str],
+    cursor
+) -> None:
+    '''Сохраняет Changes Timestamp батча для успешно обработанных кампаний (rsya_campaign_watermarks).'''
+    campaign_ids = sorted({str(r['campaign_id']) for r in results if r.get('status') == 'success'})
+    if not changes_timestamp or not campaign_ids:
+        return
+    try:
+        # Savepoint: ошибка записи водяных знаков не должна откатывать результаты батча
+        cursor.execute("SAVEPOINT campaign_watermarks")
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_campaign_watermarks
+                (project_id, campaign_id, changes_timestamp, tasks_fingerprint, last_processed_at)
+            VALUES %s
+            ON CONFLICT (project_id, campaign_id) DO UPDATE SET
+                changes_timestamp = EXCLUDED.changes_timestamp,
+                tasks_fingerprint = EXCLUDED.tasks_fingerprint,
+                last_processed_at = NOW()
+        """, [
+            (project_id, campaign_id, changes_timestamp, tasks_fingerprint)
+            for campaign_id in campaign_ids
+        ], template='(%s, %s, %s, %s, NOW())')
+        cursor.execute("RELEASE SAVEPOINT campaign_watermarks")
+    except Exception as e:
+        print(f"⚠️ Failed to save campaign watermarks: {e}", flush=True)
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT campaign_watermarks")
+        except Exception:
+            pass
+
+
+# psycopg2-соединение не потокобезопасно: запись из параллельных загрузок отчётов — только под этим локом
+_db_lock = threading.Lock()
+
+
+def run_concurrently(func, items: List[Any]) -> List[Any]:
+    '''Выполняет func(item) для каждого элемента в пуле потоков (CAMPAIGN_CONCURRENCY), сохраняя порядок.'''
+    if CAMPAIGN_CONCURRENCY <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(CAMPAIGN_CONCURRENCY, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
 def post_direct_campaigns_with_retry(headers: Dict[str, str], payload: Dict[str, Any], operation: str) -> Optional[requests.Response]:
     url = 'https://api.direct.yandex.com/json/v5/campaigns'
     last_error = None
 
     for attempt, delay in enumerate(DIRECT_CAMPAIGNS_RETRY_DELAYS, start=1):
         try:
-            response = requests.post(
+            limiter = wait_direct_rate_limit(headers)
+            response = http_session.post(
                 url,
                 json=payload,
                 headers=headers,
                 timeout=DIRECT_CAMPAIGNS_TIMEOUT
             )
-            time.sleep(API_DELAY)
+            limiter.observe(response)
             return response
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
             last_error = e
@@ -66,20 +204,138 @@ def post_direct_campaigns_with_retry(headers: Dict[str, str], payload: Dict[str,
     return None
 
 
-def mark_batch_failed_fresh_conn(batch_id: int, error_message: str) -> bool:
+def batch_worker_id(context: Any) -> str:
+    '''Идентификатор владельца аренды: request_id вызова + суффикс (DB fallback вызовов с одним request_id много).'''
+    return f"{getattr(context, 'request_id', None) or 'batch-worker'}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_batch(cursor, conn, worker_id: str, batch_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Атомарно забирает батч в processing с арендой на BATCH_LEASE_SEC: pending или processing с истёкшей арендой.
+    FOR UPDATE SKIP LOCKED — параллельные воркеры не ждут друг друга и не забирают один батч дважды.
+    batch_id=None — самый старый батч очереди (DB fallback), иначе — конкретный батч (MQ / HTTP).
+    Returns: строка батча или None, если забирать нечего
+    '''
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches b
+        SET status = 'processing',
+            started_at = NOW(),
+            lease_owner = %s,
+            lease_expires_at = NOW() + make_interval(secs => %s),
+            heartbeat_at = NOW()
+        FROM t_p97630513_yandex_cleaning_serv.rsya_projects p
+        WHERE p.id = b.project_id
+          AND b.id = (
+            SELECT id
+            FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+            WHERE status IN ('pending', 'processing')
+              AND (status = 'pending' OR lease_expires_at < NOW())
+              AND (%s::INTEGER IS NULL OR id = %s)
+            ORDER BY created_at ASC, emit_order ASC NULLS LAST
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+          )
+        RETURNING b.id, b.project_id, b.run_id, b.campaign_ids, b.changes_timestamp, b.tasks_fingerprint,
+                  p.yandex_token, p.client_login
+    """, (worker_id, BATCH_LEASE_SEC, batch_id, batch_id))
+    batch = cursor.fetchone()
+    conn.commit()
+    return batch
+
+
+def renew_batch_lease(batch_id: int, worker_id: str, cursor, conn) -> bool:
+    '''Heartbeat: продлевает аренду батча. False — аренду забрал другой воркер, обработку надо прекратить.'''
+    try:
+        cursor.execute("""
+            UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+            SET lease_expires_at = NOW() + make_interval(secs => %s),
+                heartbeat_at = NOW()
+            WHERE id = %s AND lease_owner = %s AND status = 'processing'
+        """, (BATCH_LEASE_SEC, batch_id, worker_id))
+        renewed = cursor.rowcount > 0
+        conn.commit()
+        return renewed
+    except Exception as e:
+        print(f"⚠️ Batch {batch_id}: lease heartbeat failed: {e}", flush=True)
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        # Владение арендой не подтверждено — останавливаемся, батч продолжит владелец аренды
+        return False
+
+
+def finish_run_batch(project_id: int, run_id: Optional[int], cursor) -> bool:
+    '''
+    Батч запуска перешёл в completed/failed: атомарно уменьшает remaining_batches запуска
+    (в той же транзакции, что и статус батча). Последний батч закрывает запуск и сдвигает next_run_at.
+    Батчи без run_id (до V0085) проверяются старым COUNT(*) по проекту.
+    Returns: True, если запуск завершён
+    '''
+    if run_id:
+        cursor.execute("""
+            UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_runs
+            SET remaining_batches = remaining_batches - 1,
+                status = CASE WHEN remaining_batches <= 1 THEN 'completed' ELSE status END,
+                completed_at = CASE WHEN remaining_batches <= 1 THEN NOW() ELSE completed_at END
+            WHERE id = %s AND status = 'running'
+            RETURNING remaining_batches
+        """, (run_id,))
+        row = cursor.fetchone()
+        run_finished = row is not None and row['remaining_batches'] <= 0
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) AS active_batches
+            FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+            WHERE project_id = %s
+              AND status IN ('pending', 'processing')
+        """, (project_id,))
+        run_finished = int((cursor.fetchone() or {}).get('active_batches') or 0) == 0
+    if run_finished:
+        cursor.execute("""
+            UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_schedule
+            SET last_run_at = NOW(),
+                next_run_at = NOW() + make_interval(hours => interval_hours),
+                updated_at = NOW()
+            WHERE project_id = %s
+        """, (project_id,))
+        print(f"🕒 Project {project_id}: all batches completed, next run shifted from finish time", flush=True)
+    return run_finished
+
+
+def mark_batch_failed(
+    batch_id: int, error_message: str, project_id: int, run_id: Optional[int], worker_id: str, cursor
+) -> None:
+    '''
+    Переводит батч в failed; если батч был активным — он тоже засчитывается запуску как завершённый.
+    Батч, аренду которого уже забрал другой воркер, не трогаем.
+    '''
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+        SET status = 'failed',
+            error_message = %s,
+            retry_count = retry_count + 1,
+            lease_expires_at = NULL
+        WHERE id = %s
+          AND status IN ('pending', 'processing')
+          AND (lease_owner = %s OR status = 'pending')
+    """, (error_message[:500], batch_id, worker_id))
+    if cursor.rowcount > 0:
+        finish_run_batch(project_id, run_id, cursor)
+
+
+def mark_batch_failed_fresh_conn(
+    batch_id: int, error_message: str, project_id: int, run_id: Optional[int], worker_id: str
+) -> bool:
     """Обновить статус батча на failed через новое подключение (если основное мёртвое, напр. при 499)."""
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
         return False
     try:
         conn = psycopg2.connect(dsn)
-        conn.autocommit = True
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-            SET status = 'failed', error_message = %s, retry_count = retry_count + 1
-            WHERE id = %s
-        """, (error_message[:500], batch_id))
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        mark_batch_failed(batch_id, error_message, project_id, run_id, worker_id, cur)
+        conn.commit()
         conn.close()
         return True
     except Exception as e:
@@ -167,8 +423,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     return process_batch_message(data, context)
 
 
-def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    '''Обрабатывает один батч кампаний из MQ/HTTP/DB.'''
+def process_batch_message(data: Dict[str, Any], context: Any, claimed_by: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    Обрабатывает один батч кампаний из MQ/HTTP/DB.
+    claimed_by — батч уже забран claim_batch (DB fallback) этим владельцем аренды.
+    '''
     batch_id = data.get('batch_id')
     project_id = data.get('project_id')
     campaign_ids = data.get('campaign_ids', [])
@@ -193,20 +452,15 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
     start_time = time.time()
     conn = None
     cursor = None
+    worker_id = claimed_by or batch_worker_id(context)
     
     try:
         conn = psycopg2.connect(dsn)
         conn.autocommit = False
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        # Забираем батч только если он ещё pending (чтобы один батч не обрабатывали несколько воркеров)
-        cursor.execute("""
-            UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-            SET status = 'processing', started_at = NOW()
-            WHERE id = %s AND status = 'pending'
-        """, (batch_id,))
-        conn.commit()
-        if cursor.rowcount == 0:
+        # Забираем батч с арендой (чтобы один батч не обрабатывали несколько воркеров)
+        if not claimed_by and not claim_batch(cursor, conn, worker_id, batch_id):
             conn.close()
             print(f"⏭️ Batch {batch_id} already taken by another worker, skipping", flush=True)
             return {
@@ -220,20 +474,43 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 })
             }
         
-        # Очищаем устаревшие локи (от отменённых/упавших прошлых запусков), чтобы кампании были доступны
-        cursor.execute("""
-            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_locks 
-            WHERE expires_at < NOW()
-        """)
-        cleared = cursor.rowcount
-        conn.commit()
-        if cleared > 0:
-            print(f"🔓 Cleared {cleared} expired campaign locks", flush=True)
-        
+        # Просроченные локи кампаний не чистим: acquire_campaign_lock перехватывает их сам
         print(f"📦 rsya-batch-worker: processing batch {batch_id}, {len(campaign_ids)} campaigns", flush=True)
-        # Обрабатываем каждую кампанию в батче
+        # Тёплый контейнер: снимки ExcludedSites прошлого вызова могли устареть
+        reset_excluded_sites_cache()
+
+        # Задачи проекта одинаковы для всех кампаний батча
+        tasks = load_active_tasks(project_id, cursor)
+        batch_reports = {}
+        if tasks and BATCH_REPORTS and len(campaign_ids) > 1:
+            batch_reports = get_batch_report_sets(
+                [str(c) for c in campaign_ids], yandex_token, client_login, cursor, conn, project_id, tasks
+            )
+        elif tasks and CAMPAIGN_CONCURRENCY > 1 and len(campaign_ids) > 1:
+            # Отчёты по кампаниям — параллельно под общим лимитом токена, разбор и запись в БД — последовательно
+            batch_reports = dict(zip(
+                [str(c) for c in campaign_ids],
+                run_concurrently(
+                    lambda campaign_id: get_batch_report_sets(
+                        [str(campaign_id)], yandex_token, client_login, cursor, conn, project_id, tasks
+                    ).get(str(campaign_id)),
+                    list(campaign_ids)
+                )
+            ))
+        if tasks and len(campaign_ids) > 1:
+            # ExcludedSites всего батча одним campaigns.get
+            prefetch_excluded_sites(yandex_token, [str(c) for c in campaign_ids], client_login)
+
+        # Обрабатываем каждую кампанию в батче; блокировки копятся и уходят в Директ одним bulk update
         results = []
+        deferred_blocks = {}
+        lease_lost = False
         for campaign_id in campaign_ids:
+            if not renew_batch_lease(batch_id, worker_id, cursor, conn):
+                # Аренда истекла и батч забрал другой воркер — оставшиеся кампании обработает он
+                print(f"⚠️ Batch {batch_id}: lease lost, stopping after {len(results)} campaigns", flush=True)
+                lease_lost = True
+                break
             try:
                 result = process_campaign(
                     campaign_id, 
@@ -242,7 +519,10 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     project_id,
                     cursor, 
                     conn, 
-                    context
+                    context,
+                    tasks=tasks,
+                    report_sets=batch_reports.get(str(campaign_id)),
+                    deferred_blocks=deferred_blocks
                 )
                 results.append(result)
             except Exception as e:
@@ -256,6 +536,19 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'status': 'error',
                     'error': str(e)
                 })
+            if len(deferred_blocks) >= CAMPAIGNS_UPDATE_CHUNK:
+                # Блокируем и логируем по ходу батча: таймаут или падение не теряют уже сделанную работу
+                if not renew_batch_lease(batch_id, worker_id, cursor, conn):
+                    print(f"⚠️ Batch {batch_id}: lease lost before blocking, stopping after {len(results)} campaigns", flush=True)
+                    lease_lost = True
+                    break
+                flush_deferred_blocks(deferred_blocks, results, yandex_token, client_login, cursor, conn, context)
+
+        if deferred_blocks and not lease_lost:
+            flush_deferred_blocks(deferred_blocks, results, yandex_token, client_login, cursor, conn, context)
+        elif deferred_blocks:
+            # Аренду забрал другой воркер — он заново обработает и заблокирует эти кампании
+            print(f"⚠️ Batch {batch_id}: dropping {len(deferred_blocks)} deferred blocks after lease loss", flush=True)
         
         # Подсчитываем статистику
         successful = sum(1 for r in results if r.get('status') == 'success')
@@ -264,32 +557,26 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
         total_blocked = sum(r.get('blocked', 0) or 0 for r in results)
         
         processing_time = int(time.time() - start_time)
+
+        # Остаток баллов токена — планировщик не запустит проект, пока бюджет исчерпан
+        save_direct_budget(yandex_token, client_login, cursor)
+        # Водяные знаки — плановый запуск пропустит эти кампании, пока у них нет новой статистики
+        save_campaign_watermarks(
+            project_id, results, data.get('changes_timestamp'), data.get('tasks_fingerprint'), cursor
+        )
         
-        # Обновляем статус батча
+        # Обновляем статус батча (только пока аренда наша)
         cursor.execute("""
             UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
             SET status = 'completed',
                 completed_at = NOW(),
-                processing_time_sec = %s
-            WHERE id = %s
-        """, (processing_time, batch_id))
-
-        cursor.execute("""
-            SELECT COUNT(*) AS active_batches
-            FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-            WHERE project_id = %s
-              AND status IN ('pending', 'processing')
-        """, (project_id,))
-        active_batches = int((cursor.fetchone() or {}).get('active_batches') or 0)
-        if active_batches == 0:
-            cursor.execute("""
-                UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_schedule
-                SET last_run_at = NOW(),
-                    next_run_at = NOW() + make_interval(hours => interval_hours),
-                    updated_at = NOW()
-                WHERE project_id = %s
-            """, (project_id,))
-            print(f"🕒 Project {project_id}: all batches completed, next run shifted from finish time", flush=True)
+                processing_time_sec = %s,
+                lease_expires_at = NULL
+            WHERE id = %s AND lease_owner = %s AND status = 'processing'
+        """, (processing_time, batch_id, worker_id))
+        if cursor.rowcount > 0:
+            # Счётчик запуска — в той же транзакции, что и статус батча
+            finish_run_batch(project_id, data.get('run_id'), cursor)
         
         conn.commit()
         cursor.close()
@@ -311,6 +598,7 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'successful': successful,
                 'failed': failed,
                 'skipped': skipped,
+                'lease_lost': lease_lost,
                 'processing_time_sec': processing_time
             })
         }
@@ -329,13 +617,7 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
         updated = False
         if conn and cursor:
             try:
-                cursor.execute("""
-                    UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-                    SET status = 'failed',
-                        error_message = %s,
-                        retry_count = retry_count + 1
-                    WHERE id = %s
-                """, (str(e)[:500], batch_id))
+                mark_batch_failed(batch_id, str(e), project_id, data.get('run_id'), worker_id, cursor)
                 conn.commit()
                 updated = True
             except Exception as db_error:
@@ -345,7 +627,7 @@ def process_batch_message(data: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 except Exception:
                     pass
         if not updated and batch_id:
-            updated = mark_batch_failed_fresh_conn(batch_id, str(e))
+            updated = mark_batch_failed_fresh_conn(batch_id, str(e), project_id, data.get('run_id'), worker_id)
         if not updated:
             print(f"⚠️ Could not mark batch {batch_id} as failed in DB")
         
@@ -363,21 +645,23 @@ def process_campaign(
     project_id: int,
     cursor, 
     conn, 
-    context: Any
+    context: Any,
+    tasks=None,
+    report_sets=None,
+    deferred_blocks: Optional[Dict[str, Dict[str, Any]]] = None
 ) -> Dict[str, Any]:
     '''
     Обработка одной кампании: получение площадок, фильтрация по задачам, блокировка
+    tasks / report_sets — уже загруженные на уровне батча задачи и площадки ([базовые периоды], [периоды по целям])
+    deferred_blocks — если передан, блокировка не выполняется сразу: кампания регистрируется в нём
+    со статусом pending_block, батч блокирует всё одним block_sites_bulk и вызывает finish_campaign_block
     '''
     
     # Батч уже забран одним воркером (UPDATE pending→processing), дубли кампаний убираются в планировщике — локи на уровне кампании не нужны
     try:
         # 2. Получаем активные задачи проекта
-        cursor.execute("""
-            SELECT id, description, config, combine_operator
-            FROM t_p97630513_yandex_cleaning_serv.rsya_tasks
-            WHERE project_id = %s AND enabled = TRUE
-        """, (project_id,))
-        tasks = cursor.fetchall()
+        if tasks is None:
+            tasks = load_active_tasks(project_id, cursor)
         
         if not tasks:
             print(f"⚠️ No active tasks for project {project_id}")
@@ -394,17 +678,14 @@ def process_campaign(
             print(f"🎯 Project {project_id}: loading Direct reports for goals {selected_goal_ids}", flush=True)
         
         # 3. Получаем площадки за 3 периода (сегодня, вчера, 7 дней)
-        platforms_today = get_platforms_with_retry(campaign_id, yandex_token, client_login, 0, 0, cursor, conn, project_id, first_task_id)
-        platforms_yesterday = get_platforms_with_retry(campaign_id, yandex_token, client_login, 1, 1, cursor, conn, project_id, first_task_id)
-        platforms_7d = get_platforms_with_retry(campaign_id, yandex_token, client_login, 7, 0, cursor, conn, project_id, first_task_id)
-
-        goal_platform_sets = []
-        if selected_goal_ids:
-            goal_platform_sets = [
-                get_platforms_with_retry(campaign_id, yandex_token, client_login, 0, 0, cursor, conn, project_id, first_task_id, selected_goal_ids),
-                get_platforms_with_retry(campaign_id, yandex_token, client_login, 1, 1, cursor, conn, project_id, first_task_id, selected_goal_ids),
-                get_platforms_with_retry(campaign_id, yandex_token, client_login, 7, 0, cursor, conn, project_id, first_task_id, selected_goal_ids),
-            ]
+        if report_sets is None:
+            report_sets = (
+                get_period_platforms([campaign_id], yandex_token, client_login, cursor, conn, project_id, first_task_id)[str(campaign_id)],
+                get_period_platforms(
+                    [campaign_id], yandex_token, client_login, cursor, conn, project_id, first_task_id, selected_goal_ids
+                )[str(campaign_id)] if selected_goal_ids else [],
+            )
+        (platforms_today, platforms_yesterday, platforms_7d), goal_platform_sets = report_sets
         
         # Если все отчёты async (201/202) → пропускаем (обработает поллер)
         if platforms_today is None and platforms_yesterday is None and platforms_7d is None:
@@ -468,17 +749,17 @@ def process_campaign(
         matched_platforms = []
         task_matches = {}
         task_kept_examples = {}
+        unblocked_candidates = [p for p in candidates if p['domain'].lower() not in blocked_domains]
+        columns = build_platform_columns(unblocked_candidates)
         for task in tasks:
-            config = json.loads(task['config']) if isinstance(task['config'], str) else task['config']
+            task_filter = compile_task_filter(task)
             task_id = task['id']
             task_matches[task_id] = []
             task_kept_examples[task_id] = []
             
-            for platform in candidates:
-                if platform['domain'].lower() in blocked_domains:
-                    continue
-                
-                if matches_task_filters(platform, config, task.get('combine_operator') or 'AND'):
+            matched_flags = columns.match_mask(task_filter).tolist() if columns is not None else None
+            for index, platform in enumerate(unblocked_candidates):
+                if matched_flags[index] if matched_flags is not None else task_filter.matches(platform):
                     matched_platforms.append(platform)
                     task_matches[task_id].append(platform)
                     print(f"✅ Platform {platform['domain']} matched task '{task['description']}'")
@@ -531,50 +812,157 @@ def process_campaign(
             to_block_domains = {p['domain'] for p in to_block}
         
         # 8. Добавляем новые блокировки в Директе
-        actually_blocked = 0
-        actually_blocked_domains = set()
-        block_attempt_success = True
-        if to_block:
-            blocked_domains = block_sites(campaign_id, yandex_token, client_login, [p['domain'] for p in to_block])
-            if blocked_domains is not None:
-                actually_blocked_domains = set(blocked_domains)
-                actually_blocked = len(actually_blocked_domains)
-                print(f"🚫 Campaign {campaign_id}: blocked {actually_blocked} platforms in Yandex", flush=True)
-            else:
-                block_attempt_success = False
-                print(f"❌ Campaign {campaign_id}: block_sites API failed, 0 blocked", flush=True)
-                return {
-                    'campaign_id': campaign_id,
-                    'status': 'error',
-                    'blocked': 0,
-                    'error': 'ExcludedSites API failed'
-                }
-        write_execution_logs(
-            cursor,
-            conn,
-            project_id,
-            campaign_id,
-            tasks,
-            candidates,
-            task_matches,
-            task_kept_examples,
-            to_block_domains,
-            block_attempt_success,
-            context,
-            actually_blocked,
-            actually_blocked_domains
-        )
-
-        return {
+        entry = {
             'campaign_id': campaign_id,
-            'status': 'success',
-            'blocked': actually_blocked,
-            'candidates': len(candidates)
+            'project_id': project_id,
+            'tasks': tasks,
+            'candidates': candidates,
+            'task_matches': task_matches,
+            'task_kept_examples': task_kept_examples,
+            'to_block_domains': to_block_domains,
+            'domains': [p['domain'] for p in to_block],
         }
+        if to_block and deferred_blocks is not None:
+            deferred_blocks[str(campaign_id)] = entry
+            return {
+                'campaign_id': campaign_id,
+                'status': 'pending_block',
+                'candidates': len(candidates)
+            }
+
+        blocked_domains = []
+        if to_block:
+            blocked_domains = block_sites(campaign_id, yandex_token, client_login, entry['domains'])
+        return finish_campaign_block(entry, blocked_domains, cursor, conn, context)
     finally:
         pass
 
 
+def flush_deferred_blocks(
+    deferred_blocks: Dict[str, Dict[str, Any]],
+    results: List[Dict[str, Any]],
+    yandex_token: str,
+    client_login: str,
+    cursor,
+    conn,
+    context: Any
+) -> None:
+    '''
+    Блокирует накопленные кампании одним block_sites_bulk, дописывает логи (finish_campaign_block)
+    и заменяет их pending_block-результаты в results. deferred_blocks после вызова пуст.
+    '''
+    blocked_by_campaign = block_sites_bulk(
+        yandex_token,
+        client_login,
+        {key: entry['domains'] for key, entry in deferred_blocks.items()}
+    )
+    for index, result in enumerate(results):
+        entry = deferred_blocks.get(str(result.get('campaign_id')))
+        if result.get('status') != 'pending_block' or not entry:
+            continue
+        try:
+            results[index] = finish_campaign_block(
+                entry, blocked_by_campaign.get(str(result['campaign_id'])), cursor, conn, context
+            )
+        except Exception as e:
+            print(f"❌ Error finishing campaign {result['campaign_id']}: {str(e)}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            results[index] = {
+                'campaign_id': result['campaign_id'],
+                'status': 'error',
+                'error': str(e)
+            }
+    deferred_blocks.clear()
+
+
+def finish_campaign_block(
+    entry: Dict[str, Any],
+    blocked_domains: Optional[List[str]],
+    cursor,
+    conn,
+    context: Any
+) -> Dict[str, Any]:
+    '''Завершает обработку кампании после блокировки: логи выполнения и итог по кампании.'''
+    campaign_id = entry['campaign_id']
+    actually_blocked = 0
+    actually_blocked_domains = set()
+    if entry['domains']:
+        if blocked_domains is not None:
+            actually_blocked_domains = set(blocked_domains)
+            actually_blocked = len(actually_blocked_domains)
+            print(f"🚫 Campaign {campaign_id}: blocked {actually_blocked} platforms in Yandex", flush=True)
+        else:
+            print(f"❌ Campaign {campaign_id}: block_sites API failed, 0 blocked", flush=True)
+            return {
+                'campaign_id': campaign_id,
+                'status': 'error',
+                'blocked': 0,
+                'error': 'ExcludedSites API failed'
+            }
+    write_execution_logs(
+        cursor,
+        conn,
+        entry['project_id'],
+        campaign_id,
+        entry['tasks'],
+        entry['candidates'],
+        entry['task_matches'],
+        entry['task_kept_examples'],
+        entry['to_block_domains'],
+        True,
+        context,
+        actually_blocked,
+        actually_blocked_domains
+    )
+
+    return {
+        'campaign_id': campaign_id,
+        'status': 'success',
+        'blocked': actually_blocked,
+        'candidates': len(entry['candidates'])
+    }
+
+
+def load_active_tasks(project_id: int, cursor) -> List[Dict[str, Any]]:
+    cursor.execute("""
+        SELECT id, description, config, combine_operator
+        FROM t_p97630513_yandex_cleaning_serv.rsya_tasks
+        WHERE project_id = %s AND enabled = TRUE
+    """, (project_id,))
+    return cursor.fetchall()
+
+
+def get_batch_report_sets(
+    campaign_ids: List[str],
+    yandex_token: str,
+    client_login: str,
+    cursor,
+    conn,
+    project_id: int,
+    tasks
+) -> Dict[str, Any]:
+    '''
+    Отчёты сразу по всем кампаниям батча (CampaignId IN [...]), разложенные по кампаниям.
+    Returns: {campaign_id: ([сегодня, вчера, 7 дней], [те же периоды по целям])}
+    '''
+    first_task_id = tasks[0]['id']
+    selected_goal_ids = collect_selected_goal_ids(tasks)
+    print(f"📑 Batch report for {len(campaign_ids)} campaigns (mode={REPORT_MODE})", flush=True)
+
+    def fetch(goal_ids: Optional[List[str]]):
+        return get_period_platforms(campaign_ids, yandex_token, client_login, cursor, conn, project_id, first_task_id, goal_ids)
+
+    # Базовый отчёт и отчёт по целям независимы — тянем параллельно
+    base_sets, goal_sets = run_concurrently(fetch, [None, selected_goal_ids]) if selected_goal_ids else (fetch(None), {})
+    return {
+        campaign_id: (base_sets[campaign_id], goal_sets.get(campaign_id, []))
+        for campaign_id in campaign_ids
+    }
+
+
 def write_execution_logs(
     cursor,
     conn,
@@ -593,7 +981,13 @@ def write_execution_logs(
     request_id = getattr(context, 'request_id', None) or 'batch-worker'
     candidates_count = len(candidates)
     actual_blocked_domains = actual_blocked_domains or set()
+    if not tasks:
+        conn.commit()
+        return
 
+    # Логи всей кампании уходят несколькими многострочными INSERT вместо запроса на каждую строку
+    execution_rows = []
+    blocking_examples = {}
     for task in tasks:
         task_id = task['id']
         matched = task_matches.get(task_id, [])
@@ -615,14 +1009,7 @@ def write_execution_logs(
 
         blocked_count = actual_blocked_count if actual_blocked_count is not None else len(blocked_examples)
 
-        cursor.execute("""
-            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_cleaning_execution_logs
-            (project_id, task_id, execution_type, started_at, completed_at, finished_at,
-             placements_found, placements_matched, placements_sent_to_queue, placements_blocked,
-             status, request_id, metadata)
-            VALUES (%s, %s, 'batch_worker', NOW(), NOW(), NOW(), %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
+        execution_rows.append((
             project_id,
             task_id,
             candidates_count,
@@ -633,100 +1020,62 @@ def write_execution_logs(
             str(request_id),
             json.dumps(metadata, ensure_ascii=False)
         ))
-        execution_log_id = cursor.fetchone()['id']
-
-        for platform in blocked_examples[:100]:
-            cursor.execute("""
-                INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_blocking_logs
-                (execution_log_id, project_id, task_id, campaign_id, domain, action,
-                 clicks, cost, conversions, cpa, attempts, error_message)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, %s)
-            """, (
-                execution_log_id,
-                project_id,
-                task_id,
-                int(campaign_id),
-                platform['domain'],
-                'blocked',
-                int(platform.get('clicks', 0) or 0),
-                float(platform.get('cost', 0) or 0),
-                int(platform.get('conversions', 0) or 0),
-                float(platform.get('cpa', 0) or 0),
-                'important_platform' if is_important_platform(platform['domain']) else None
-            ))
-
-        for platform in not_applied_examples[:100]:
-            cursor.execute("""
-                INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_blocking_logs
-                (execution_log_id, project_id, task_id, campaign_id, domain, action,
-                 clicks, cost, conversions, cpa, attempts, error_message)
-                VALUES (%s, %s, %s, %s, %s, 'matched_not_blocked', %s, %s, %s, %s, 0, %s)
-            """, (
-                execution_log_id,
-                project_id,
-                task_id,
-                int(campaign_id),
-                platform['domain'],
-                int(platform.get('clicks', 0) or 0),
-                float(platform.get('cost', 0) or 0),
-                int(platform.get('conversions', 0) or 0),
-                float(platform.get('cpa', 0) or 0),
-                'not_applied_to_excluded_sites'
-            ))
-
-        for platform in kept_examples[:30]:
-            cursor.execute("""
-                INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_blocking_logs
-                (execution_log_id, project_id, task_id, campaign_id, domain, action,
-                 clicks, cost, conversions, cpa, attempts, error_message)
-                VALUES (%s, %s, %s, %s, %s, 'kept_example', %s, %s, %s, %s, 0, %s)
-            """, (
-                execution_log_id,
-                project_id,
-                task_id,
-                int(campaign_id),
-                platform['domain'],
-                int(platform.get('clicks', 0) or 0),
-                float(platform.get('cost', 0) or 0),
-                int(platform.get('conversions', 0) or 0),
-                float(platform.get('cpa', 0) or 0),
-                'important_platform' if is_important_platform(platform['domain']) else None
-            ))
+        blocking_examples[task_id] = (
+            [(p, 'blocked', 'important_platform' if is_important_platform(p['domain']) else None) for p in blocked_examples[:100]]
+            + [(p, 'matched_not_blocked', 'not_applied_to_excluded_sites') for p in not_applied_examples[:100]]
+            + [(p, 'kept_example', 'important_platform' if is_important_platform(p['domain']) else None) for p in kept_examples[:30]]
+        )
 
-        cursor.execute("""
-            UPDATE t_p97630513_yandex_cleaning_serv.rsya_tasks
-            SET last_executed_at = NOW()
-            WHERE id = %s
-        """, (task_id,))
+    inserted = psycopg2.extras.execute_values(cursor, """
+        INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_cleaning_execution_logs
+        (project_id, task_id, execution_type, started_at, completed_at, finished_at,
+         placements_found, placements_matched, placements_sent_to_queue, placements_blocked,
+         status, request_id, metadata)
+        VALUES %s
+        RETURNING id, task_id
+    """, execution_rows, template="(%s, %s, 'batch_worker', NOW(), NOW(), NOW(), %s, %s, %s, %s, %s, %s, %s)",
+        page_size=len(execution_rows), fetch=True)
+    execution_log_ids = {row['task_id']: row['id'] for row in inserted}
+
+    blocking_rows = [
+        (
+            execution_log_ids[task_id],
+            project_id,
+            task_id,
+            int(campaign_id),
+            platform['domain'],
+            action,
+            int(platform.get('clicks', 0) or 0),
+            float(platform.get('cost', 0) or 0),
+            int(platform.get('conversions', 0) or 0),
+            float(platform.get('cpa', 0) or 0),
+            error_message
+        )
+        for task_id, examples in blocking_examples.items()
+        for platform, action, error_message in examples
+    ]
+    if blocking_rows:
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_blocking_logs
+            (execution_log_id, project_id, task_id, campaign_id, domain, action,
+             clicks, cost, conversions, cpa, attempts, error_message)
+            VALUES %s
+        """, blocking_rows, template='(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0, %s)', page_size=1000)
+
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_tasks
+        SET last_executed_at = NOW()
+        WHERE id = ANY(%s)
+    """, (list(execution_log_ids.keys()),))
 
     conn.commit()
 
 
-def _normalize_list(value) -> List[str]:
-    if not value:
-        return []
-    if isinstance(value, str):
-        return [item.strip().lower() for item in value.split(',') if item.strip()]
-    return [str(item).strip().lower() for item in value if str(item).strip()]
-
-
-def _normalize_goal_ids(config: Dict[str, Any]) -> List[str]:
-    goal_ids = config.get('goal_ids')
-    if goal_ids:
-        return [str(goal_id).strip() for goal_id in goal_ids if str(goal_id).strip()][:10]
-
-    goal_id = str(config.get('goal_id') or '').strip()
-    if goal_id and goal_id not in ('all', 'selected'):
-        return [goal_id]
-
-    return []
-
-
 def collect_selected_goal_ids(tasks) -> List[str]:
     selected = []
     for task in tasks:
         config = json.loads(task['config']) if isinstance(task['config'], str) else (task['config'] or {})
-        for goal_id in _normalize_goal_ids(config):
+        for goal_id in normalize_goal_ids(config):
             if goal_id not in selected:
                 selected.append(goal_id)
             if len(selected) >= 10:
@@ -734,25 +1083,6 @@ def collect_selected_goal_ids(tasks) -> List[str]:
     return selected
 
 
-def _platform_conversions_for_config(platform: Dict[str, Any], config: Dict[str, Any]) -> int:
-    goal_ids = _normalize_goal_ids(config)
-    if not goal_ids:
-        return int(platform.get('conversions', 0) or 0)
-
-    goal_conversions = platform.get('goal_conversions') or {}
-    if goal_conversions:
-        return int(sum(goal_conversions.get(str(goal_id), 0) or 0 for goal_id in goal_ids))
-
-    return int(platform.get('conversions', 0) or 0)
-
-
-def _platform_cpa_for_config(platform: Dict[str, Any], config: Dict[str, Any]) -> float:
-    conversions = _platform_conversions_for_config(platform, config)
-    if conversions <= 0:
-        return 0
-    return float(platform.get('cost', 0) or 0) / conversions
-
-
 def merge_platform_metrics(target: Dict[str, Any], source: Dict[str, Any], merge_base_metrics: bool = True) -> None:
     if merge_base_metrics:
         target['clicks'] += source.get('clicks', 0)
@@ -772,64 +1102,82 @@ def merge_platform_metrics(target: Dict[str, Any], source: Dict[str, Any], merge
         target['cpa'] = target.get('cost', 0) / target['conversions']
 
 
-def _domain_matches_keyword(domain: str, keyword: str) -> bool:
-    if '.' in keyword:
-        if keyword.endswith('.') and not keyword.startswith('.'):
-            return domain.startswith(keyword)
-        if keyword.startswith('.') and not keyword.endswith('.'):
-            return domain.endswith(keyword)
-        return keyword in domain
-    return keyword in domain
-
-
-def matches_task_filters(platform: Dict[str, Any], config: Dict[str, Any], combine_operator: str = 'AND') -> bool:
+class PlatformColumns:
     '''
-    Проверяет соответствие площадки фильтрам задачи.
-    Исключения и защита конверсий всегда сильнее любых условий.
-    AND: все активные условия должны совпасть.
-    OR: достаточно любого активного условия.
+    Метрики кандидатов кампании массивами NumPy (строятся один раз на кампанию):
+    пороги каждой задачи — векторные маски, объединённые по AND/OR, вместо цикла по dict.
+    Результат совпадает с CompiledTaskFilter.matches для каждой строки.
     '''
-    domain = platform['domain'].lower()
-    combine_operator = (combine_operator or config.get('combine_operator') or 'AND').upper()
-    
-    exceptions = _normalize_list(config.get('exceptions', []))
-    if exceptions and any(exc in domain for exc in exceptions):
-        return False
 
-    if (config.get('protect_conversions') or _normalize_goal_ids(config)) and _platform_conversions_for_config(platform, config) > 0:
-        return False
+    def __init__(self, platforms: List[Dict[str, Any]]):
+        self.platforms = platforms
+        self.domains = [p['domain'].lower() for p in platforms]
+        self.fields = {
+            field: np.fromiter((p.get(field, 0) or 0 for p in platforms), dtype=float, count=len(platforms))
+            for field in ('impressions', 'clicks', 'cpc', 'ctr', 'cost')
+        }
+        self.conversions = np.fromiter(
+            (int(p.get('conversions', 0) or 0) for p in platforms), dtype=float, count=len(platforms)
+        )
+        self._goal_conversions: Dict[tuple, Any] = {}
+
+    def conversions_for(self, goal_ids: List[str]):
+        if not goal_ids:
+            return self.conversions
+        key = tuple(goal_ids)
+        if key not in self._goal_conversions:
+            values = np.array(self.conversions)
+            for index, platform in enumerate(self.platforms):
+                goal_conversions = platform.get('goal_conversions') or {}
+                if goal_conversions:
+                    values[index] = int(sum(goal_conversions.get(goal_id, 0) or 0 for goal_id in goal_ids))
+            self._goal_conversions[key] = values
+        return self._goal_conversions[key]
+
+    def _regex_mask(self, pattern):
+        return np.fromiter((pattern.search(domain) is not None for domain in self.domains), dtype=bool, count=len(self.domains))
+
+    def match_mask(self, task_filter: CompiledTaskFilter):
+        size = len(self.domains)
+        conversions = self.conversions_for(task_filter.goal_ids) if task_filter.needs_conversions else None
+
+        conditions = []
+        if task_filter.keywords_re is not None:
+            conditions.append(self._regex_mask(task_filter.keywords_re))
+        for field, is_min, threshold in task_filter.thresholds:
+            if field == 'conversions':
+                values = conversions
+            elif field == 'cpa':
+                values = np.divide(self.fields['cost'], conversions, out=np.zeros(size), where=conversions > 0)
+            else:
+                values = self.fields[field]
+            conditions.append(values >= threshold if is_min else values <= threshold)
 
-    conditions = []
-
-    keywords = _normalize_list(config.get('keywords', []))
-    if keywords:
-        conditions.append(any(_domain_matches_keyword(domain, kw) for kw in keywords))
-
-    metric_rules = [
-        ('min_impressions', lambda value: platform.get('impressions', 0) >= value),
-        ('max_impressions', lambda value: platform.get('impressions', 0) <= value),
-        ('min_clicks', lambda value: platform.get('clicks', 0) >= value),
-        ('max_clicks', lambda value: platform.get('clicks', 0) <= value),
-        ('min_cpc', lambda value: platform.get('cpc', 0) >= value),
-        ('max_cpc', lambda value: platform.get('cpc', 0) <= value),
-        ('min_ctr', lambda value: platform.get('ctr', 0) >= value),
-        ('max_ctr', lambda value: platform.get('ctr', 0) <= value),
-        ('min_conversions', lambda value: _platform_conversions_for_config(platform, config) >= value),
-        ('min_cpa', lambda value: _platform_cpa_for_config(platform, config) >= value),
-        ('max_cpa', lambda value: _platform_cpa_for_config(platform, config) <= value),
-    ]
+        if not conditions:
+            return np.zeros(size, dtype=bool)
+        mask = np.logical_or.reduce(conditions) if task_filter.combine_or else np.logical_and.reduce(conditions)
 
-    for key, predicate in metric_rules:
-        value = config.get(key)
-        if value is not None:
-            conditions.append(predicate(value))
+        if task_filter.exceptions_re is not None:
+            mask &= ~self._regex_mask(task_filter.exceptions_re)
+        if task_filter.protect_conversions:
+            mask &= ~(conversions > 0)
+        return mask
 
-    if not conditions:
-        return False
 
-    if combine_operator == 'OR':
-        return any(conditions)
-    return all(conditions)
+def build_platform_columns(platforms: List[Dict[str, Any]]) -> Optional[PlatformColumns]:
+    '''Колоночное представление для больших кампаний; None — numpy нет или строк мало.'''
+    if np is None or COLUMNAR_MIN_ROWS <= 0 or len(platforms) < COLUMNAR_MIN_ROWS:
+        return None
+    return PlatformColumns(platforms)
+
+
+def compile_task_filter(task: Dict[str, Any]) -> CompiledTaskFilter:
+    '''Фильтр задачи компилируется один раз: список задач общий для всех кампаний батча.'''
+    compiled = task.get('compiled_filter')
+    if compiled is None:
+        config = json.loads(task['config']) if isinstance(task['config'], str) else (task['config'] or {})
+        compiled = task['compiled_filter'] = CompiledTaskFilter(config, task.get('combine_operator') or 'AND')
+    return compiled
 
 
 def process_from_database() -> Dict[str, Any]:
@@ -846,27 +1194,12 @@ def process_from_database() -> Dict[str, Any]:
         conn = psycopg2.connect(dsn)
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        # ОЧИСТКА МЕРТВЫХ ЛОКОВ (старше 5 минут)
-        cursor.execute("""
-            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_locks 
-            WHERE expires_at < NOW()
-        """)
-        deleted_locks = cursor.rowcount
-        conn.commit()
-        if deleted_locks > 0:
-            print(f'🔓 Cleaned {deleted_locks} expired campaign locks')
-        
-        # Получаем 1 pending batch
-        cursor.execute("""
-            SELECT b.id, b.project_id, b.campaign_ids, p.yandex_token, p.client_login
-            FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches b
-            JOIN t_p97630513_yandex_cleaning_serv.rsya_projects p ON p.id = b.project_id
-            WHERE b.status = 'pending'
-            ORDER BY b.created_at ASC
-            LIMIT 1
-        """)
+        class FakeContext:
+            request_id = 'db-fallback'
         
-        batch = cursor.fetchone()
+        # Забираем 1 батч (pending или с истёкшей арендой) — параллельные fallback-воркеры берут разные батчи
+        worker_id = batch_worker_id(FakeContext())
+        batch = claim_batch(cursor, conn, worker_id)
         
         if not batch:
             conn.close()
@@ -880,23 +1213,20 @@ def process_from_database() -> Dict[str, Any]:
                 })
             }
         
-        # Обрабатываем батч рекурсивно через handler
-        event = {
-            'httpMethod': 'POST',
-            'body': json.dumps({
-                'batch_id': batch['id'],
-                'project_id': batch['project_id'],
-                'campaign_ids': json.loads(batch['campaign_ids']) if isinstance(batch['campaign_ids'], str) else batch['campaign_ids'],
-                'yandex_token': batch['yandex_token'],
-                'client_login': batch.get('client_login') or ''
-            })
+        # Батч уже наш — обрабатываем без повторного захвата
+        data = {
+            'batch_id': batch['id'],
+            'project_id': batch['project_id'],
+            'run_id': batch.get('run_id'),
+            'campaign_ids': json.loads(batch['campaign_ids']) if isinstance(batch['campaign_ids'], str) else batch['campaign_ids'],
+            'yandex_token': batch['yandex_token'],
+            'client_login': batch.get('client_login') or '',
+            'changes_timestamp': batch.get('changes_timestamp'),
+            'tasks_fingerprint': batch.get('tasks_fingerprint')
         }
         
-        class FakeContext:
-            request_id = 'db-fallback'
-        
         conn.close()
-        return handler(event, FakeContext())
+        return process_batch_message(data, FakeContext(), claimed_by=worker_id)
         
     except Exception as e:
         print(f'❌ DB Fallback error: {str(e)}')
@@ -947,8 +1277,108 @@ def release_campaign_lock(campaign_id: str, cursor, conn, project_id: int) -> No
             pass
 
 
+def get_period_platforms(
+    campaign_ids: List[str],
+    yandex_token: str,
+    client_login: str,
+    cursor,
+    conn,
+    project_id: int,
+    task_id: int,
+    goal_ids: Optional[List[str]] = None
+) -> Dict[str, List[Optional[List[Dict[str, Any]]]]]:
+    '''
+    Площадки за 3 периода по каждой кампании: {campaign_id: [сегодня, вчера, 7 дней]}.
+    В режиме daily — один отчёт с полем Date вместо трёх отдельных.
+    None вместо списка — отчёт не получен (async/ошибка).
+    '''
+    campaign_ids = [str(c) for c in campaign_ids]
+    if REPORT_MODE != 'daily':
+        periods = [
+            split_platforms_by_campaign(
+                get_platforms_with_retry(campaign_ids, yandex_token, client_login, days_ago, days_end, cursor, conn, project_id, task_id, goal_ids),
+                campaign_ids
+            )
+            for days_ago, days_end in ((0, 0), (1, 1), (7, 0))
+        ]
+        return {campaign_id: [period[campaign_id] for period in periods] for campaign_id in campaign_ids}
+
+    daily_rows = split_platforms_by_campaign(
+        get_platforms_with_retry(
+            campaign_ids, yandex_token, client_login, 7, 0, cursor, conn, project_id, task_id, goal_ids, with_date=True
+        ),
+        campaign_ids
+    )
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    result = {}
+    for campaign_id, rows in daily_rows.items():
+        if rows is None:
+            result[campaign_id] = [None, None, None]
+            continue
+        result[campaign_id] = [
+            aggregate_daily_platforms(rows, {today}),
+            aggregate_daily_platforms(rows, {yesterday}),
+            aggregate_daily_platforms(rows),
+        ]
+    return result
+
+
+def split_platforms_by_campaign(
+    platforms: Optional[List[Dict[str, Any]]],
+    campaign_ids: List[str]
+) -> Dict[str, Optional[List[Dict[str, Any]]]]:
+    '''Раскладывает строки отчёта по кампаниям (колонка CampaignId). None → None для всех кампаний.'''
+    if platforms is None:
+        return {campaign_id: None for campaign_id in campaign_ids}
+
+    by_campaign = {campaign_id: [] for campaign_id in campaign_ids}
+    for platform in platforms:
+        campaign_id = platform.get('campaign_id') or (campaign_ids[0] if len(campaign_ids) == 1 else None)
+        if campaign_id in by_campaign:
+            by_campaign[campaign_id].append(platform)
+    return by_campaign
+
+
+def aggregate_daily_platforms(rows: List[Dict[str, Any]], dates: Optional[set] = None) -> List[Dict[str, Any]]:
+    '''Сворачивает строки Placement×Date в площадки за период (как отчёт без поля Date).'''
+    aggregated: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        if dates is not None and row.get('date') not in dates:
+            continue
+        domain = row['domain']
+        target = aggregated.get(domain)
+        if target is None:
+            target = aggregated[domain] = {
+                'domain': domain,
+                'clicks': 0,
+                'cost': 0.0,
+                'conversions': 0,
+                'goal_conversions': {},
+                'impressions': 0,
+            }
+        target['clicks'] += row.get('clicks', 0)
+        target['cost'] += row.get('cost', 0)
+        target['conversions'] += row.get('conversions', 0)
+        target['impressions'] += row.get('impressions', 0)
+        for goal_id, value in (row.get('goal_conversions') or {}).items():
+            target['goal_conversions'][goal_id] = target['goal_conversions'].get(goal_id, 0) + (value or 0)
+
+    platforms = []
+    for platform in aggregated.values():
+        clicks = platform['clicks']
+        impressions = platform['impressions']
+        conversions = platform['conversions']
+        platform['cpc'] = platform['cost'] / clicks if clicks else 0
+        platform['ctr'] = (clicks / impressions * 100) if impressions else 0
+        platform['cpa'] = platform['cost'] / conversions if conversions else 0
+        platforms.append(platform)
+    return platforms
+
+
 def get_platforms_with_retry(
-    campaign_id: str, 
+    campaign_ids: List[str], 
     yandex_token: str, 
     client_login: str,
     days_ago: int,
@@ -957,40 +1387,50 @@ def get_platforms_with_retry(
     conn,
     project_id: int,
     task_id: int,
-    goal_ids: Optional[List[str]] = None
+    goal_ids: Optional[List[str]] = None,
+    with_date: bool = False
 ) -> Optional[List[Dict[str, Any]]]:
     '''
     Получает площадки с clicks >= 1 за период с retry при 429
+    with_date=True — строки в разрезе дней (ключ 'date'), см. aggregate_daily_platforms
     Returns: list площадок или None (если async report)
     '''
     report_name = None
+    campaign_label = ','.join(campaign_ids) if len(campaign_ids) <= 3 else f'{campaign_ids[0]} +{len(campaign_ids) - 1}'
     for attempt, delay in enumerate(RETRY_DELAYS):
         try:
             date_from = (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%d')
             date_to = (datetime.now() - timedelta(days=days_end)).strftime('%Y-%m-%d')
             
             # Запрашиваем отчёт у Яндекса
-            response = create_report(campaign_id, yandex_token, client_login, date_from, date_to, goal_ids, report_name)
+            response = create_report(
+                campaign_ids, yandex_token, client_login, date_from, date_to, goal_ids, report_name, with_date,
+                use_registry=True
+            )
             
             if response['status'] == 200:
                 # Отчёт готов → парсим TSV
-                platforms = parse_tsv_report(response['data'])
+                platforms = list(parse_tsv_report(response['lines']))
                 return platforms
             
             elif response['status'] in [201, 202]:
                 # Отчёт готовится. Повторный запрос с тем же ReportName забирает готовый отчёт.
-                report_name = response.get('report_name') or report_name or f"platforms_{campaign_id}_{date_from}_{date_to}"
-                print(f"⏳ Report {report_name} is pending (campaign {campaign_id}), waiting {delay}s", flush=True)
+                report_name = response.get('report_name') or report_name
+                print(f"⏳ Report {report_name} is pending (campaigns {campaign_label}), waiting {delay}s", flush=True)
                 time.sleep(delay)
                 continue
             
             elif response['status'] == 429:
-                # 429 или 400 с кодом 56 (create_report возвращает 429) → retry с backoff
+                # 429 или 400 с кодом 56 / 152 (create_report возвращает 429).
+                # Пауза выставлена в limiter токена — следующий create_report дождётся её сам.
+                budget = get_direct_limiter(yandex_token, client_login).budget()
+                if budget['low_on_units']:
+                    print(f"⚠️ Direct units almost exhausted ({budget['units_available']}/{budget['units_daily']}), skipping campaigns {campaign_label}")
+                    return None
                 if delay > MAX_WAIT_FOR_429:
-                    print(f"⚠️ Rate/limit exceeded, skipping campaign {campaign_id}")
+                    print(f"⚠️ Rate/limit exceeded, skipping campaigns {campaign_label}")
                     return None
-                print(f"⏱️ Limit exceeded, waiting {delay}s... (attempt {attempt + 1}/{len(RETRY_DELAYS)})")
-                time.sleep(delay)
+                print(f"⏱️ Limit exceeded, cooling down {budget['cooldown_sec']:.0f}s... (attempt {attempt + 1}/{len(RETRY_DELAYS)})")
                 continue
 
             elif response['status'] in [408, 500, 502, 503, 504]:
@@ -1021,21 +1461,127 @@ def get_platforms_with_retry(
     if report_name:
         try:
             report_id = report_name
-            cursor.execute("""
-                INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_pending_reports
-                (project_id, task_id, report_id, campaign_ids, date_from, date_to, report_name, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending')
-                ON CONFLICT (report_id) DO NOTHING
-            """, (project_id, task_id, report_id, json.dumps([campaign_id]), date_from, date_to, report_name))
-            conn.commit()
-            print(f"⏳ Report {report_name} still pending after retries (campaign {campaign_id})", flush=True)
+            with _db_lock:
+                cursor.execute("""
+                    INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_pending_reports
+                    (project_id, task_id, report_id, campaign_ids, date_from, date_to, report_name, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending')
+                    ON CONFLICT (report_id) DO NOTHING
+                """, (project_id, task_id, report_id, json.dumps(campaign_ids), date_from, date_to, report_name))
+                conn.commit()
+            print(f"⏳ Report {report_name} still pending after retries (campaigns {campaign_label})", flush=True)
         except Exception as e:
             print(f"❌ Failed to save pending report {report_name}: {e}", flush=True)
     return None
 
 
-def create_report(campaign_id: str, yandex_token: str, client_login: str, date_from: str, date_to: str, goal_ids: Optional[List[str]] = None, report_name: Optional[str] = None) -> Dict[str, Any]:
-    '''Создаёт отчёт через Yandex Direct API'''
+def report_request_hash(headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''Канонический ключ отчёта: параметры без ReportName, заголовки формата и аккаунт (Client-Login, иначе токен).'''
+    account = headers.get('Client-Login') or hashlib.sha256(headers.get('Authorization', '').encode('utf-8')).hexdigest()
+    canonical = {
+        'account': account,
+        'headers': {key: value for key, value in headers.items() if key not in ('Authorization', 'Client-Login', 'Accept-Language')},
+        'params': {key: value for key, value in params.items() if key != 'ReportName'},
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def registry_report_name(cursor, prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''
+    ReportName из общего реестра rsya_report_registry: одинаковый запрос (тот же хэш) в пределах TTL
+    получает то же имя — Директ отдаёт уже заказанный или готовый отчёт, а не ставит новый в очередь.
+    Изменения в реестре коммитит вызывающий код; при ошибке реестра — новое имя с меткой времени.
+    '''
+    report_hash = report_request_hash(headers, params)
+    report_name = f'{prefix}_{report_hash[:16]}_{int(time.time())}'
+    date_to = (params.get('SelectionCriteria') or {}).get('DateTo') or ''
+    # Отчёт только за прошедшие дни не меняется — его можно переиспользовать дольше
+    ttl = REPORT_REUSE_HISTORY_TTL_SEC if date_to and date_to < datetime.now().strftime('%Y-%m-%d') else REPORT_REUSE_TTL_SEC
+    try:
+        cursor.execute("SAVEPOINT report_registry")
+        cursor.execute("""
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_report_registry AS r
+                (report_hash, report_name, request_headers, request_params, created_at, last_used_at)
+            VALUES (%s, %s, %s, %s, NOW(), NOW())
+            ON CONFLICT (report_hash) DO UPDATE SET
+                report_name = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                   THEN EXCLUDED.report_name ELSE r.report_name END,
+                request_params = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                      THEN EXCLUDED.request_params ELSE r.request_params END,
+                created_at = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                  THEN NOW() ELSE r.created_at END,
+                last_used_at = NOW()
+            RETURNING report_name
+        """, (
+            report_hash,
+            report_name,
+            json.dumps({key: value for key, value in headers.items() if key != 'Authorization'}),
+            json.dumps({**params, 'ReportName': report_name}, ensure_ascii=False),
+            ttl,
+            ttl,
+            ttl,
+        ))
+        row = cursor.fetchone()
+        cursor.execute("RELEASE SAVEPOINT report_registry")
+        return (row['report_name'] if isinstance(row, dict) else row[0]) or report_name
+    except Exception as e:
+        print(f"⚠️ Report registry unavailable, using a fresh report name: {e}", flush=True)
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT report_registry")
+        except Exception:
+            pass
+        return report_name
+
+
+# Подключение к реестру отчётов живёт между вызовами тёплого контейнера (не по подключению на каждый отчёт);
+# параллельные загрузки отчётов обращаются к нему только под _registry_lock
+_registry_conn = None
+_registry_lock = threading.Lock()
+
+
+def get_registry_conn():
+    '''Отдельное от транзакции батча подключение к реестру отчётов; закрытое или оборванное открывается заново.'''
+    global _registry_conn
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return None
+    if _registry_conn is None or _registry_conn.closed:
+        _registry_conn = psycopg2.connect(dsn)
+    return _registry_conn
+
+
+def resolve_report_name(conn, prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''
+    ReportName через общий реестр отчётов в подключении реестра (get_registry_conn):
+    коммит реестра не затрагивает транзакцию батча. Без БД — новое имя с меткой времени.
+    '''
+    if conn is None:
+        return f'{prefix}_{report_request_hash(headers, params)[:16]}_{int(time.time())}'
+    
+    cursor = conn.cursor()
+    try:
+        report_name = registry_report_name(cursor, prefix, headers, params)
+        conn.commit()
+        return report_name
+    finally:
+        cursor.close()
+
+
+def create_report(
+    campaign_ids: List[str],
+    yandex_token: str,
+    client_login: str,
+    date_from: str,
+    date_to: str,
+    goal_ids: Optional[List[str]] = None,
+    report_name: Optional[str] = None,
+    with_date: bool = False,
+    use_registry: bool = False
+) -> Dict[str, Any]:
+    '''
+    Создаёт отчёт через Yandex Direct API
+    use_registry — имя нового отчёта берётся из rsya_report_registry (подключение к уже заказанному отчёту)
+    '''
     url = 'https://api.direct.yandex.com/json/v5/reports'
     headers = {
         'Authorization': f'Bearer {yandex_token}',
@@ -1052,6 +1598,15 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
     goal_suffix = ''
     if normalized_goal_ids:
         goal_suffix = '_g' + hashlib.sha1(','.join(normalized_goal_ids).encode('utf-8')).hexdigest()[:8]
+    field_names = ['Placement', 'Clicks', 'Cost', 'Conversions', 'Impressions']
+    if len(campaign_ids) > 1:
+        field_names = ['CampaignId'] + field_names
+        campaigns_key = 'batch_' + hashlib.sha1(','.join(campaign_ids).encode('utf-8')).hexdigest()[:10]
+    else:
+        campaigns_key = str(campaign_ids[0])
+    if with_date:
+        field_names = ['Date'] + field_names
+        goal_suffix += '_daily'
 
     payload = {
         'params': {
@@ -1059,8 +1614,8 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
                 'Filter': [
                     {
                         'Field': 'CampaignId',
-                        'Operator': 'EQUALS',
-                        'Values': [str(campaign_id)]
+                        'Operator': 'IN' if len(campaign_ids) > 1 else 'EQUALS',
+                        'Values': [str(campaign_id) for campaign_id in campaign_ids]
                     },
                     {
                         'Field': 'Impressions',
@@ -1071,8 +1626,8 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
                 'DateFrom': date_from,
                 'DateTo': date_to
             },
-            'FieldNames': ['Placement', 'Clicks', 'Cost', 'Conversions', 'Impressions'],
-            'ReportName': report_name or f'platforms_{campaign_id}_{date_from}_{date_to}{goal_suffix}_{int(time.time())}',
+            'FieldNames': field_names,
+            'ReportName': report_name or f'platforms_{campaigns_key}_{date_from}_{date_to}{goal_suffix}_{int(time.time())}',
             'ReportType': 'CUSTOM_REPORT',
             'DateRangeType': 'CUSTOM_DATE',
             'Format': 'TSV',
@@ -1084,26 +1639,32 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
     if normalized_goal_ids:
         payload['params']['Goals'] = normalized_goal_ids
         payload['params']['AttributionModels'] = ['AUTO']
+
+    if not report_name and use_registry:
+        try:
+            with _registry_lock:
+                payload['params']['ReportName'] = resolve_report_name(get_registry_conn(), 'platforms', headers, payload['params'])
+        except Exception as e:
+            print(f"⚠️ Report registry unavailable: {e}", flush=True)
     
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
-        time.sleep(API_DELAY)  # Задержка для соблюдения лимитов API
+        limiter = wait_direct_rate_limit(headers)
+        resp = http_session.post(url, headers=headers, json=payload, timeout=60, stream=True)
+        limiter.observe(resp)
         
         if resp.status_code == 200:
-            return {'status': 200, 'data': resp.text}
-        elif resp.status_code in [201, 202]:
+            return {'status': 200, 'lines': iter_report_lines(resp)}
+        # Тела 201/202 и ошибок короткие — дочитываем, соединение возвращается в пул
+        resp.content
+        if resp.status_code in [201, 202]:
             return {'status': resp.status_code, 'report_name': payload['params']['ReportName']}
         elif resp.status_code == 429:
             return {'status': 429, 'error': 'Rate limit exceeded'}
         elif resp.status_code == 400:
-            # 400 с кодом 56 = "Превышен лимит" (лимит отчётов) — обрабатываем как 429, retry с backoff
-            try:
-                err = resp.json()
-                code = err.get('error', {}).get('error_code') or err.get('error', {}).get('error_code')
-                if str(code) == '56':
-                    return {'status': 429, 'error': err.get('error', {}).get('error_string') or 'Limit exceeded (56)'}
-            except Exception:
-                pass
+            # 400 с кодом 56 / 152 = превышен лимит / нет баллов — обрабатываем как 429 (пауза уже выставлена в limiter)
+            code = direct_error_code(resp)
+            if code in DIRECT_LIMIT_ERROR_CODES:
+                return {'status': 429, 'error': f'Limit exceeded ({code})'}
             return {'status': 400, 'error': resp.text}
         else:
             return {'status': resp.status_code, 'error': resp.text}
@@ -1114,58 +1675,6 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
         return {'status': 500, 'error': str(e)}
 
 
-def parse_tsv_report(tsv_data: str) -> List[Dict[str, Any]]:
-    '''Парсит TSV отчёт в список площадок'''
-    lines = tsv_data.strip().split('\n')
-    if len(lines) < 2:
-        return []
-    
-    header = lines[0].split('\t')
-    platforms = []
-    for line in lines[1:]:
-        parts = line.split('\t')
-        if len(parts) < len(header):
-            continue
-
-        row = dict(zip(header, parts))
-        domain = (row.get('Placement') or parts[0]).strip()
-        if ' ' in domain or not domain:
-            continue
-
-        goal_conversions = {}
-        for key, value in row.items():
-            if not key.startswith('Conversions_'):
-                continue
-            parts_key = key.split('_')
-            if len(parts_key) >= 3:
-                goal_id = parts_key[1]
-                goal_conversions[goal_id] = goal_conversions.get(goal_id, 0) + int(float(value or 0))
-
-        conversions = int(float(row.get('Conversions') or 0))
-        if goal_conversions:
-            conversions = sum(goal_conversions.values())
-
-        clicks = int(float(row.get('Clicks') or 0))
-        cost = float(row.get('Cost') or 0)
-        impressions = int(float(row.get('Impressions') or 0))
-        cpc = cost / clicks if clicks else 0
-        ctr = (clicks / impressions * 100) if impressions else 0
-        cpa = cost / conversions if conversions else 0
-        platforms.append({
-            'domain': domain,
-            'clicks': clicks,
-            'cost': cost,
-            'conversions': conversions,
-            'goal_conversions': goal_conversions,
-            'impressions': impressions,
-            'cpc': cpc,
-            'cpa': cpa,
-            'ctr': ctr
-        })
-    
-    return platforms
-
-
 def get_blocked_sites(campaign_id: str, yandex_token: str, client_login: str = '') -> List[Dict[str, Any]]:
     '''Получает уже заблокированные площадки именно из Campaign.ExcludedSites.'''
     excluded_sites = get_excluded_sites(yandex_token, campaign_id, client_login)
@@ -1179,10 +1688,11 @@ def _canonical_excluded_site(site: str) -> str:
     return site[4:] if site.startswith('www.') else site
 
 
-def block_sites(campaign_id: str, yandex_token: str, client_login: str, domains: List[str]) -> Optional[List[str]]:
-    '''Блокирует площадки через Yandex Direct API'''
-    
-    # Получаем текущий список ExcludedSites
+def _plan_block_sites(campaign_id: str, yandex_token: str, client_login: str, domains: List[str]) -> Optional[Dict[str, Any]]:
+    '''
+    Считает новый ExcludedSites для блокировки domains по снимку кампании.
+    Returns: план {'domains_to_add', 'current_canonical', 'new_excluded_list'} или None (кампанию нельзя/не удалось прочитать)
+    '''
     current_excluded = get_excluded_sites(yandex_token, campaign_id, client_login)
     
     if current_excluded == 'UNMODIFIABLE':
@@ -1198,7 +1708,6 @@ def block_sites(campaign_id: str, yandex_token: str, client_login: str, domains:
     domains_normalized = [d.lower() for d in domains]
     
     # Фильтруем домены которых еще нет в списке
-    current_excluded_set = set(current_excluded_normalized)
     current_excluded_canonical = set(_canonical_excluded_site(d) for d in current_excluded_normalized)
     domains_to_add = []
     domains_to_add_canonical = set()
@@ -1211,7 +1720,7 @@ def block_sites(campaign_id: str, yandex_token: str, client_login: str, domains:
     
     if not domains_to_add:
         print(f'✅ All {len(domains)} domains already blocked in campaign {campaign_id}')
-        return []
+        return {'domains_to_add': [], 'current_canonical': current_excluded_canonical, 'new_excluded_list': None}
     
     # Добавляем новые домены (используем set для уникальности)
     new_excluded_list = []
@@ -1224,38 +1733,77 @@ def block_sites(campaign_id: str, yandex_token: str, client_login: str, domains:
         seen_canonical.add(canonical)
     
     print(f'📝 Campaign {campaign_id}: Adding {len(domains_to_add)} domains (current: {len(current_excluded)}, new total: {len(new_excluded_list)})')
-    
-    # Обновляем в Яндексе
-    applied_sites = update_excluded_sites(yandex_token, campaign_id, new_excluded_list, client_login)
-
-    if applied_sites is not None:
-        applied_canonical = set(_canonical_excluded_site(site) for site in applied_sites)
-        actually_added = [
-            domain for domain in domains_to_add
-            if _canonical_excluded_site(domain) in applied_canonical
-            and _canonical_excluded_site(domain) not in current_excluded_canonical
-        ]
-        print(f'✅ Blocked {len(actually_added)} domains in campaign {campaign_id}')
-        return actually_added
-    else:
+    return {
+        'domains_to_add': domains_to_add,
+        'current_canonical': current_excluded_canonical,
+        'new_excluded_list': new_excluded_list
+    }
+
+
+def _applied_block_domains(campaign_id: str, plan: Dict[str, Any], applied_sites: Optional[List[str]]) -> Optional[List[str]]:
+    if applied_sites is None:
         print(f'❌ Failed to block domains in campaign {campaign_id}')
+        return None
 
-    return None
+    applied_canonical = set(_canonical_excluded_site(site) for site in applied_sites)
+    actually_added = [
+        domain for domain in plan['domains_to_add']
+        if _canonical_excluded_site(domain) in applied_canonical
+        and _canonical_excluded_site(domain) not in plan['current_canonical']
+    ]
+    print(f'✅ Blocked {len(actually_added)} domains in campaign {campaign_id}')
+    return actually_added
+
+
+def block_sites(campaign_id: str, yandex_token: str, client_login: str, domains: List[str]) -> Optional[List[str]]:
+    '''Блокирует площадки через Yandex Direct API'''
+    return block_sites_bulk(yandex_token, client_login, {str(campaign_id): domains}).get(str(campaign_id))
+
+
+def block_sites_bulk(yandex_token: str, client_login: str, domains_by_campaign: Dict[str, List[str]]) -> Dict[str, Optional[List[str]]]:
+    '''
+    Блокирует площадки сразу в нескольких кампаниях: планы по снимкам, затем минимум вызовов campaigns.update.
+    Returns: {campaign_id: реально добавленные домены или None при ошибке}
+    '''
+    results: Dict[str, Optional[List[str]]] = {}
+    plans = {}
+    for campaign_id, domains in domains_by_campaign.items():
+        plan = _plan_block_sites(campaign_id, yandex_token, client_login, domains)
+        if plan is None:
+            results[campaign_id] = None
+        elif not plan['domains_to_add']:
+            results[campaign_id] = []
+        else:
+            plans[campaign_id] = plan
+
+    if plans:
+        applied = update_excluded_sites_bulk(
+            yandex_token,
+            {campaign_id: plan['new_excluded_list'] for campaign_id, plan in plans.items()},
+            client_login
+        )
+        for campaign_id, plan in plans.items():
+            results[campaign_id] = _applied_block_domains(campaign_id, plan, applied.get(campaign_id))
+
+    return results
 
 
 def unblock_sites(campaign_id: str, yandex_token: str, client_login: str, domains: List[str]) -> bool:
     '''Разблокирует площадки (ротация)'''
     
-    # Получаем текущий список ExcludedSites
+    # Текущий список ExcludedSites (из снимка, если кампанию уже читали в этом вызове)
     current_excluded = get_excluded_sites(yandex_token, campaign_id, client_login)
     
-    if current_excluded is None:
+    if current_excluded is None or current_excluded == 'UNMODIFIABLE':
         print(f'❌ Failed to fetch ExcludedSites for campaign {campaign_id}')
         return False
     
     # Убираем указанные домены
     current_excluded_set = set(current_excluded)
     domains_to_remove = set(domains)
+    if not current_excluded_set & domains_to_remove:
+        print(f'✅ Nothing to unblock in campaign {campaign_id}: snapshot has none of {len(domains_to_remove)} domains')
+        return True
     new_excluded_list = list(current_excluded_set - domains_to_remove)
     
     print(f'📝 Campaign {campaign_id}: Removing {len(domains_to_remove)} domains (current: {len(current_excluded)}, new total: {len(new_excluded_list)})')
@@ -1271,19 +1819,100 @@ def unblock_sites(campaign_id: str, yandex_token: str, client_login: str, domain
     return success is not None
 
 
-def get_excluded_sites(token: str, campaign_id: str, client_login: str = '') -> Optional[List[str]]:
-    '''Получение списка ExcludedSites из Яндекс.Директ'''
+def _excluded_sites_from_campaign(campaign_data: Dict[str, Any]):
+    '''ExcludedSites кампании из ответа campaigns.get: дедуплицированный список или 'UNMODIFIABLE'.'''
+    campaign_id = campaign_data.get('Id')
+    campaign_status = str(campaign_data.get('Status', 'UNKNOWN') or 'UNKNOWN').upper()
+    if campaign_status in {'DRAFT', 'ARCHIVED'}:
+        print(f'⚠️ Campaign {campaign_id} has status {campaign_status}, cannot be modified')
+        return 'UNMODIFIABLE'
     
-    try:
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Accept-Language': 'ru'
-        }
-        if client_login:
-            headers['Client-Login'] = client_login
+    excluded_sites_obj = campaign_data.get('ExcludedSites', {})
+    excluded = excluded_sites_obj.get('Items', []) if excluded_sites_obj else []
+    
+    print(f'📊 Campaign {campaign_id}: ExcludedSites contains {len(excluded)} domains')
+    if excluded:
+        print(f'   First 5: {excluded[:5]}')
+        print(f'   Last 5: {excluded[-5:]}')
+    
+    # Дедуплицируем список (избегаем ошибки 9802)
+    deduplicated = list(dict.fromkeys(excluded)) if excluded else []
+    
+    if len(excluded) != len(deduplicated):
+        print(f'⚠️ Removed {len(excluded) - len(deduplicated)} duplicates from ExcludedSites')
+    
+    return deduplicated
+
+
+def _direct_headers(token: str, client_login: str = '') -> Dict[str, str]:
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Accept-Language': 'ru'
+    }
+    if client_login:
+        headers['Client-Login'] = client_login
+    return headers
+
+
+def prefetch_excluded_sites(token: str, campaign_ids: List[str], client_login: str = '') -> int:
+    '''
+    Читает ExcludedSites всех кампаний батча одним campaigns.get (до 1000 Ids за вызов) в снимок вызова.
+    Кампании, которых нет в ответе, не кэшируются — их прочитает get_excluded_sites по одной.
+    Returns: сколько кампаний попало в снимок
+    '''
+    missing = [str(c) for c in dict.fromkeys(campaign_ids) if str(c) not in _excluded_sites_cache]
+    loaded = 0
+    for i in range(0, len(missing), CAMPAIGNS_GET_CHUNK):
+        chunk = missing[i:i + CAMPAIGNS_GET_CHUNK]
+        try:
+            response = post_direct_campaigns_with_retry(
+                _direct_headers(token, client_login),
+                {
+                    'method': 'get',
+                    'params': {
+                        'SelectionCriteria': {
+                            'Ids': [int(campaign_id) for campaign_id in chunk]
+                        },
+                        'FieldNames': ['Id', 'ExcludedSites', 'Status']
+                    }
+                },
+                'get ExcludedSites (bulk)'
+            )
+            if response is None or response.status_code != 200:
+                print(f'⚠️ Bulk ExcludedSites fetch failed for {len(chunk)} campaigns, falling back to per-campaign reads')
+                continue
 
+            data = response.json()
+            if data.get('error'):
+                print(f'⚠️ Bulk ExcludedSites API error: {json.dumps(data["error"], ensure_ascii=False)}')
+                continue
+
+            requested = set(chunk)
+            for campaign_data in data.get('result', {}).get('Campaigns', []):
+                campaign_id = str(campaign_data.get('Id'))
+                if campaign_id not in requested:
+                    print(f'🚨 Bulk ExcludedSites: API returned unexpected campaign {campaign_id}, ignoring')
+                    continue
+                excluded = _excluded_sites_from_campaign(campaign_data)
+                _excluded_sites_cache[campaign_id] = list(excluded) if isinstance(excluded, list) else excluded
+                loaded += 1
+        except Exception as e:
+            print(f'⚠️ Error in bulk ExcludedSites fetch: {str(e)}')
+
+    if missing:
+        print(f'📥 Prefetched ExcludedSites for {loaded}/{len(missing)} campaigns', flush=True)
+    return loaded
+
+
+def get_excluded_sites(token: str, campaign_id: str, client_login: str = '', use_cache: bool = True) -> Optional[List[str]]:
+    '''Получение списка ExcludedSites из Яндекс.Директ (снимок кэшируется на время вызова)'''
+    
+    if use_cache and str(campaign_id) in _excluded_sites_cache:
+        return _cached_excluded_sites(campaign_id)
+
+    try:
         response = post_direct_campaigns_with_retry(
-            headers,
+            _direct_headers(token, client_login),
             {
                 'method': 'get',
                 'params': {
@@ -1307,6 +1936,7 @@ def get_excluded_sites(token: str, campaign_id: str, client_login: str = '') ->
         
         if not campaigns:
             print(f'📭 Campaign {campaign_id}: API returned empty campaigns list')
+            _excluded_sites_cache[str(campaign_id)] = []
             return []
         
         # КРИТИЧЕСКАЯ ПРОВЕРКА: API вернул именно запрошенную кампанию
@@ -1319,196 +1949,238 @@ def get_excluded_sites(token: str, campaign_id: str, client_login: str = '') ->
             print(f'🛡️ SAFETY: Aborting to prevent overwriting wrong campaign data!')
             return None
 
-        campaign_status = str(campaign_data.get('Status', 'UNKNOWN') or 'UNKNOWN').upper()
-        if campaign_status in {'DRAFT', 'ARCHIVED'}:
-            print(f'⚠️ Campaign {campaign_id} has status {campaign_status}, cannot be modified')
-            return 'UNMODIFIABLE'
+        excluded = _excluded_sites_from_campaign(campaign_data)
+        _excluded_sites_cache[str(campaign_id)] = list(excluded) if isinstance(excluded, list) else excluded
+        return excluded
         
-        excluded_sites_obj = campaign_data.get('ExcludedSites', {})
-        excluded = excluded_sites_obj.get('Items', []) if excluded_sites_obj else []
+    except Exception as e:
+        print(f'❌ Error fetching ExcludedSites: {str(e)}')
+        return None
+
+
+def _validate_excluded_sites(excluded_sites: List[str]) -> List[str]:
+    '''Отбрасывает домены, которые Direct заведомо не примет в ExcludedSites.'''
+    valid_sites = []
+    invalid_sites = []
+    seen_canonical = set()
+    
+    for site in excluded_sites:
+        # Пропускаем пустые строки
+        if not site or not site.strip():
+            invalid_sites.append((site, 'empty'))
+            continue
         
-        print(f'📊 Campaign {campaign_id}: ExcludedSites contains {len(excluded)} domains')
-        if excluded:
-            print(f'   First 5: {excluded[:5]}')
-            print(f'   Last 5: {excluded[-5:]}')
+        site_clean = site.strip()
         
-        # Дедуплицируем список (избегаем ошибки 9802)
-        deduplicated = list(dict.fromkeys(excluded)) if excluded else []
+        # Проверяем длину (макс 255 символов)
+        if len(site_clean) > 255:
+            invalid_sites.append((site_clean, 'too_long'))
+            continue
         
-        if len(excluded) != len(deduplicated):
-            print(f'⚠️ Removed {len(excluded) - len(deduplicated)} duplicates from ExcludedSites')
+        # Проверяем на пробелы, табы, переносы строк
+        if any(char in site_clean for char in [' ', '\t', '\n', '\r']):
+            invalid_sites.append((site_clean, 'whitespace'))
+            continue
         
-        return deduplicated
+        # Проверяем что не начинается с точки или дефиса
+        if site_clean.startswith('.') or site_clean.startswith('-'):
+            invalid_sites.append((site_clean, 'invalid_start'))
+            continue
         
-    except Exception as e:
-        print(f'❌ Error fetching ExcludedSites: {str(e)}')
-        return None
+        # Проверяем что не заканчивается точкой или дефисом
+        if site_clean.endswith('.') or site_clean.endswith('-'):
+            invalid_sites.append((site_clean, 'invalid_end'))
+            continue
+        
+        # Проверяем на кириллицу (русские буквы)
+        if any(ord(char) >= 0x0400 and ord(char) <= 0x04FF for char in site_clean):
+            invalid_sites.append((site_clean, 'contains_cyrillic'))
+            continue
+        
+        # ExcludedSites принимает не только домены, но и ID мобильных приложений.
+        # Для доменов "_" запрещен, но Android package name с "_" должен проходить.
+        if not all(char.isalnum() or char in ['.', '-', '_'] for char in site_clean):
+            invalid_sites.append((site_clean, 'invalid_chars'))
+            continue
+
+        if '_' in site_clean:
+            parts = site_clean.split('.')
+            looks_like_mobile_app = (
+                len(parts) >= 2
+                and all(part and not part.startswith('-') and not part.endswith('-') for part in parts)
+                and any('_' in part for part in parts)
+            )
+            if not looks_like_mobile_app:
+                invalid_sites.append((site_clean, 'invalid_underscore'))
+                continue
+        
+        # Проверяем что нет двойных точек подряд
+        if '..' in site_clean:
+            invalid_sites.append((site_clean, 'double_dot'))
+            continue
+        
+        canonical = _canonical_excluded_site(site_clean)
+        if canonical in seen_canonical:
+            invalid_sites.append((site_clean, 'duplicate'))
+            continue
+
+        valid_sites.append(site_clean)
+        seen_canonical.add(canonical)
+    
+    # Логируем невалидные домены
+    if invalid_sites:
+        print(f'⚠️ FILTERED {len(invalid_sites)} invalid domains:')
+        for site, reason in invalid_sites[:10]:  # Показываем первые 10
+            print(f'  ❌ {site[:50]} → {reason}')
+        if len(invalid_sites) > 10:
+            print(f'  ... и еще {len(invalid_sites) - 10} доменов')
+
+    return valid_sites
 
 
 def update_excluded_sites(token: str, campaign_id: str, excluded_sites: List[str], client_login: str = '') -> Optional[List[str]]:
     '''Обновление списка ExcludedSites в Яндекс.Директ'''
-    
+    return update_excluded_sites_bulk(token, {str(campaign_id): excluded_sites}, client_login).get(str(campaign_id))
+
+
+def update_excluded_sites_bulk(token: str, excluded_by_campaign: Dict[str, List[str]], client_login: str = '') -> Dict[str, Optional[List[str]]]:
+    '''
+    Обновление ExcludedSites нескольких кампаний: до CAMPAIGNS_UPDATE_CHUNK кампаний в одном campaigns.update.
+    UpdateResults сопоставляются с кампаниями по позиции; элементы ExcludedSites[i], отклонённые Директом,
+    выкидываются из списка своей кампании, и повторно отправляются только такие кампании.
+    Returns: {campaign_id: применённый список или None при ошибке}
+    '''
+    results: Dict[str, Optional[List[str]]] = {}
+    pending: Dict[str, List[str]] = {}
+
     try:
-        # Валидация доменов перед отправкой
-        valid_sites = []
-        invalid_sites = []
-        seen_canonical = set()
-        
-        for site in excluded_sites:
-            # Пропускаем пустые строки
-            if not site or not site.strip():
-                invalid_sites.append((site, 'empty'))
-                continue
-            
-            site_clean = site.strip()
-            
-            # Проверяем длину (макс 255 символов)
-            if len(site_clean) > 255:
-                invalid_sites.append((site_clean, 'too_long'))
-                continue
-            
-            # Проверяем на пробелы, табы, переносы строк
-            if any(char in site_clean for char in [' ', '\t', '\n', '\r']):
-                invalid_sites.append((site_clean, 'whitespace'))
-                continue
-            
-            # Проверяем что не начинается с точки или дефиса
-            if site_clean.startswith('.') or site_clean.startswith('-'):
-                invalid_sites.append((site_clean, 'invalid_start'))
-                continue
-            
-            # Проверяем что не заканчивается точкой или дефисом
-            if site_clean.endswith('.') or site_clean.endswith('-'):
-                invalid_sites.append((site_clean, 'invalid_end'))
-                continue
-            
-            # Проверяем на кириллицу (русские буквы)
-            if any(ord(char) >= 0x0400 and ord(char) <= 0x04FF for char in site_clean):
-                invalid_sites.append((site_clean, 'contains_cyrillic'))
-                continue
+        for campaign_id, excluded_sites in excluded_by_campaign.items():
+            campaign_id = str(campaign_id)
+            valid_sites = _validate_excluded_sites(excluded_sites)
             
-            # ExcludedSites принимает не только домены, но и ID мобильных приложений.
-            # Для доменов "_" запрещен, но Android package name с "_" должен проходить.
-            if not all(char.isalnum() or char in ['.', '-', '_'] for char in site_clean):
-                invalid_sites.append((site_clean, 'invalid_chars'))
+            if not valid_sites:
+                print(f'❌ No valid domains to update in campaign {campaign_id}')
+                results[campaign_id] = None
                 continue
 
-            if '_' in site_clean:
-                parts = site_clean.split('.')
-                looks_like_mobile_app = (
-                    len(parts) >= 2
-                    and all(part and not part.startswith('-') and not part.endswith('-') for part in parts)
-                    and any('_' in part for part in parts)
-                )
-                if not looks_like_mobile_app:
-                    invalid_sites.append((site_clean, 'invalid_underscore'))
-                    continue
-            
-            # Проверяем что нет двойных точек подряд
-            if '..' in site_clean:
-                invalid_sites.append((site_clean, 'double_dot'))
-                continue
-            
-            canonical = _canonical_excluded_site(site_clean)
-            if canonical in seen_canonical:
-                invalid_sites.append((site_clean, 'duplicate'))
+            # Оптимистичная проверка по снимку: если список не изменился — update не нужен
+            snapshot = _excluded_sites_cache.get(campaign_id)
+            if isinstance(snapshot, list) and snapshot == valid_sites:
+                print(f'✅ Campaign {campaign_id}: ExcludedSites unchanged vs snapshot, skipping update')
+                results[campaign_id] = valid_sites
                 continue
+            # Снимок больше не достоверен, пока не подтвердится успешный update
+            _excluded_sites_cache.pop(campaign_id, None)
 
-            valid_sites.append(site_clean)
-            seen_canonical.add(canonical)
-        
-        # Логируем невалидные домены
-        if invalid_sites:
-            print(f'⚠️ FILTERED {len(invalid_sites)} invalid domains:')
-            for site, reason in invalid_sites[:10]:  # Показываем первые 10
-                print(f'  ❌ {site[:50]} → {reason}')
-            if len(invalid_sites) > 10:
-                print(f'  ... и еще {len(invalid_sites) - 10} доменов')
-        
-        if not valid_sites:
-            print(f'❌ No valid domains to update')
-            return None
-        
-        print(f'🔄 Updating campaign {campaign_id}: {len(valid_sites)} valid domains (filtered {len(invalid_sites)})')
-        
-        print(f'📋 ExcludedSites preview: {valid_sites[:10]}')
-        if len(valid_sites) > 10:
-            print(f'  ... and {len(valid_sites) - 10} more')
-        
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Accept-Language': 'ru'
-        }
-        if client_login:
-            headers['Client-Login'] = client_login
+            print(f'🔄 Updating campaign {campaign_id}: {len(valid_sites)} valid domains (filtered {len(excluded_sites) - len(valid_sites)})')
+            print(f'📋 ExcludedSites preview: {valid_sites[:10]}')
+            if len(valid_sites) > 10:
+                print(f'  ... and {len(valid_sites) - 10} more')
+            pending[campaign_id] = valid_sites
+
+        headers = _direct_headers(token, client_login)
 
         for update_attempt in range(1, 21):
-            response = post_direct_campaigns_with_retry(
-                headers,
-                {
-                    'method': 'update',
-                    'params': {
-                        'Campaigns': [{
-                            'Id': int(campaign_id),
-                            'ExcludedSites': {
-                                'Items': valid_sites
-                            }
-                        }]
-                    }
-                },
-                'update ExcludedSites'
-            )
-            if response is None:
-                return None
-            
-            print(f'📡 HTTP Status: {response.status_code}')
-            
-            if response.status_code != 200:
-                print(f'❌ FULL API ERROR: {response.text}')
-                return None
-            
-            data = response.json()
-            print(f'📥 FULL API RESPONSE: {json.dumps(data, ensure_ascii=False)}')
-            
-            update_results = data.get('result', {}).get('UpdateResults', [])
-            first_result = update_results[0] if update_results else {}
-            result_errors = first_result.get('Errors') or []
-
-            if first_result.get('Id') and not result_errors:
-                print(f'✅ Campaign {campaign_id} updated successfully')
-                return valid_sites
-
-            bad_indices = []
-            for error in result_errors:
-                details = str(error.get('Details') or error.get('Message') or '')
-                match = re.search(r'ExcludedSites\[(\d+)\]', details)
-                if match:
-                    bad_indices.append(int(match.group(1)))
-
-            if bad_indices:
-                removed = []
-                for index in sorted(set(bad_indices), reverse=True):
-                    if 0 <= index < len(valid_sites):
-                        removed.append(valid_sites.pop(index))
-                print(
-                    f'⚠️ Direct rejected {len(removed)} ExcludedSites items on attempt {update_attempt}: {removed}. Retrying without them.',
-                    flush=True
+            if not pending:
+                break
+
+            retry: Dict[str, List[str]] = {}
+            campaign_ids = list(pending.keys())
+            for i in range(0, len(campaign_ids), CAMPAIGNS_UPDATE_CHUNK):
+                chunk = campaign_ids[i:i + CAMPAIGNS_UPDATE_CHUNK]
+                response = post_direct_campaigns_with_retry(
+                    headers,
+                    {
+                        'method': 'update',
+                        'params': {
+                            'Campaigns': [
+                                {
+                                    'Id': int(campaign_id),
+                                    'ExcludedSites': {
+                                        'Items': pending[campaign_id]
+                                    }
+                                }
+                                for campaign_id in chunk
+                            ]
+                        }
+                    },
+                    'update ExcludedSites'
                 )
-                if valid_sites:
+                if response is None:
+                    results.update({campaign_id: None for campaign_id in chunk})
                     continue
-                print('❌ No valid domains left after Direct rejected ExcludedSites items')
-                return None
-
-            if 'error' in data:
-                print(f'❌ API ERROR OBJECT: {json.dumps(data["error"], ensure_ascii=False)}')
-            else:
-                print(f'❌ UpdateResults errors without ExcludedSites index: {json.dumps(result_errors, ensure_ascii=False)}')
-            return None
+                
+                print(f'📡 HTTP Status: {response.status_code} ({len(chunk)} campaigns)')
+                
+                if response.status_code != 200:
+                    print(f'❌ FULL API ERROR: {response.text}')
+                    results.update({campaign_id: None for campaign_id in chunk})
+                    continue
+                
+                data = response.json()
+                print(f'📥 FULL API RESPONSE: {json.dumps(data, ensure_ascii=False)}')
 
-        return None
+                if 'error' in data:
+                    print(f'❌ API ERROR OBJECT: {json.dumps(data["error"], ensure_ascii=False)}')
+                    results.update({campaign_id: None for campaign_id in chunk})
+                    continue
+                
+                update_results = data.get('result', {}).get('UpdateResults', [])
+                for index, campaign_id in enumerate(chunk):
+                    item_result = update_results[index] if index < len(update_results) else {}
+                    result_errors = item_result.get('Errors') or []
+                    valid_sites = pending[campaign_id]
+
+                    if item_result.get('Id') and not result_errors:
+                        if str(item_result.get('Id')) != campaign_id:
+                            print(f'🚨 UpdateResults[{index}] Id {item_result.get("Id")} does not match campaign {campaign_id}')
+                            results[campaign_id] = None
+                            continue
+                        print(f'✅ Campaign {campaign_id} updated successfully')
+                        _excluded_sites_cache[campaign_id] = list(valid_sites)
+                        results[campaign_id] = valid_sites
+                        continue
+
+                    bad_indices = []
+                    for error in result_errors:
+                        details = str(error.get('Details') or error.get('Message') or '')
+                        match = re.search(r'ExcludedSites\[(\d+)\]', details)
+                        if match:
+                            bad_indices.append(int(match.group(1)))
+
+                    if bad_indices:
+                        removed = []
+                        for bad_index in sorted(set(bad_indices), reverse=True):
+                            if 0 <= bad_index < len(valid_sites):
+                                removed.append(valid_sites.pop(bad_index))
+                        print(
+                            f'⚠️ Direct rejected {len(removed)} ExcludedSites items in campaign {campaign_id} '
+                            f'on attempt {update_attempt}: {removed}. Retrying without them.',
+                            flush=True
+                        )
+                        if valid_sites:
+                            retry[campaign_id] = valid_sites
+                            continue
+                        print(f'❌ No valid domains left in campaign {campaign_id} after Direct rejected ExcludedSites items')
+                        results[campaign_id] = None
+                        continue
+
+                    print(
+                        f'❌ Campaign {campaign_id}: UpdateResults errors without ExcludedSites index: '
+                        f'{json.dumps(result_errors, ensure_ascii=False)}'
+                    )
+                    results[campaign_id] = None
+
+            pending = retry
+
+        for campaign_id in pending:
+            results[campaign_id] = None
+        return results
         
     except Exception as e:
         print(f'❌ Exception in update_excluded_sites: {str(e)}')
         import traceback
         print(f'❌ Traceback: {traceback.format_exc()}')
-        return None
+        for campaign_id in excluded_by_campaign:
+            results.setdefault(str(campaign_id), None)
+        return results
@@ -0,0 +1,245 @@
+import random
+
+import pytest
+
+from task_filter import CompiledTaskFilter
+
+
+@pytest.fixture(scope='module')
+def worker(load_function):
+    return load_function('rsya-batch-worker')
+
+
+def daily_row(domain, date, clicks, cost, conversions, impressions, goal_conversions=None, campaign_id=None):
+    row = {
+        'domain': domain,
+        'date': date,
+        'clicks': clicks,
+        'cost': cost,
+        'conversions': conversions,
+        'impressions': impressions,
+        'goal_conversions': goal_conversions or {},
+    }
+    if campaign_id is not None:
+        row['campaign_id'] = campaign_id
+    return row
+
+
+def test_split_platforms_by_campaign(worker):
+    rows = [{'domain': 'a.ru', 'campaign_id': '1'}, {'domain': 'b.ru', 'campaign_id': '2'}, {'domain': 'c.ru', 'campaign_id': '9'}]
+    assert worker.split_platforms_by_campaign(rows, ['1', '2', '3']) == {
+        '1': [rows[0]],
+        '2': [rows[1]],
+        '3': [],
+    }
+    # Отчёт одной кампании приходит без колонки CampaignId
+    assert worker.split_platforms_by_campaign([{'domain': 'a.ru'}], ['7']) == {'7': [{'domain': 'a.ru'}]}
+    assert worker.split_platforms_by_campaign(None, ['1', '2']) == {'1': None, '2': None}
+
+
+def test_aggregate_daily_platforms_period_and_day(worker):
+    rows = [
+        daily_row('a.ru', '2026-10-17', 10, 20.0, 1, 100, {'5': 1}),
+        daily_row('a.ru', '2026-10-18', 30, 40.0, 0, 300, {'6': 2}),
+        daily_row('b.ru', '2026-10-18', 0, 0.0, 0, 50),
+    ]
+    period = {platform['domain']: platform for platform in worker.aggregate_daily_platforms(rows)}
+    assert period['a.ru'] == {
+        'domain': 'a.ru',
+        'clicks': 40,
+        'cost': 60.0,
+        'conversions': 1,
+        'goal_conversions': {'5': 1, '6': 2},
+        'impressions': 400,
+        'cpc': 1.5,
+        'ctr': 10.0,
+        'cpa': 60.0,
+    }
+    assert (period['b.ru']['cpc'], period['b.ru']['ctr'], period['b.ru']['cpa']) == (0, 0.0, 0)
+
+    today = worker.aggregate_daily_platforms(rows, {'2026-10-18'})
+    assert [(p['domain'], p['clicks'], p['goal_conversions']) for p in today] == [('a.ru', 30, {'6': 2}), ('b.ru', 0, {})]
+    assert worker.aggregate_daily_platforms(rows, {'2026-10-01'}) == []
+
+
+def test_daily_aggregation_matches_period_report(worker):
+    '''Сумма дневных строк по площадке совпадает с отчётом за период без поля Date.'''
+    rng = random.Random(3)
+    dates = ['2026-10-12', '2026-10-13', '2026-10-14']
+    rows = [
+        daily_row(domain, date, rng.randint(0, 20), float(rng.randint(0, 100)), rng.randint(0, 2), rng.randint(0, 500))
+        for domain in ('a.ru', 'b.ru', 'c.ru') for date in dates if rng.random() < 0.8
+    ]
+    for platform in worker.aggregate_daily_platforms(rows, set(dates[1:])):
+        source = [row for row in rows if row['domain'] == platform['domain'] and row['date'] in dates[1:]]
+        for field in ('clicks', 'cost', 'conversions', 'impressions'):
+            assert platform[field] == sum(row[field] for row in source)
+
+
+def test_platform_columns_mask_matches_compiled_filter(worker):
+    pytest.importorskip('numpy')
+    rng = random.Random(10)
+    domains = ['casino.ru', 'news.example.com', 'vpn-app.com', 'game.net', 'mail.ru', 'x.org']
+    for _ in range(300):
+        platforms = []
+        for _ in range(rng.randint(1, 40)):
+            clicks = rng.randint(0, 100)
+            impressions = rng.randint(0, 2000)
+            cost = rng.choice([0.0, rng.uniform(0, 500)])
+            goal_conversions = {g: rng.randint(0, 2) for g in rng.sample(['1', '2', '3'], rng.randint(0, 2))}
+            conversions = rng.randint(0, 3)
+            platforms.append({
+                'domain': rng.choice(domains),
+                'clicks': clicks,
+                'impressions': impressions,
+                'cost': cost,
+                'conversions': conversions,
+                'goal_conversions': goal_conversions,
+                'cpc': cost / clicks if clicks else 0,
+                'ctr': clicks / impressions * 100 if impressions else 0,
+            })
+        config = {key: rng.choice([0, 1, 5, 50.5]) for key in ('min_clicks', 'max_cpc', 'min_ctr', 'min_conversions', 'max_cpa', 'min_cpa') if rng.random() < 0.3}
+        if rng.random() < 0.5:
+            config['keywords'] = rng.sample(['casino', '.com', 'news.', 'game'], 2)
+        if rng.random() < 0.3:
+            config['exceptions'] = ['mail']
+        if rng.random() < 0.3:
+            config['goal_ids'] = rng.sample(['1', '2', '3'], 1)
+        if rng.random() < 0.2:
+            config['protect_conversions'] = True
+        task_filter = CompiledTaskFilter(config, rng.choice(['AND', 'OR']))
+
+        mask = worker.PlatformColumns(platforms).match_mask(task_filter)
+        assert list(mask) == [task_filter.matches(platform) for platform in platforms], config
+
+
+class CampaignsUpdateStub:
+    '''Подмена campaigns.update: отвечает заготовленными UpdateResults и запоминает отправленные кампании.'''
+
+    def __init__(self, fake_response, replies):
+        self.fake_response = fake_response
+        self.replies = list(replies)
+        self.sent = []
+
+    def __call__(self, headers, payload, operation):
+        campaigns = payload['params']['Campaigns']
+        self.sent.append([(str(c['Id']), list(c['ExcludedSites']['Items'])) for c in campaigns])
+        reply = self.replies.pop(0)
+        update_results = reply(campaigns) if callable(reply) else reply
+        return self.fake_response({'result': {'UpdateResults': update_results}})
+
+
+@pytest.fixture
+def campaigns_update(worker, monkeypatch, fake_response):
+    monkeypatch.setattr(worker, '_excluded_sites_cache', {})
+
+    def install(*replies):
+        stub = CampaignsUpdateStub(fake_response, replies)
+        monkeypatch.setattr(worker, 'post_direct_campaigns_with_retry', stub)
+        return stub
+    return install
+
+
+def test_update_excluded_sites_bulk_maps_results_by_position(worker, campaigns_update):
+    stub = campaigns_update(
+        [
+            {'Id': 1},
+            {'Errors': [{'Code': 5005, 'Details': 'Invalid value in ExcludedSites[1]'}]},
+            {'Id': 3},
+        ],
+        [{'Id': 2}],
+    )
+    results = worker.update_excluded_sites_bulk('token', {
+        '1': ['a.ru'],
+        '2': ['b.ru', 'bad.ru', 'c.ru'],
+        '3': ['d.ru'],
+    })
+    assert results == {'1': ['a.ru'], '2': ['b.ru', 'c.ru'], '3': ['d.ru']}
+    # Повторно уходит только кампания с отклонёнными элементами и без них
+    assert stub.sent[1] == [('2', ['b.ru', 'c.ru'])]
+    assert worker._excluded_sites_cache['2'] == ['b.ru', 'c.ru']
+
+
+def test_update_excluded_sites_bulk_rejects_mismatched_or_missing_results(worker, campaigns_update):
+    campaigns_update([{'Id': 2}])
+    results = worker.update_excluded_sites_bulk('token', {'1': ['a.ru'], '2': ['b.ru']})
+    assert results == {'1': None, '2': None}
+    assert worker._excluded_sites_cache == {}
+
+
+def test_update_excluded_sites_bulk_positions_are_per_chunk(worker, campaigns_update, monkeypatch):
+    monkeypatch.setattr(worker, 'CAMPAIGNS_UPDATE_CHUNK', 2)
+    stub = campaigns_update(
+        lambda campaigns: [{'Id': c['Id']} for c in campaigns],
+        lambda campaigns: [{'Errors': [{'Details': 'ExcludedSites[0]'}]}],
+    )
+    results = worker.update_excluded_sites_bulk('token', {'1': ['a.ru'], '2': ['b.ru'], '3': ['c.ru']})
+    assert [len(chunk) for chunk in stub.sent] == [2, 1]
+    # У кампании 3 не осталось доменов после отклонения единственного элемента
+    assert results == {'1': ['a.ru'], '2': ['b.ru'], '3': None}
+
+
+class RunCursor:
+    '''Курсор-эмулятор для счётчика remaining_batches запуска и статусов его батчей.'''
+
+    def __init__(self, remaining_batches, batches):
+        self.run = {'status': 'running', 'remaining_batches': remaining_batches}
+        self.batches = batches
+        self.schedule_shifts = 0
+        self.rowcount = 0
+        self._row = None
+
+    def execute(self, sql, params=()):
+        self._row = None
+        if 'UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_runs' in sql:
+            if self.run['status'] == 'running':
+                self.run['remaining_batches'] -= 1
+                if self.run['remaining_batches'] <= 0:
+                    self.run['status'] = 'completed'
+                self._row = {'remaining_batches': self.run['remaining_batches']}
+        elif 'UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_schedule' in sql:
+            self.schedule_shifts += 1
+        elif 'UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches' in sql:
+            _, batch_id, worker_id = params
+            batch = self.batches[batch_id]
+            active = batch['status'] in ('pending', 'processing')
+            self.rowcount = int(active and (batch['lease_owner'] == worker_id or batch['status'] == 'pending'))
+            if self.rowcount:
+                batch['status'] = 'failed'
+        else:
+            raise AssertionError(sql)
+
+    def fetchone(self):
+        return self._row
+
+
+def test_run_counter_closes_run_on_last_batch(worker):
+    cursor = RunCursor(3, {})
+    assert worker.finish_run_batch(10, 77, cursor) is False
+    assert worker.finish_run_batch(10, 77, cursor) is False
+    assert cursor.schedule_shifts == 0
+    assert worker.finish_run_batch(10, 77, cursor) is True
+    assert cursor.run == {'status': 'completed', 'remaining_batches': 0}
+    assert cursor.schedule_shifts == 1
+    # Закрытый запуск больше не уменьшается и расписание не сдвигается повторно
+    assert worker.finish_run_batch(10, 77, cursor) is False
+    assert cursor.schedule_shifts == 1
+
+
+def test_failed_batch_counts_once_and_only_for_lease_owner(worker):
+    cursor = RunCursor(2, {
+        1: {'status': 'processing', 'lease_owner': 'worker-a'},
+        2: {'status': 'processing', 'lease_owner': 'worker-b'},
+    })
+    worker.mark_batch_failed(1, 'boom', 10, 77, 'worker-a', cursor)
+    worker.mark_batch_failed(1, 'boom again', 10, 77, 'worker-a', cursor)
+    assert cursor.run['remaining_batches'] == 1
+
+    # Аренду батча 2 держит другой воркер — его статус и счётчик запуска не трогаем
+    worker.mark_batch_failed(2, 'stale', 10, 77, 'worker-a', cursor)
+    assert cursor.batches[2]['status'] == 'processing'
+    assert cursor.run['remaining_batches'] == 1
+
+    worker.mark_batch_failed(2, 'boom', 10, 77, 'worker-b', cursor)
+    assert cursor.run == {'status': 'completed', 'remaining_batches': 0}
+    assert cursor.schedule_shifts == 1
@@ -2,32 +2,130 @@ import json
 import os
 import time
 import re
-from typing import Dict, Any, List
+import uuid
+from typing import Dict, Any, List, Optional
 import psycopg2
 import psycopg2.extras
 import requests
 import boto3
+from direct_client import build_http_session, get_direct_limiter
+
+
+http_session = build_http_session()
+
 
 BATCH_SIZE = 50  # Обрабатываем 50 площадок за раз
+QUEUE_LEASE_SEC = int(os.environ.get('RSYA_QUEUE_LEASE_SEC', '300'))  # Аренда захваченных строк block_queue
+RESCORE_BATCH = 1000  # Сколько pending строк со старой версией приоритета пересчитываем за вызов
+CAMPAIGNS_GET_CHUNK = 1000  # Лимит Ids в SelectionCriteria campaigns.get
+CAMPAIGNS_UPDATE_CHUNK = 10  # Лимит кампаний в одном campaigns.update
+
+
+# Снимок ExcludedSites в рамках одного вызова: campaign_id → список доменов или 'UNMODIFIABLE'
+_excluded_sites_cache: Dict[str, Any] = {}
+
+
+def post_direct_campaigns(token: str, payload: Dict[str, Any]) -> requests.Response:
+    '''POST в campaigns под лимитом токена (token bucket + Units).'''
+    limiter = get_direct_limiter(token)
+    limiter.acquire()
+    response = http_session.post(
+        'https://api.direct.yandex.com/json/v5/campaigns',
+        json=payload,
+        headers={'Authorization': f'Bearer {token}'}
+    )
+    limiter.observe(response)
+    return response
+
+
+def claim_queue_items(cursor, conn, worker_id: str, limit: int = BATCH_SIZE) -> List[Dict[str, Any]]:
+    '''
+    Захватывает самые приоритетные pending площадки block_queue (FOR UPDATE SKIP LOCKED) в аренду worker_id.
+    Захват коммитится сразу: параллельные воркеры берут другие строки, не дожидаясь конца обработки.
+    Строки с истёкшей арендой (воркер упал) возвращаются в pending.
+    '''
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.block_queue
+        SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        WHERE status = 'processing'
+          AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+    """)
+    if cursor.rowcount:
+        print(f'♻️ Returned {cursor.rowcount} placements with expired lease to pending')
+    
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.block_queue bq
+        SET status = 'processing',
+            lease_owner = %s,
+            lease_expires_at = NOW() + make_interval(secs => %s)
+        WHERE bq.id IN (
+            SELECT q.id
+            FROM t_p97630513_yandex_cleaning_serv.block_queue q
+            WHERE q.status = 'pending'
+            ORDER BY q.priority_score DESC, q.cost DESC, q.clicks DESC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING bq.id, bq.task_id, bq.campaign_id, bq.domain, bq.project_id,
+                  bq.clicks, bq.cost, bq.conversions, bq.cpa, bq.priority_score
+    """, (worker_id, QUEUE_LEASE_SEC, limit))
+    items = sorted(cursor.fetchall(), key=lambda item: float(item['priority_score'] or 0), reverse=True)
+    conn.commit()
+    return items
 
-def process_from_database_fallback(dsn: str) -> Dict[str, Any]:
+
+def release_queue_items(cursor, queue_ids: List[int], worker_id: str) -> None:
+    '''Возвращает в pending захваченные worker_id строки, которые обработка не сняла с очереди'''
+    if queue_ids:
+        cursor.execute("""
+            UPDATE t_p97630513_yandex_cleaning_serv.block_queue
+            SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ANY(%s) AND status = 'processing' AND lease_owner = %s
+        """, (list(queue_ids), worker_id))
+
+
+def rescore_pending_queue(cursor, conn, limit: int = RESCORE_BATCH) -> int:
+    '''
+    Пересчитывает priority_score pending строк, записанных старой версией формулы (или без неё),
+    одним UPDATE через SQL-функцию block_queue_priority_score — формула хранится только в БД.
+    '''
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.block_queue bq
+        SET priority_score = t_p97630513_yandex_cleaning_serv.block_queue_priority_score(
+                bq.domain, bq.clicks, bq.cost, bq.conversions, bq.cpa),
+            priority_version = t_p97630513_yandex_cleaning_serv.block_queue_priority_version()
+        WHERE bq.id IN (
+            SELECT q.id
+            FROM t_p97630513_yandex_cleaning_serv.block_queue q
+            WHERE q.status = 'pending'
+              AND q.priority_version < t_p97630513_yandex_cleaning_serv.block_queue_priority_version()
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    """, (limit,))
+    rescored = cursor.rowcount
+    conn.commit()
+    if rescored:
+        print(f'🧮 Rescored {rescored} pending placements')
+    return rescored
+
+
+def process_from_database_fallback(dsn: str, worker_id: str) -> Dict[str, Any]:
     '''Fallback: обработка pending площадок напрямую из БД когда MQ пустая'''
     try:
         conn = psycopg2.connect(dsn)
         conn.autocommit = False
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         
-        # Читаем pending площадки с приоритетом (лимит 50)
-        cursor.execute("""
-            SELECT bq.id, bq.task_id, bq.campaign_id, bq.domain, bq.project_id,
-                   bq.clicks, bq.cost, bq.conversions, bq.cpa
-            FROM t_p97630513_yandex_cleaning_serv.block_queue bq
-            WHERE bq.status = 'pending'
-            ORDER BY bq.cost DESC, bq.clicks DESC
-            LIMIT 50
-        """)
+        # Строки без актуального приоритета пересчитываем до захвата, иначе они встанут в конец очереди
+        try:
+            rescore_pending_queue(cursor, conn)
+        except Exception as e:
+            conn.rollback()
+            print(f'⚠️ Priority rescore skipped: {e}')
         
-        pending_items = cursor.fetchall()
+        # Захватываем pending площадки по приоритету (лимит BATCH_SIZE)
+        pending_items = claim_queue_items(cursor, conn, worker_id)
         
         if not pending_items:
             cursor.close()
@@ -53,6 +151,7 @@ def process_from_database_fallback(dsn: str) -> Dict[str, Any]:
                 projects_map[project_id][campaign_id] = []
             
             projects_map[project_id][campaign_id].append({
+                'id': item['id'],
                 'task_id': item['task_id'],
                 'campaign_id': str(campaign_id),
                 'domain': item['domain'],
@@ -76,18 +175,18 @@ def process_from_database_fallback(dsn: str) -> Dict[str, Any]:
             project = cursor.fetchone()
             if not project or not project['yandex_token']:
                 print(f'❌ Project {project_id} not found or no token')
+                release_queue_items(
+                    cursor, [item['id'] for items in campaigns_map.values() for item in items], worker_id
+                )
                 continue
             
             token = project['yandex_token']
             
-            # Обрабатываем каждую кампанию
-            for campaign_id, placements in campaigns_map.items():
-                result = block_placements_batch(
-                    token, campaign_id, placements, cursor, conn, project_id
-                )
-                processed_total += result['processed']
-                blocked_total += result['blocked']
-                failed_total += result['failed']
+            # Все кампании проекта — одним campaigns.get и минимумом campaigns.update
+            result = block_placements_for_project(token, campaigns_map, cursor, conn, project_id, worker_id)
+            processed_total += result['processed']
+            blocked_total += result['blocked']
+            failed_total += result['failed']
         
         conn.commit()
         cursor.close()
@@ -132,48 +231,6 @@ def process_from_database_fallback(dsn: str) -> Dict[str, Any]:
         }
 
 
-def calculate_priority_score(item: Dict[str, Any]) -> float:
-    '''Расчет приоритета площадки для блокировки (больше = важнее заблокировать)'''
-    domain = item.get('domain', '').lower()
-    clicks = item.get('clicks', 0)
-    cost = item.get('cost', 0)
-    conversions = item.get('conversions', 0)
-    cpa = item.get('cpa', 0)
-    
-    score = 0.0
-    
-    # ВЫСОКИЙ ПРИОРИТЕТ: Подозрительные домены
-    suspicious_patterns = [
-        r'\.com$', r'dsp', r'vpn',
-        r'game|игр|казино|poker|casino',
-        r'adult|xxx|porn', r'download|торрент'
-    ]
-    
-    is_suspicious = any(re.search(pattern, domain) for pattern in suspicious_patterns)
-    
-    if is_suspicious:
-        score += 100
-        if cost > 100:
-            score += 50
-        if clicks > 50:
-            score += 30
-    
-    # СРЕДНИЙ ПРИОРИТЕТ: Бесполезный трафик
-    if cost > 0 and clicks > 10:
-        cpc = cost / clicks
-        if cpc < 5 and conversions == 0:
-            score += 60
-    
-    if cpa > 1000:
-        score += 70
-    
-    # Чем больше расход - тем выше приоритет
-    if cost > 0:
-        score += min(cost / 10, 50)
-    
-    return score
-
-
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Worker для обработки батчей площадок из Message Queue (self-polling)
@@ -207,6 +264,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Message Queue credentials not configured'})
         }
     
+    # Тёплый контейнер: снимки ExcludedSites прошлого вызова могли устареть
+    _excluded_sites_cache.clear()
+    worker_id = str(getattr(context, 'request_id', None) or uuid.uuid4().hex)
+
     try:
         sqs = boto3.client(
             'sqs',
@@ -232,7 +293,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             dsn = os.environ.get('DATABASE_URL')
             if dsn:
                 try:
-                    return process_from_database_fallback(dsn)
+                    return process_from_database_fallback(dsn, worker_id)
                 except Exception as db_err:
                     print(f'❌ Database fallback failed: {str(db_err)}')
             
@@ -310,14 +371,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         campaigns_map[campaign_id] = []
                     campaigns_map[campaign_id].append(placement)
                 
-                # Обрабатываем каждую кампанию
-                for campaign_id, campaign_placements in campaigns_map.items():
-                    result = block_placements_batch(
-                        token, campaign_id, campaign_placements, cursor, conn, project_id
-                    )
-                    processed_total += result['processed']
-                    blocked_total += result['blocked']
-                    failed_total += result['failed']
+                # Все кампании сообщения — одним campaigns.get и минимумом campaigns.update
+                result = block_placements_for_project(token, campaigns_map, cursor, conn, project_id, worker_id)
+                processed_total += result['processed']
+                blocked_total += result['blocked']
+                failed_total += result['failed']
                 
                 # Удаляем обработанное сообщение
                 if receipt_handle:
@@ -372,148 +430,164 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
 
 
-def block_placements_for_campaign(
-    token: str, 
-    campaign_id: int, 
-    task_id: int, 
-    items: List[Dict], 
-    cursor, 
-    conn
-) -> Dict[str, int]:
-    '''Блокировка площадок для одной кампании'''
-    
-    print(f'🎯 Campaign {campaign_id}: processing {len(items)} placements')
-    
-    # Получаем текущий список ExcludedSites из Яндекса
-    current_excluded = get_excluded_sites(token, campaign_id)
-    
-    if current_excluded is None:
-        print(f'❌ Failed to fetch ExcludedSites for campaign {campaign_id}')
-        return {'processed': 0, 'blocked': 0, 'failed': len(items)}
-    
-    print(f'🔍 Current excluded list: {current_excluded[:10]}')
-    
-    # Рассчитываем сколько мест доступно (лимит 950 вместо 1000 для ротации)
-    soft_limit = 950
-    current_count = len(current_excluded)
-    available_slots = max(0, soft_limit - current_count)
-    
-    print(f'📊 Campaign {campaign_id}: Current blocked={current_count}, Requested={len(items)} (unique={len(set([i["domain"] for i in items]))}), Will add={min(available_slots, len(items))}')
-    
-    # Если лимит достигнут - пропускаем
-    if available_slots == 0:
-        print(f'⛔ Campaign {campaign_id}: LIMIT REACHED ({current_count}/{soft_limit}+). Skipping addition, waiting for daily rotation.')
-        
-        # Помечаем площадки как failed (rotation их освободит)
-        for item in items:
-            cursor.execute("""
-                UPDATE t_p97630513_yandex_cleaning_serv.block_queue 
-                SET status = 'failed', 
-                    attempts = attempts + 1,
-                    error_message = 'Campaign at limit, waiting for rotation'
-                WHERE id = %s
-            """, (item['id'],))
-        
-        return {'processed': len(items), 'blocked': 0, 'failed': len(items)}
-    
-    # Фильтруем домены которых еще нет в списке
-    current_excluded_set = set(current_excluded)
-    domains_to_add = []
-    already_blocked_items = []
-    
-    for item in items:
-        domain = item['domain']
-        if domain not in current_excluded_set:
-            domains_to_add.append(domain)
-        else:
-            already_blocked_items.append(item)
-    
-    # Уже заблокированные - удалим позже после успешного обновления
-    
-    print(f'📝 Domains to add: {domains_to_add[:10]}')
-    
-    if not domains_to_add:
-        print(f'✅ All {len(items)} placements already blocked')
-        return {'processed': len(items), 'blocked': 0, 'failed': 0}
-    
-    # Ограничиваем количество добавляемых доменов
-    domains_to_add = domains_to_add[:available_slots]
-    
-    # Добавляем новые домены (используем set чтобы гарантировать уникальность)
-    new_excluded_list = list(set(list(current_excluded_set) + domains_to_add))
-    
-    print(f'📝 New excluded list size: {len(new_excluded_list)} (current: {len(current_excluded)}, adding: {len(domains_to_add)})')
-    
-    # Обновляем в Яндексе
-    success = update_excluded_sites(token, campaign_id, new_excluded_list)
-    
-    if success:
-        # УДАЛЯЕМ из очереди (не completed!)
-        blocked_count = 0
-        for item in items:
-            if item['domain'] in domains_to_add:
-                cursor.execute("""
-                    DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue WHERE id = %s
-                """, (item['id'],))
-                blocked_count += 1
-        
-        # Удаляем уже заблокированные
-        for item in already_blocked_items:
-            cursor.execute("""
-                DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue WHERE id = %s
-            """, (item['id'],))
-        
-        print(f'✅ Blocked {blocked_count} placements in campaign {campaign_id}, deleted {len(already_blocked_items)} already blocked')
-        return {'processed': len(items), 'blocked': blocked_count, 'failed': 0}
-    else:
-        # Increment attempts, но НЕ failed (retry автоматически)
-        for item in items:
-            if item['domain'] in domains_to_add:
-                cursor.execute("""
-                    UPDATE t_p97630513_yandex_cleaning_serv.block_queue 
-                    SET attempts = attempts + 1,
-                        error_message = 'Failed to update ExcludedSites'
-                    WHERE id = %s AND attempts < 3
-                """, (item['id'],))
-                # Удаляем если >= 3 попытки
-                cursor.execute("""
-                    DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue WHERE id = %s AND attempts >= 3
-                """, (item['id'],))
-        
-        print(f'❌ Batch failed: Failed to update ExcludedSites')
-        return {'processed': len(items), 'blocked': 0, 'failed': len(items)}
+def attach_queue_ids(cursor, conn, project_id: int, campaigns_map: Dict[Any, List[Dict]], worker_id: str) -> Dict[Any, List[Dict]]:
+    '''
+    Проставляет площадкам queue_ids — id строк block_queue (одна площадка может стоять в очереди от нескольких задач).
+    Площадки из БД уже захвачены claim_queue_items и несут свой id; для сообщений MQ строки находятся
+    и берутся в аренду одним запросом по (campaign_id, domain).
+    В аренду берутся только pending строки и processing с истёкшей арендой — failed строки не возвращаются в работу.
+    Returns: campaigns_map без площадок, все строки которых в аренде у другого воркера или уже failed
+    '''
+    lookup = []
+    for campaign_id, placements in campaigns_map.items():
+        for placement in placements:
+            if placement.get('id'):
+                placement['queue_ids'] = [placement['id']]
+            else:
+                placement['queue_ids'] = []
+                lookup.append((int(campaign_id), placement['domain'], placement))
+    if not lookup:
+        return campaigns_map
+
+    keys = ([item[0] for item in lookup], [item[1] for item in lookup])
+    cursor.execute("""
+        SELECT bq.campaign_id, bq.domain
+        FROM t_p97630513_yandex_cleaning_serv.block_queue bq
+        JOIN unnest(%s::bigint[], %s::text[]) AS k(campaign_id, domain)
+          ON bq.campaign_id = k.campaign_id AND bq.domain = k.domain
+        WHERE bq.project_id = %s
+    """, (*keys, project_id))
+    queued_keys = {(int(row['campaign_id']), row['domain']) for row in cursor.fetchall()}
+
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.block_queue bq
+        SET status = 'processing',
+            lease_owner = %s,
+            lease_expires_at = NOW() + make_interval(secs => %s)
+        WHERE bq.id IN (
+            SELECT q.id
+            FROM t_p97630513_yandex_cleaning_serv.block_queue q
+            JOIN unnest(%s::bigint[], %s::text[]) AS k(campaign_id, domain)
+              ON q.campaign_id = k.campaign_id AND q.domain = k.domain
+            WHERE q.project_id = %s
+              AND (q.status = 'pending'
+                   OR (q.status = 'processing' AND (q.lease_expires_at IS NULL OR q.lease_expires_at < NOW())))
+            FOR UPDATE OF q SKIP LOCKED
+        )
+        RETURNING bq.id, bq.campaign_id, bq.domain
+    """, (worker_id, QUEUE_LEASE_SEC, *keys, project_id))
+    ids_by_key: Dict[tuple, List[int]] = {}
+    for row in cursor.fetchall():
+        ids_by_key.setdefault((int(row['campaign_id']), row['domain']), []).append(row['id'])
+    conn.commit()
+
+    skipped = set()
+    for campaign_id, domain, placement in lookup:
+        key = (campaign_id, domain)
+        placement['queue_ids'] = ids_by_key.get(key, [])
+        if key in queued_keys and not placement['queue_ids']:
+            # Площадку уже блокирует другой воркер или она уже отклонена (failed) — повторный campaigns.update не нужен
+            skipped.add(id(placement))
+    if skipped:
+        print(f'⏭️ Project {project_id}: {len(skipped)} placements are leased by another worker or failed, skipping')
+
+    result = {}
+    for campaign_id, placements in campaigns_map.items():
+        kept = [placement for placement in placements if id(placement) not in skipped]
+        if kept:
+            result[campaign_id] = kept
+    return result
+
+
+def _queue_ids(placements: List[Dict]) -> List[int]:
+    return [queue_id for placement in placements for queue_id in (placement.get('queue_ids') or [])]
 
 
-def block_placements_batch(
-    token: str, 
-    campaign_id: int, 
-    placements: List[Dict], 
-    cursor, 
+def delete_queue_items(cursor, queue_ids: List[int]) -> None:
+    '''Снимает обработанные площадки с очереди одним DELETE по id'''
+    if queue_ids:
+        cursor.execute("""
+            DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue WHERE id = ANY(%s)
+        """, (list(queue_ids),))
+
+
+def fail_queue_items(cursor, queue_ids: List[int], error_message: str) -> None:
+    '''Помечает площадки failed одним UPDATE по id'''
+    if queue_ids:
+        cursor.execute("""
+            UPDATE t_p97630513_yandex_cleaning_serv.block_queue 
+            SET status = 'failed',
+                attempts = attempts + 1,
+                error_message = %s,
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE id = ANY(%s)
+        """, (error_message, list(queue_ids)))
+
+
+def block_placements_for_project(
+    token: str,
+    campaigns_map: Dict[Any, List[Dict]],
+    cursor,
     conn,
-    project_id: int
+    project_id: int,
+    worker_id: Optional[str] = None
 ) -> Dict[str, int]:
-    '''Блокировка батча площадок для одной кампании (из Message Queue)'''
-    
+    '''
+    Блокировка площадок сразу по нескольким кампаниям проекта:
+    ExcludedSites читаются одним campaigns.get, новые списки уходят пачками в campaigns.update.
+    worker_id — строки очереди берутся в аренду; площадки, арендованные другим воркером, пропускаются.
+    '''
+    totals = {'processed': 0, 'blocked': 0, 'failed': 0}
+    worker_id = worker_id or uuid.uuid4().hex
+    campaigns_map = attach_queue_ids(cursor, conn, project_id, campaigns_map, worker_id)
+    if not campaigns_map:
+        return totals
+    prefetch_excluded_sites(token, list(campaigns_map.keys()))
+
+    plans = {}
+    for campaign_id, placements in campaigns_map.items():
+        plan, result = _plan_placements_block(token, campaign_id, placements, cursor, project_id)
+        if plan is None:
+            for key in totals:
+                totals[key] += result[key]
+        else:
+            plans[str(campaign_id)] = plan
+
+    if plans:
+        applied = update_excluded_sites_bulk(
+            token, {campaign_id: plan['new_excluded_list'] for campaign_id, plan in plans.items()}
+        )
+        for campaign_id, plan in plans.items():
+            result = _finish_placements_block(plan, applied.get(campaign_id), cursor, project_id)
+            for key in totals:
+                totals[key] += result[key]
+
+    # Не снятые с очереди строки (ошибка чтения кампании, лимит) — обратно в pending
+    release_queue_items(
+        cursor, [queue_id for placements in campaigns_map.values() for queue_id in _queue_ids(placements)], worker_id
+    )
+    return totals
+
+
+def _plan_placements_block(token: str, campaign_id, placements: List[Dict], cursor, project_id: int):
+    '''
+    Returns: (план обновления ExcludedSites, None) или (None, итог) если update не нужен
+    '''
     print(f'🎯 Campaign {campaign_id}: processing {len(placements)} placements from MQ')
     
-    # Получаем текущий список ExcludedSites из Яндекса
+    # Получаем текущий список ExcludedSites (снимок вызова)
     current_excluded = get_excluded_sites(token, campaign_id)
     
     # Не трогаем только черновики и архив. Кампании без бюджета всё равно можно чистить.
     if current_excluded == 'UNMODIFIABLE':
         print(f'🗑️ Campaign {campaign_id} cannot be modified, removing {len(placements)} placements from queue')
-        for placement in placements:
-            cursor.execute("""
-                DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue 
-                WHERE project_id = %s 
-                  AND campaign_id = %s 
-                  AND domain = %s
-            """, (project_id, campaign_id, placement['domain']))
-        return {'processed': len(placements), 'blocked': 0, 'failed': 0}
+        delete_queue_items(cursor, _queue_ids(placements))
+        return None, {'processed': len(placements), 'blocked': 0, 'failed': 0}
     
     if current_excluded is None:
         print(f'❌ Failed to fetch ExcludedSites for campaign {campaign_id}')
-        return {'processed': 0, 'blocked': 0, 'failed': len(placements)}
+        return None, {'processed': 0, 'blocked': 0, 'failed': len(placements)}
     
     # Лимит 950
     soft_limit = 950
@@ -522,7 +596,7 @@ def block_placements_batch(
     
     if available_slots == 0:
         print(f'⛔ Campaign {campaign_id}: LIMIT REACHED')
-        return {'processed': len(placements), 'blocked': 0, 'failed': len(placements)}
+        return None, {'processed': len(placements), 'blocked': 0, 'failed': len(placements)}
     
     # Фильтруем домены которых еще нет (КРИТИЧНО: lowercase для дедупликации)
     current_excluded_normalized = [d.lower() for d in current_excluded]
@@ -539,14 +613,8 @@ def block_placements_batch(
     if not domains_to_add:
         print(f'✅ All {len(placements)} placements already blocked')
         # Удаляем из block_queue
-        for placement in placements:
-            cursor.execute("""
-                DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue 
-                WHERE project_id = %s 
-                  AND campaign_id = %s 
-                  AND domain = %s
-            """, (project_id, campaign_id, placement['domain']))
-        return {'processed': len(placements), 'blocked': 0, 'failed': 0}
+        delete_queue_items(cursor, _queue_ids(placements))
+        return None, {'processed': len(placements), 'blocked': 0, 'failed': 0}
     
     # Ограничиваем
     domains_to_add = domains_to_add[:available_slots]
@@ -555,46 +623,114 @@ def block_placements_batch(
     new_excluded_list = list(set(current_excluded_normalized + domains_to_add))
     
     print(f'📝 New excluded list size: {len(new_excluded_list)} (current: {len(current_excluded)}, adding: {len(domains_to_add)})')
-    
-    # Обновляем в Яндексе
-    success = update_excluded_sites(token, campaign_id, new_excluded_list)
-    
-    if success:
-        # УДАЛЯЕМ из block_queue
-        for placement in placements:
-            domain_normalized = placement['domain'].lower()
-            if domain_normalized in domains_to_add or domain_normalized in current_excluded_set:
-                cursor.execute("""
-                    DELETE FROM t_p97630513_yandex_cleaning_serv.block_queue 
-                    WHERE project_id = %s 
-                      AND campaign_id = %s 
-                      AND domain = %s
-                """, (project_id, campaign_id, placement['domain']))
-        
-        print(f'✅ Blocked {len(domains_to_add)} placements in campaign {campaign_id}')
-        return {'processed': len(placements), 'blocked': len(domains_to_add), 'failed': 0}
-    else:
+    return {
+        'campaign_id': campaign_id,
+        'placements': placements,
+        'current_excluded_set': current_excluded_set,
+        'domains_to_add': domains_to_add,
+        'new_excluded_list': new_excluded_list,
+    }, None
+
+
+def _finish_placements_block(plan: Dict[str, Any], applied_sites, cursor, project_id: int) -> Dict[str, int]:
+    campaign_id = plan['campaign_id']
+    placements = plan['placements']
+    current_excluded_set = plan['current_excluded_set']
+
+    if applied_sites is None:
         print(f'❌ Failed to update ExcludedSites')
         return {'processed': len(placements), 'blocked': 0, 'failed': len(placements)}
 
+    applied_set = set(applied_sites)
+    blocked_domains = [domain for domain in plan['domains_to_add'] if domain in applied_set]
+    rejected = 0
 
-def get_excluded_sites(token: str, campaign_id: int):
-    '''Получение списка ExcludedSites из Яндекс.Директ (возвращает список доменов или 'ARCHIVED')'''
+    # УДАЛЯЕМ из block_queue; отклонённые Директом домены — failed, чтобы не крутились в очереди
+    done_ids = []
+    rejected_ids = []
+    domains_to_add = set(plan['domains_to_add'])
+    for placement in placements:
+        domain_normalized = placement['domain'].lower()
+        if domain_normalized in applied_set or domain_normalized in current_excluded_set:
+            done_ids.extend(placement.get('queue_ids') or [])
+        elif domain_normalized in domains_to_add:
+            rejected += 1
+            rejected_ids.extend(placement.get('queue_ids') or [])
+    delete_queue_items(cursor, done_ids)
+    fail_queue_items(cursor, rejected_ids, 'Rejected by Direct ExcludedSites validation')
+    
+    print(f'✅ Blocked {len(blocked_domains)} placements in campaign {campaign_id}' + (f', rejected {rejected}' if rejected else ''))
+    return {'processed': len(placements), 'blocked': len(blocked_domains), 'failed': rejected}
+
+
+def _excluded_sites_from_campaign(campaign_data: Dict[str, Any]):
+    '''ExcludedSites кампании из ответа campaigns.get: дедуплицированный список или 'UNMODIFIABLE'.'''
+    campaign_id = campaign_data.get('Id')
+    campaign_status = str(campaign_data.get('Status', 'UNKNOWN') or 'UNKNOWN').upper()
+    if campaign_status in {'DRAFT', 'ARCHIVED'}:
+        print(f'⚠️ Campaign {campaign_id} has status {campaign_status}, cannot be modified')
+        return 'UNMODIFIABLE'  # Специальное значение для неактивных кампаний
     
-    try:
-        response = requests.post(
-            'https://api.direct.yandex.com/json/v5/campaigns',
-            json={
+    excluded_sites_obj = campaign_data.get('ExcludedSites', {})
+    excluded = excluded_sites_obj.get('Items', []) if excluded_sites_obj else []
+    
+    # КРИТИЧНО: Дедуплицируем список сразу, чтобы избежать ошибки 9802 при обратной отправке
+    deduplicated = list(dict.fromkeys(excluded)) if excluded else []
+    
+    if len(excluded) != len(deduplicated):
+        print(f'⚠️ Removed {len(excluded) - len(deduplicated)} duplicates from current ExcludedSites (was {len(excluded)}, now {len(deduplicated)})')
+    
+    return deduplicated
+
+
+def prefetch_excluded_sites(token: str, campaign_ids: List[Any]) -> int:
+    '''Читает ExcludedSites нескольких кампаний одним campaigns.get в снимок вызова.'''
+    missing = [str(c) for c in dict.fromkeys(campaign_ids) if str(c) not in _excluded_sites_cache]
+    loaded = 0
+    for i in range(0, len(missing), CAMPAIGNS_GET_CHUNK):
+        chunk = missing[i:i + CAMPAIGNS_GET_CHUNK]
+        try:
+            response = post_direct_campaigns(token, {
                 'method': 'get',
                 'params': {
                     'SelectionCriteria': {
-                        'Ids': [campaign_id]
+                        'Ids': [int(campaign_id) for campaign_id in chunk]
                     },
                     'FieldNames': ['Id', 'ExcludedSites', 'Status']
                 }
-            },
-            headers={'Authorization': f'Bearer {token}'}
-        )
+            })
+            if response.status_code != 200:
+                print(f'⚠️ Bulk ExcludedSites fetch failed: {response.status_code}, {response.text[:500]}')
+                continue
+
+            requested = set(chunk)
+            for campaign_data in response.json().get('result', {}).get('Campaigns', []):
+                campaign_id = str(campaign_data.get('Id'))
+                if campaign_id in requested:
+                    _excluded_sites_cache[campaign_id] = _excluded_sites_from_campaign(campaign_data)
+                    loaded += 1
+        except Exception as e:
+            print(f'⚠️ Error in bulk ExcludedSites fetch: {str(e)}')
+    return loaded
+
+
+def get_excluded_sites(token: str, campaign_id: int):
+    '''Получение списка ExcludedSites из Яндекс.Директ (возвращает список доменов или 'ARCHIVED')'''
+    
+    cached = _excluded_sites_cache.get(str(campaign_id))
+    if cached is not None:
+        return list(cached) if isinstance(cached, list) else cached
+
+    try:
+        response = post_direct_campaigns(token, {
+            'method': 'get',
+            'params': {
+                'SelectionCriteria': {
+                    'Ids': [campaign_id]
+                },
+                'FieldNames': ['Id', 'ExcludedSites', 'Status']
+            }
+        })
         
         if response.status_code != 200:
             print(f'Yandex API error: {response.status_code}, {response.text}')
@@ -606,69 +742,105 @@ def get_excluded_sites(token: str, campaign_id: int):
         if not campaigns:
             return []
         
-        campaign_status = str(campaigns[0].get('Status', 'UNKNOWN') or 'UNKNOWN').upper()
-        if campaign_status in {'DRAFT', 'ARCHIVED'}:
-            print(f'⚠️ Campaign {campaign_id} has status {campaign_status}, cannot be modified')
-            return 'UNMODIFIABLE'  # Специальное значение для неактивных кампаний
-        
-        excluded_sites_obj = campaigns[0].get('ExcludedSites', {})
-        excluded = excluded_sites_obj.get('Items', []) if excluded_sites_obj else []
-        
-        # КРИТИЧНО: Дедуплицируем список сразу, чтобы избежать ошибки 9802 при обратной отправке
-        deduplicated = list(dict.fromkeys(excluded)) if excluded else []
-        
-        if len(excluded) != len(deduplicated):
-            print(f'⚠️ Removed {len(excluded) - len(deduplicated)} duplicates from current ExcludedSites (was {len(excluded)}, now {len(deduplicated)})')
-        
-        return deduplicated
+        excluded = _excluded_sites_from_campaign(campaigns[0])
+        _excluded_sites_cache[str(campaign_id)] = excluded
+        return list(excluded) if isinstance(excluded, list) else excluded
         
     except Exception as e:
         print(f'Error fetching ExcludedSites: {str(e)}')
         return None
 
 
-def update_excluded_sites(token: str, campaign_id: int, excluded_sites: List[str]) -> bool:
-    '''Обновление списка ExcludedSites в Яндекс.Директ'''
-    
+def update_excluded_sites_bulk(token: str, excluded_by_campaign: Dict[str, List[str]]) -> Dict[str, Any]:
+    '''
+    Обновление ExcludedSites нескольких кампаний пачками по CAMPAIGNS_UPDATE_CHUNK.
+    UpdateResults сопоставляются с кампаниями по позиции; отклонённые элементы ExcludedSites[i]
+    убираются из списка своей кампании и она отправляется повторно.
+    Returns: {campaign_id: применённый список или None при ошибке}
+    '''
+    results: Dict[str, Any] = {}
+    pending = {str(campaign_id): list(sites) for campaign_id, sites in excluded_by_campaign.items()}
+    for campaign_id in pending:
+        # Снимок больше не достоверен, пока не подтвердится успешный update
+        _excluded_sites_cache.pop(campaign_id, None)
+
     try:
-        response = requests.post(
-            'https://api.direct.yandex.com/json/v5/campaigns',
-            json={
-                'method': 'update',
-                'params': {
-                    'Campaigns': [{
-                        'Id': campaign_id,
-                        'ExcludedSites': {
-                            'Items': excluded_sites
-                        }
-                    }]
-                }
-            },
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        
-        if response.status_code != 200:
-            print(f'❌ Yandex API HTTP {response.status_code}: {response.text[:500]}')
-            return False
-        
-        data = response.json()
-        print(f'📥 Yandex API response: {json.dumps(data, ensure_ascii=False)[:1000]}')
-        
-        # Проверяем что обновление прошло успешно
-        if 'result' in data:
-            update_results = data['result'].get('UpdateResults', [])
-            if update_results and 'Id' in update_results[0]:
-                print(f'✅ Campaign {campaign_id} updated successfully')
-                return True
-        
-        # Если есть ошибки
-        if 'error' in data:
-            print(f'❌ Yandex API error response: {json.dumps(data["error"], ensure_ascii=False)}')
-        else:
-            print(f'❌ Unexpected Yandex API response format (no result, no error)')
-        
-        return False
+        for update_attempt in range(1, 21):
+            if not pending:
+                break
+
+            retry = {}
+            campaign_ids = list(pending.keys())
+            for i in range(0, len(campaign_ids), CAMPAIGNS_UPDATE_CHUNK):
+                chunk = campaign_ids[i:i + CAMPAIGNS_UPDATE_CHUNK]
+                response = post_direct_campaigns(token, {
+                    'method': 'update',
+                    'params': {
+                        'Campaigns': [
+                            {
+                                'Id': int(campaign_id),
+                                'ExcludedSites': {
+                                    'Items': pending[campaign_id]
+                                }
+                            }
+                            for campaign_id in chunk
+                        ]
+                    }
+                })
+                
+                if response.status_code != 200:
+                    print(f'❌ Yandex API HTTP {response.status_code}: {response.text[:500]}')
+                    results.update({campaign_id: None for campaign_id in chunk})
+                    continue
+                
+                data = response.json()
+                print(f'📥 Yandex API response: {json.dumps(data, ensure_ascii=False)[:1000]}')
+
+                if 'error' in data or 'result' not in data:
+                    if 'error' in data:
+                        print(f'❌ Yandex API error response: {json.dumps(data["error"], ensure_ascii=False)}')
+                    else:
+                        print(f'❌ Unexpected Yandex API response format (no result, no error)')
+                    results.update({campaign_id: None for campaign_id in chunk})
+                    continue
+                
+                update_results = data['result'].get('UpdateResults', [])
+                for index, campaign_id in enumerate(chunk):
+                    item_result = update_results[index] if index < len(update_results) else {}
+                    result_errors = item_result.get('Errors') or []
+                    sites = pending[campaign_id]
+
+                    if 'Id' in item_result and not result_errors:
+                        print(f'✅ Campaign {campaign_id} updated successfully')
+                        _excluded_sites_cache[campaign_id] = list(sites)
+                        results[campaign_id] = sites
+                        continue
+
+                    bad_indices = set()
+                    for error in result_errors:
+                        details = str(error.get('Details') or error.get('Message') or '')
+                        match = re.search(r'ExcludedSites\[(\d+)\]', details)
+                        if match:
+                            bad_indices.add(int(match.group(1)))
+
+                    if bad_indices:
+                        removed = [sites.pop(bad_index) for bad_index in sorted(bad_indices, reverse=True) if 0 <= bad_index < len(sites)]
+                        print(f'⚠️ Direct rejected {len(removed)} ExcludedSites items in campaign {campaign_id} on attempt {update_attempt}: {removed}')
+                        if sites:
+                            retry[campaign_id] = sites
+                            continue
+
+                    print(f'❌ Campaign {campaign_id} update errors: {json.dumps(result_errors, ensure_ascii=False)}')
+                    results[campaign_id] = None
+
+            pending = retry
+
+        for campaign_id in pending:
+            results[campaign_id] = None
+        return results
         
     except Exception as e:
         print(f'Error updating ExcludedSites: {str(e)}')
-        return False
+        for campaign_id in excluded_by_campaign:
+            results.setdefault(str(campaign_id), None)
+        return results
@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def block_worker(load_function):
+    return load_function('rsya-block-worker')
+
+
+@pytest.fixture
+def campaigns_update(block_worker, monkeypatch, fake_response):
+    '''Подмена campaigns.update: UpdateResults по очереди из replies, отправленные кампании — в sent.'''
+    monkeypatch.setattr(block_worker, '_excluded_sites_cache', {})
+    sent = []
+
+    def install(*replies):
+        replies = list(replies)
+
+        def post(token, payload):
+            campaigns = payload['params']['Campaigns']
+            sent.append([(str(c['Id']), list(c['ExcludedSites']['Items'])) for c in campaigns])
+            return fake_response({'result': {'UpdateResults': replies.pop(0)}})
+
+        monkeypatch.setattr(block_worker, 'post_direct_campaigns', post)
+        return sent
+    return install
+
+
+def test_update_excluded_sites_bulk_maps_results_by_position(block_worker, campaigns_update):
+    sent = campaigns_update(
+        [
+            {'Errors': [{'Details': 'ExcludedSites[0]: invalid'}, {'Details': 'ExcludedSites[2]: invalid'}]},
+            {'Id': 2},
+        ],
+        [{'Id': 1}],
+    )
+    results = block_worker.update_excluded_sites_bulk('token', {
+        '1': ['bad-1.ru', 'a.ru', 'bad-2.ru', 'b.ru'],
+        '2': ['c.ru'],
+    })
+    assert results == {'1': ['a.ru', 'b.ru'], '2': ['c.ru']}
+    assert sent[1] == [('1', ['a.ru', 'b.ru'])]
+    assert block_worker._excluded_sites_cache == {'1': ['a.ru', 'b.ru'], '2': ['c.ru']}
+
+
+def test_update_excluded_sites_bulk_fails_campaign_without_result(block_worker, campaigns_update):
+    campaigns_update([{'Id': 1}, {'Errors': [{'Code': 8800, 'Message': 'Campaign not found'}]}])
+    results = block_worker.update_excluded_sites_bulk('token', {'1': ['a.ru'], '2': ['b.ru'], '3': ['c.ru']})
+    assert results == {'1': ['a.ru'], '2': None, '3': None}
+    assert '2' not in block_worker._excluded_sites_cache
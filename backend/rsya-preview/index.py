@@ -8,11 +8,20 @@ from typing import Any, Dict, List, Optional
 import psycopg2
 import psycopg2.extras
 import requests
+from direct_client import build_http_session, direct_limiter_for_headers
+from direct_reports import iter_report_lines, parse_tsv_report
+from task_filter import CompiledTaskFilter, normalize_goal_ids, normalize_list
+
+
+http_session = build_http_session()
 
 
 SCHEMA = 't_p97630513_yandex_cleaning_serv'
-API_DELAY = 0.6
+
 PREVIEW_CAMPAIGN_LIMIT = 5
+# Общий реестр отчётов (rsya_report_registry): тот же запрос в пределах TTL переиспользует ReportName
+REPORT_REUSE_TTL_SEC = int(os.environ.get('RSYA_REPORT_REUSE_TTL_SEC', '1800'))  # Отчёт, включающий сегодня
+REPORT_REUSE_HISTORY_TTL_SEC = 6 * 3600  # Отчёт только за прошедшие дни
 
 IMPORTANT_PLATFORMS = {
     'yandex.ru', 'ya.ru', 'dzen.ru', 'kinopoisk.ru', 'mail.ru', 'vk.com', 'ok.ru',
@@ -36,103 +45,11 @@ def response(status: int, body: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def normalize_list(value, lower: bool = False) -> List[str]:
-    if not value:
-        return []
-    items = value.split(',') if isinstance(value, str) else value
-    result = [str(item).strip() for item in items if str(item).strip()]
-    return [item.lower() for item in result] if lower else result
-
-
-def normalize_goal_ids(config: Dict[str, Any]) -> List[str]:
-    goal_ids = normalize_list(config.get('goal_ids'))
-    if goal_ids:
-        return goal_ids[:10]
-
-    goal_id = str(config.get('goal_id') or '').strip()
-    if goal_id and goal_id not in ('all', 'selected'):
-        return [goal_id]
-
-    return []
-
-
 def is_important_platform(domain: str) -> bool:
     domain = (domain or '').lower().strip()
     return any(domain == important or domain.endswith('.' + important) for important in IMPORTANT_PLATFORMS)
 
 
-def platform_conversions_for_config(platform: Dict[str, Any], config: Dict[str, Any]) -> int:
-    goal_ids = normalize_goal_ids(config)
-    if not goal_ids:
-        return int(platform.get('conversions', 0) or 0)
-
-    goal_conversions = platform.get('goal_conversions') or {}
-    if goal_conversions:
-        return int(sum(goal_conversions.get(str(goal_id), 0) or 0 for goal_id in goal_ids))
-
-    return int(platform.get('conversions', 0) or 0)
-
-
-def platform_cpa_for_config(platform: Dict[str, Any], config: Dict[str, Any]) -> float:
-    conversions = platform_conversions_for_config(platform, config)
-    if conversions <= 0:
-        return 0
-    return float(platform.get('cost', 0) or 0) / conversions
-
-
-def domain_matches_keyword(domain: str, keyword: str) -> bool:
-    if '.' in keyword:
-        if keyword.endswith('.') and not keyword.startswith('.'):
-            return domain.startswith(keyword)
-        if keyword.startswith('.') and not keyword.endswith('.'):
-            return domain.endswith(keyword)
-        return keyword in domain
-    return keyword in domain
-
-
-def matches_task_filters(platform: Dict[str, Any], config: Dict[str, Any], combine_operator: str = 'AND') -> bool:
-    domain = platform['domain'].lower()
-    combine_operator = (combine_operator or config.get('combine_operator') or 'AND').upper()
-
-    exceptions = normalize_list(config.get('exceptions', []), lower=True)
-    if exceptions and any(exc in domain for exc in exceptions):
-        return False
-
-    if (config.get('protect_conversions') or normalize_goal_ids(config)) and platform_conversions_for_config(platform, config) > 0:
-        return False
-
-    conditions = []
-    keywords = normalize_list(config.get('keywords', []), lower=True)
-    if keywords:
-        conditions.append(any(domain_matches_keyword(domain, keyword) for keyword in keywords))
-
-    metric_rules = [
-        ('min_impressions', lambda value: platform.get('impressions', 0) >= value),
-        ('max_impressions', lambda value: platform.get('impressions', 0) <= value),
-        ('min_clicks', lambda value: platform.get('clicks', 0) >= value),
-        ('max_clicks', lambda value: platform.get('clicks', 0) <= value),
-        ('min_cpc', lambda value: platform.get('cpc', 0) >= value),
-        ('max_cpc', lambda value: platform.get('cpc', 0) <= value),
-        ('min_ctr', lambda value: platform.get('ctr', 0) >= value),
-        ('max_ctr', lambda value: platform.get('ctr', 0) <= value),
-        ('min_conversions', lambda value: platform_conversions_for_config(platform, config) >= value),
-        ('min_cpa', lambda value: platform_cpa_for_config(platform, config) >= value),
-        ('max_cpa', lambda value: platform_cpa_for_config(platform, config) <= value),
-    ]
-
-    for key, predicate in metric_rules:
-        value = config.get(key)
-        if value is not None:
-            conditions.append(predicate(float(value)))
-
-    if not conditions:
-        return False
-
-    if combine_operator == 'OR':
-        return any(conditions)
-    return all(conditions)
-
-
 def validate_task_config(config: Dict[str, Any], combine_operator: str) -> List[str]:
     config = config or {}
     combine_operator = (combine_operator or 'OR').upper()
@@ -168,7 +85,73 @@ def validate_task_config(config: Dict[str, Any], combine_operator: str) -> List[
     return reasons[:3]
 
 
-def create_report(campaign_id: str, yandex_token: str, client_login: str, date_from: str, date_to: str, goal_ids: Optional[List[str]]) -> Dict[str, Any]:
+def report_request_hash(headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''Канонический ключ отчёта: параметры без ReportName, заголовки формата и аккаунт (Client-Login, иначе токен).'''
+    account = headers.get('Client-Login') or hashlib.sha256(headers.get('Authorization', '').encode('utf-8')).hexdigest()
+    canonical = {
+        'account': account,
+        'headers': {key: value for key, value in headers.items() if key not in ('Authorization', 'Client-Login', 'Accept-Language')},
+        'params': {key: value for key, value in params.items() if key != 'ReportName'},
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def registry_report_name(cursor, prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''
+    ReportName из общего реестра rsya_report_registry: одинаковый запрос (тот же хэш) в пределах TTL
+    получает то же имя — Директ отдаёт уже заказанный или готовый отчёт, а не ставит новый в очередь.
+    Изменения в реестре коммитит вызывающий код; при ошибке реестра — новое имя с меткой времени.
+    '''
+    report_hash = report_request_hash(headers, params)
+    report_name = f'{prefix}_{report_hash[:16]}_{int(time.time())}'
+    date_to = (params.get('SelectionCriteria') or {}).get('DateTo') or ''
+    # Отчёт только за прошедшие дни не меняется — его можно переиспользовать дольше
+    ttl = REPORT_REUSE_HISTORY_TTL_SEC if date_to and date_to < datetime.now().strftime('%Y-%m-%d') else REPORT_REUSE_TTL_SEC
+    try:
+        cursor.execute("SAVEPOINT report_registry")
+        cursor.execute("""
+            INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_report_registry AS r
+                (report_hash, report_name, request_headers, request_params, created_at, last_used_at)
+            VALUES (%s, %s, %s, %s, NOW(), NOW())
+            ON CONFLICT (report_hash) DO UPDATE SET
+                report_name = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                   THEN EXCLUDED.report_name ELSE r.report_name END,
+                request_params = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                      THEN EXCLUDED.request_params ELSE r.request_params END,
+                created_at = CASE WHEN r.created_at < NOW() - make_interval(secs => %s)
+                                  THEN NOW() ELSE r.created_at END,
+                last_used_at = NOW()
+            RETURNING report_name
+        """, (
+            report_hash,
+            report_name,
+            json.dumps({key: value for key, value in headers.items() if key != 'Authorization'}),
+            json.dumps({**params, 'ReportName': report_name}, ensure_ascii=False),
+            ttl,
+            ttl,
+            ttl,
+        ))
+        row = cursor.fetchone()
+        cursor.execute("RELEASE SAVEPOINT report_registry")
+        return (row['report_name'] if isinstance(row, dict) else row[0]) or report_name
+    except Exception as e:
+        print(f"⚠️ Report registry unavailable, using a fresh report name: {e}")
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT report_registry")
+        except Exception:
+            pass
+        return report_name
+
+
+def create_report(
+    campaign_id: str,
+    yandex_token: str,
+    client_login: str,
+    date_from: str,
+    date_to: str,
+    goal_ids: Optional[List[str]],
+    cursor=None,
+) -> Dict[str, Any]:
     normalized_goal_ids = [str(goal_id).strip() for goal_id in (goal_ids or []) if str(goal_id).strip()][:10]
     goal_suffix = ''
     if normalized_goal_ids:
@@ -197,28 +180,36 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
         payload['params']['Goals'] = normalized_goal_ids
         payload['params']['AttributionModels'] = ['AUTO']
 
-    try:
-        headers = {
-            'Authorization': f'Bearer {yandex_token}',
-            'Accept-Language': 'ru',
-            'processingMode': 'auto',
-            'returnMoneyInMicros': 'false',
-            'skipReportHeader': 'true',
-            'skipReportSummary': 'true',
-        }
-        if client_login:
-            headers['Client-Login'] = client_login
+    headers = {
+        'Authorization': f'Bearer {yandex_token}',
+        'Accept-Language': 'ru',
+        'processingMode': 'auto',
+        'returnMoneyInMicros': 'false',
+        'skipReportHeader': 'true',
+        'skipReportSummary': 'true',
+    }
+    if client_login:
+        headers['Client-Login'] = client_login
+    if cursor is not None:
+        # Превью и batch worker строят одинаковый отчёт по кампании — подключаемся к уже заказанному
+        payload['params']['ReportName'] = registry_report_name(cursor, 'preview', headers, payload['params'])
+        cursor.connection.commit()
 
-        resp = requests.post(
+    try:
+        limiter = direct_limiter_for_headers(headers)
+        limiter.acquire()
+        resp = http_session.post(
             'https://api.direct.yandex.com/json/v5/reports',
             headers=headers,
             json=payload,
             timeout=30,
+            stream=True,
         )
-        time.sleep(API_DELAY)
+        limiter.observe(resp)
         if resp.status_code == 200:
-            return {'status': 200, 'data': resp.text}
+            return {'status': 200, 'lines': iter_report_lines(resp)}
         if resp.status_code in (201, 202):
+            resp.close()
             return {'status': resp.status_code, 'report_name': payload['params']['ReportName']}
         return {'status': resp.status_code, 'error': resp.text[:1000]}
     except requests.exceptions.Timeout:
@@ -227,61 +218,15 @@ def create_report(campaign_id: str, yandex_token: str, client_login: str, date_f
         return {'status': 500, 'error': str(exc)}
 
 
-def parse_tsv_report(tsv_data: str) -> List[Dict[str, Any]]:
-    lines = tsv_data.strip().split('\n')
-    if len(lines) < 2:
-        return []
-
-    header = lines[0].split('\t')
-    platforms = []
-    for line in lines[1:]:
-        parts = line.split('\t')
-        if len(parts) < len(header):
-            continue
-        row = dict(zip(header, parts))
-        domain = (row.get('Placement') or parts[0]).strip().lower()
-        if not domain or ' ' in domain:
-            continue
-
-        goal_conversions = {}
-        for key, value in row.items():
-            if not key.startswith('Conversions_'):
-                continue
-            key_parts = key.split('_')
-            if len(key_parts) >= 3:
-                goal_id = key_parts[1]
-                goal_conversions[goal_id] = goal_conversions.get(goal_id, 0) + int(float(value or 0))
-
-        conversions = int(float(row.get('Conversions') or 0))
-        if goal_conversions:
-            conversions = sum(goal_conversions.values())
-        clicks = int(float(row.get('Clicks') or 0))
-        cost = float(row.get('Cost') or 0)
-        impressions = int(float(row.get('Impressions') or 0))
-
-        platforms.append({
-            'domain': domain,
-            'clicks': clicks,
-            'cost': cost,
-            'conversions': conversions,
-            'goal_conversions': goal_conversions,
-            'impressions': impressions,
-            'cpc': cost / clicks if clicks else 0,
-            'cpa': cost / conversions if conversions else 0,
-            'ctr': clicks / impressions * 100 if impressions else 0,
-            'important': is_important_platform(domain),
-        })
-
-    return platforms
-
-
 def get_excluded_sites(token: str, campaign_id: str, client_login: str = '') -> Optional[List[str]]:
     try:
         headers = {'Authorization': f'Bearer {token}', 'Accept-Language': 'ru'}
         if client_login:
             headers['Client-Login'] = client_login
 
-        resp = requests.post(
+        limiter = direct_limiter_for_headers(headers)
+        limiter.acquire()
+        resp = http_session.post(
             'https://api.direct.yandex.com/json/v5/campaigns',
             json={
                 'method': 'get',
@@ -293,7 +238,7 @@ def get_excluded_sites(token: str, campaign_id: str, client_login: str = '') ->
             headers=headers,
             timeout=30,
         )
-        time.sleep(API_DELAY)
+        limiter.observe(resp)
         if resp.status_code != 200:
             return None
         campaigns = resp.json().get('result', {}).get('Campaigns', [])
@@ -384,6 +329,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     date_to = datetime.now().strftime('%Y-%m-%d')
     date_from = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
     goal_ids = normalize_goal_ids(config)
+    task_filter = CompiledTaskFilter(config, combine_operator)
 
     will_block = []
     already_blocked = []
@@ -393,8 +339,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     checked = 0
     matched = 0
 
+    # Соединение для реестра отчётов: без него отчёты заказываются как раньше, с новыми именами
+    registry_conn = None
+    registry_cur = None
+    try:
+        registry_conn = psycopg2.connect(dsn)
+        registry_cur = registry_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    except Exception as exc:
+        print(f'⚠️ Report registry connection failed: {exc}')
+
     for campaign_id in selected_campaign_ids:
-        report = create_report(campaign_id, project['yandex_token'], client_login, date_from, date_to, goal_ids)
+        report = create_report(
+            campaign_id, project['yandex_token'], client_login, date_from, date_to, goal_ids, registry_cur
+        )
         if report['status'] in (201, 202):
             reports_pending.append({'campaign_id': campaign_id, 'report_name': report.get('report_name')})
             continue
@@ -405,18 +362,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         excluded = get_excluded_sites(project['yandex_token'], campaign_id, client_login)
         excluded_set = set(excluded or [])
 
-        for platform in parse_tsv_report(report['data']):
-            checked += 1
-            is_match = matches_task_filters(platform, config, combine_operator)
-            if is_match:
-                matched += 1
-                if platform['domain'] in excluded_set:
-                    if len(already_blocked) < 30:
-                        already_blocked.append(platform_view(platform, campaign_id, True))
-                elif len(will_block) < 50:
-                    will_block.append(platform_view(platform, campaign_id, False))
-            elif len(kept_examples) < 50:
-                kept_examples.append(platform_view(platform, campaign_id, platform['domain'] in excluded_set))
+        try:
+            for platform in parse_tsv_report(report['lines'], lower_domains=True):
+                platform['important'] = is_important_platform(platform['domain'])
+                checked += 1
+                is_match = task_filter.matches(platform)
+                if is_match:
+                    matched += 1
+                    if platform['domain'] in excluded_set:
+                        if len(already_blocked) < 30:
+                            already_blocked.append(platform_view(platform, campaign_id, True))
+                    elif len(will_block) < 50:
+                        will_block.append(platform_view(platform, campaign_id, False))
+                elif len(kept_examples) < 50:
+                    kept_examples.append(platform_view(platform, campaign_id, platform['domain'] in excluded_set))
+        except requests.RequestException as exc:
+            # Обрыв соединения посреди потока отчёта — кампания попадает в ошибки, уже прочитанное учтено
+            errors.append({'campaign_id': campaign_id, 'status': 500, 'error': f'Report stream interrupted: {exc}'})
+
+    if registry_conn is not None:
+        registry_conn.close()
 
     important_will_block = [item for item in will_block if item['important']]
     warnings = []
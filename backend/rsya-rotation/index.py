@@ -1,53 +1,15 @@
 import json
 import os
-import re
-from typing import Dict, Any, List
+from typing import Dict, Any
 import psycopg2
 import psycopg2.extras
-import requests
+from direct_client import build_http_session
 
-BATCH_SIZE = 20  # Обрабатываем 20 кампаний за раз
 
-def calculate_priority_score(item: Dict[str, Any]) -> float:
-    '''Расчет приоритета площадки для блокировки (больше = важнее заблокировать)'''
-    domain = item.get('domain', '').lower()
-    clicks = item.get('clicks', 0)
-    cost = item.get('cost', 0)
-    conversions = item.get('conversions', 0)
-    cpa = item.get('cpa', 0)
-    
-    score = 0.0
-    
-    # ВЫСОКИЙ ПРИОРИТЕТ: Подозрительные домены
-    suspicious_patterns = [
-        r'\.com$', r'dsp', r'vpn',
-        r'game|игр|казино|poker|casino',
-        r'adult|xxx|porn', r'download|торрент'
-    ]
-    
-    is_suspicious = any(re.search(pattern, domain) for pattern in suspicious_patterns)
-    
-    if is_suspicious:
-        score += 100
-        if cost > 100:
-            score += 50
-        if clicks > 50:
-            score += 30
-    
-    # СРЕДНИЙ ПРИОРИТЕТ: Бесполезный трафик
-    if cost > 0 and clicks > 10:
-        cpc = cost / clicks
-        if cpc < 5 and conversions == 0:
-            score += 60
-    
-    if cpa > 1000:
-        score += 70
-    
-    # Чем больше расход - тем выше приоритет
-    if cost > 0:
-        score += min(cost / 10, 50)
-    
-    return score
+http_session = build_http_session()
+
+
+BATCH_SIZE = 20  # Обрабатываем 20 кампаний за раз
 
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -242,7 +204,7 @@ def rotate_campaign_if_needed(token: str, campaign_id: int, project_id: int, cur
         }
     }
     
-    response = requests.post(
+    response = http_session.post(
         'https://api.direct.yandex.com/json/v5/campaigns',
         headers=headers,
         json=get_body,
@@ -271,41 +233,41 @@ def rotate_campaign_if_needed(token: str, campaign_id: int, project_id: int, cur
     
     print(f'🔄 Campaign {campaign_id}: {len(current_excluded)}/1000 sites, starting rotation...')
     
-    # Получаем метрики для текущих площадок из БД
-    platforms_with_metrics = []
-    
-    for domain in current_excluded:
-        cursor.execute("""
-            SELECT domain, clicks, cost, conversions, cpa
-            FROM block_queue
-            WHERE campaign_id = %s AND domain = %s
-            ORDER BY created_at DESC
+    # Приоритет текущих площадок — одним запросом по самой свежей строке на домен: сохранённый priority_score,
+    # если он посчитан текущей версией формулы; иначе (старая версия или площадки нет в очереди)
+    # его досчитывает block_queue_priority_score, без метрик — только по домену
+    cursor.execute("""
+        SELECT d.domain,
+               COALESCE(m.clicks, 0) AS clicks,
+               COALESCE(m.cost, 0) AS cost,
+               COALESCE(m.conversions, 0) AS conversions,
+               COALESCE(m.cpa, 0) AS cpa,
+               CASE WHEN m.priority_version = t_p97630513_yandex_cleaning_serv.block_queue_priority_version()
+                    THEN m.priority_score
+                    ELSE t_p97630513_yandex_cleaning_serv.block_queue_priority_score(
+                        d.domain, m.clicks, m.cost, m.conversions, m.cpa)
+               END AS priority_score
+        FROM unnest(%s::text[]) WITH ORDINALITY AS d(domain, ord)
+        LEFT JOIN LATERAL (
+            SELECT bq.clicks, bq.cost, bq.conversions, bq.cpa, bq.priority_score, bq.priority_version
+            FROM block_queue bq
+            WHERE bq.campaign_id = %s AND bq.domain = d.domain
+            ORDER BY bq.created_at DESC
             LIMIT 1
-        """, (campaign_id, domain))
-        
-        row = cursor.fetchone()
-        
-        if row:
-            platforms_with_metrics.append({
-                'domain': domain,
-                'clicks': row['clicks'] or 0,
-                'cost': float(row['cost']) if row['cost'] else 0,
-                'conversions': row['conversions'] or 0,
-                'cpa': float(row['cpa']) if row['cpa'] else 0
-            })
-        else:
-            # Если нет метрик в БД - даем минимальный приоритет
-            platforms_with_metrics.append({
-                'domain': domain,
-                'clicks': 0,
-                'cost': 0,
-                'conversions': 0,
-                'cpa': 0
-            })
-    
-    # Рассчитываем приоритет для каждой площадки
-    for platform in platforms_with_metrics:
-        platform['priority_score'] = calculate_priority_score(platform)
+        ) m ON TRUE
+        ORDER BY d.ord
+    """, (list(current_excluded), campaign_id))
+    platforms_with_metrics = [
+        {
+            'domain': row['domain'],
+            'clicks': row['clicks'],
+            'cost': float(row['cost']),
+            'conversions': row['conversions'],
+            'cpa': float(row['cpa']),
+            'priority_score': float(row['priority_score'])
+        }
+        for row in cursor.fetchall()
+    ]
     
     # Сортируем по приоритету (низкий приоритет = первые на удаление)
     platforms_with_metrics.sort(key=lambda x: x['priority_score'])
@@ -333,7 +295,7 @@ def rotate_campaign_if_needed(token: str, campaign_id: int, project_id: int, cur
         }
     }
     
-    update_response = requests.post(
+    update_response = http_session.post(
         'https://api.direct.yandex.com/json/v5/campaigns',
         headers=headers,
         json=update_body,
@@ -345,11 +307,11 @@ def rotate_campaign_if_needed(token: str, campaign_id: int, project_id: int, cur
         return {'campaign_id': campaign_id, 'rotated': False, 'error': 'Failed to update campaign'}
     
     # Удаляем из block_queue записи для удаленных площадок
-    for platform in platforms_to_remove:
+    if platforms_to_remove:
         cursor.execute("""
             DELETE FROM block_queue
-            WHERE campaign_id = %s AND domain = %s
-        """, (campaign_id, platform['domain']))
+            WHERE campaign_id = %s AND domain = ANY(%s)
+        """, (campaign_id, [p['domain'] for p in platforms_to_remove]))
     
     print(f'✅ Campaign {campaign_id}: rotated {remove_count} platforms, {len(new_excluded)} remain')
     
@@ -1,18 +1,50 @@
+import hashlib
 import json
 import os
-from typing import Dict, Any, List
-from datetime import datetime, timedelta
+import time
+from typing import Dict, Any, List, Optional
+from datetime import datetime
 import psycopg2
 import psycopg2.extras
 import boto3
 import requests
+from direct_client import build_http_session
+
+
+http_session = build_http_session()
+
 
 # Константы для расчёта батчей
 AVG_TIME_PER_CAMPAIGN = 7  # секунд на обработку 1 кампании (по факту ~6-7 сек)
 SAFE_TIMEOUT = 25  # 25 сек (Cloud Function timeout 30 сек с запасом)
-BATCH_SIZE = int(os.environ.get('RSYA_CAMPAIGN_BATCH_SIZE', '7'))
+BATCH_TIME_MARGIN_SEC = 5  # Запас внутри SAFE_TIMEOUT: ошибка оценки стоимости, запись результатов батча
+# Бюджет времени одного батча: кампании раскладываются по батчам по оценке их стоимости из истории,
+# батч должен уложиться в один вызов воркера
+BATCH_TIME_BUDGET_SEC = int(os.environ.get('RSYA_BATCH_TIME_BUDGET_SEC', str(SAFE_TIMEOUT - BATCH_TIME_MARGIN_SEC)))
+MAX_CAMPAIGNS_PER_BATCH = int(os.environ.get('RSYA_MAX_CAMPAIGNS_PER_BATCH', '30'))
+MIN_CAMPAIGN_COST_SEC = 1.0
+PLACEMENTS_PER_COST_UNIT = 1000  # +1 к весу кампании за каждую 1000 площадок в отчёте
+BLOCKED_PER_COST_UNIT = 200  # +1 к весу за каждые 200 заблокированных площадок
+COST_HISTORY_DAYS = 3
+RUN_RETENTION_DAYS = int(os.environ.get('RSYA_RUN_RETENTION_DAYS', '14'))  # Сколько хранить прошлые запуски и их батчи
 SCHEDULER_PROJECT_LIMIT = int(os.environ.get('RSYA_SCHEDULER_PROJECT_LIMIT', '50'))
 SCHEDULER_FORCE_PROJECT_LIMIT = int(os.environ.get('RSYA_SCHEDULER_FORCE_PROJECT_LIMIT', '100'))
+DIRECT_UNITS_RESERVE = 0.05  # Остаток баллов ниже 5% суточного лимита — проект ждёт восстановления бюджета
+DIRECT_BUDGET_TTL_MINUTES = 60  # Баллы Директа восстанавливаются в течение суток: старый снимок бюджета не учитываем
+# Fair share: из просроченных проектов берём в FAIR_SHARE_CANDIDATE_FACTOR раз больше лимита,
+# чередуем по пользователям и не запускаем токен / пользователя сверх лимита активных батчей
+FAIR_SHARE_CANDIDATE_FACTOR = 4
+TOKEN_MAX_ACTIVE_BATCHES = int(os.environ.get('RSYA_TOKEN_MAX_ACTIVE_BATCHES', '40'))
+USER_MAX_ACTIVE_BATCHES = int(os.environ.get('RSYA_USER_MAX_ACTIVE_BATCHES', '60'))
+CAMPAIGNS_GET_CHUNK = 1000  # Лимит Ids в SelectionCriteria campaigns.get
+CATALOG_FULL_REFRESH_HOURS = int(os.environ.get('RSYA_CATALOG_FULL_REFRESH_HOURS', '24'))  # Полная выгрузка кампаний — не чаще
+# Кампания без новой статистики пропускается в плановом запуске, но не дольше этого срока:
+# окно отчёта «7 дней» сдвигается, и правила по метрикам дают другой результат без новых показов
+DIRTY_MAX_SKIP_HOURS = int(os.environ.get('RSYA_DIRTY_MAX_SKIP_HOURS', '24'))
+DIRTY_CHANGES = {'STAT', 'SELF'}  # ChangesIn Changes.checkCampaigns, после которых кампанию нужно перечистить
+MQ_QUEUE_URL = 'https://message-queue.api.cloud.yandex.net/b1gga4kkbv0csaelq94p/dj60000000b1egur05em/rsyacleaner'
+MQ_BATCH_LIMIT = 10  # Лимит записей в одном send_message_batch
+MQ_SEND_RETRIES = 3
 VALID_PROJECT_FILTER = """
                   AND p.is_configured = TRUE
                   AND p.campaign_ids IS NOT NULL
@@ -58,6 +90,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     # Проверяем параметры
     params = event.get('queryStringParameters') or {}
     force_all = params.get('force_all') == 'true'
+    # Тёплый контейнер: неотправленные сообщения прошлого (упавшего) вызова не досылаем
+    _mq_buffer.clear()
     target_project_id = params.get('project_id')
     
     try:
@@ -75,6 +109,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     s.id as schedule_id,
                     s.project_id,
                     s.interval_hours,
+                    s.weight,
+                    p.user_id,
                     p.yandex_token,
                     p.campaign_ids,
                     p.client_login,
@@ -93,6 +129,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     s.id as schedule_id,
                     s.project_id,
                     s.interval_hours,
+                    s.weight,
+                    p.user_id,
                     p.yandex_token,
                     p.campaign_ids,
                     p.client_login,
@@ -112,6 +150,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     s.id as schedule_id,
                     s.project_id,
                     s.interval_hours,
+                    s.weight,
+                    p.user_id,
                     p.yandex_token,
                     p.campaign_ids,
                     p.client_login,
@@ -124,7 +164,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                   {valid_project_filter}
                 ORDER BY s.next_run_at
                 LIMIT %s
-            """.format(valid_project_filter=VALID_PROJECT_FILTER), (SCHEDULER_PROJECT_LIMIT,))
+            """.format(valid_project_filter=VALID_PROJECT_FILTER), (SCHEDULER_PROJECT_LIMIT * FAIR_SHARE_CANDIDATE_FACTOR,))
         
         projects = cursor.fetchall()
         print(f"📊 Found {len(projects)} projects to schedule")
@@ -143,11 +183,55 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         total_batches = 0
         results = []
+        # Ручной запуск конкретного проекта бюджет не проверяет
+        exhausted_budgets = set() if target_project_id else load_exhausted_direct_budgets(projects, cursor, conn)
         
-        for project in projects:
+        # Плановый запуск — fair share между пользователями и токенами; ручной и force_all — как раньше
+        fair_share = not target_project_id and not force_all
+        if fair_share:
+            projects = order_projects_fairly(projects)
+            active_by_token, active_by_user = load_active_batch_counts(cursor)
+        scheduled_projects = 0
+        deferred_projects = 0
+        
+        for index, project in enumerate(projects):
+            if fair_share and scheduled_projects >= SCHEDULER_PROJECT_LIMIT:
+                # Остальные проекты ждут следующего запуска планировщика
+                deferred_projects += len(projects) - index
+                break
+            budget_key = direct_budget_key(project['yandex_token'], project.get('client_login'))
+            token_hash = budget_key[0]
+            if fair_share and (
+                active_by_token.get(token_hash, 0) >= TOKEN_MAX_ACTIVE_BATCHES
+                or active_by_user.get(project.get('user_id'), 0) >= USER_MAX_ACTIVE_BATCHES
+            ):
+                # Токен или пользователь уже занял свою долю очереди — ждёт следующего запуска
+                print(f"⚖️ Project {project['project_id']}: token/user active batch cap reached, deferred")
+                deferred_projects += 1
+                results.append({
+                    'project_id': project['project_id'],
+                    'status': 'deferred',
+                    'reason': 'fair_share_cap'
+                })
+                continue
+            if budget_key in exhausted_budgets:
+                # next_run_at не двигаем — проект попадёт в следующий запуск планировщика
+                print(f"💤 Project {project['project_id']}: Direct units exhausted or cooling down, deferred")
+                deferred_projects += 1
+                results.append({
+                    'project_id': project['project_id'],
+                    'status': 'deferred',
+                    'reason': 'direct_budget_exhausted'
+                })
+                continue
+            # Проект планируется в своей точке сохранения: ошибка откатывает только его батчи и запуск,
+            # а его сообщения снимаются из буфера MQ — иначе воркер получит батчи, которых нет в БД
+            mq_mark = len(_mq_buffer)
             try:
-                batches_created = schedule_project(project, cursor, conn, context, force_all=force_all)
-                total_batches += batches_created
+                cursor.execute("SAVEPOINT schedule_project")
+                batches_created = schedule_project(
+                    project, cursor, conn, context, force_all=force_all, skip_unchanged=fair_share
+                )
                 
                 # Обновляем next_run_at
                 cursor.execute("""
@@ -157,6 +241,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         updated_at = NOW()
                     WHERE id = %s
                 """, (project['interval_hours'], project['schedule_id']))
+                cursor.execute("RELEASE SAVEPOINT schedule_project")
+                
+                total_batches += batches_created
+                scheduled_projects += 1
+                if fair_share:
+                    active_by_token[token_hash] = active_by_token.get(token_hash, 0) + batches_created
+                    active_by_user[project.get('user_id')] = active_by_user.get(project.get('user_id'), 0) + batches_created
                 
                 results.append({
                     'project_id': project['project_id'],
@@ -166,25 +257,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
             except Exception as e:
                 print(f"❌ Error scheduling project {project['project_id']}: {str(e)}")
+                cursor.execute("ROLLBACK TO SAVEPOINT schedule_project")
+                del _mq_buffer[mq_mark:]
                 results.append({
                     'project_id': project['project_id'],
                     'status': 'error',
                     'error': str(e)
                 })
         
+        # Батчи не удаляются при каждом запуске — старые запуски чистятся раз в тик по сроку хранения
+        prune_old_runs(cursor)
         conn.commit()
         cursor.close()
         conn.close()
+
+        # В MQ — только после commit, чтобы воркер нашёл батч в статусе pending.
+        # Не отправленные батчи остаются pending и подхватываются DB fallback воркера.
+        try:
+            mq_stats = flush_mq()
+        except Exception as e:
+            print(f"❌ MQ publish failed: {str(e)}")
+            mq_stats = {'sent': 0, 'failed': total_batches}
         
-        print(f"✅ Scheduled {len(projects)} projects, {total_batches} batches total")
+        print(f"✅ Scheduled {scheduled_projects} projects ({deferred_projects} deferred), {total_batches} batches total")
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'scheduled_projects': len(projects),
+                'scheduled_projects': scheduled_projects,
+                'deferred_projects': deferred_projects,
                 'total_batches': total_batches,
+                'mq_sent': mq_stats['sent'],
+                'mq_failed': mq_stats['failed'],
                 'results': results
             })
         }
@@ -201,9 +307,80 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
 
 
-def schedule_project(project: Dict[str, Any], cursor, conn, context: Any, force_all: bool = False) -> int:
+def direct_budget_key(yandex_token: str, client_login: Any) -> tuple:
+    return (hashlib.sha256(yandex_token.encode('utf-8')).hexdigest(), (client_login or '').strip())
+
+
+def load_exhausted_direct_budgets(projects: List[Dict[str, Any]], cursor, conn) -> set:
+    '''
+    Токены (token_hash, client_login), по которым Директ недавно сообщил об исчерпании баллов
+    или которые ещё в паузе после 429 (rsya_direct_api_budget пишет rsya-batch-worker).
+    '''
+    token_hashes = list({direct_budget_key(p['yandex_token'], p.get('client_login'))[0] for p in projects})
+    try:
+        cursor.execute("""
+            SELECT token_hash, client_login
+            FROM t_p97630513_yandex_cleaning_serv.rsya_direct_api_budget
+            WHERE token_hash = ANY(%s)
+              AND (
+                  cooldown_until > NOW()
+                  OR (
+                      units_daily > 0
+                      AND units_available < units_daily * %s
+                      AND updated_at > NOW() - make_interval(mins => %s)
+                  )
+              )
+        """, (token_hashes, DIRECT_UNITS_RESERVE, DIRECT_BUDGET_TTL_MINUTES))
+        return {(row['token_hash'], row['client_login']) for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"⚠️ Failed to load Direct budgets: {e}")
+        conn.rollback()
+        return set()
+
+
+def order_projects_fairly(projects: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Чередует проекты по пользователям: сначала первый просроченный проект каждого пользователя,
+    затем второй и т.д. (внутри — по next_run_at, как пришли из SELECT).
+    '''
+    rank_by_user: Dict[Any, int] = {}
+    ranked = []
+    for position, project in enumerate(projects):
+        rank = rank_by_user.get(project.get('user_id'), 0)
+        rank_by_user[project.get('user_id')] = rank + 1
+        ranked.append((rank, position, project))
+    return [project for _, _, project in sorted(ranked, key=lambda item: (item[0], item[1]))]
+
+
+def load_active_batch_counts(cursor) -> tuple:
+    '''Число pending/processing батчей по token_hash и по user_id.'''
+    cursor.execute("""
+        SELECT token_hash, user_id, COUNT(*) AS active
+        FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+        WHERE status IN ('pending', 'processing')
+        GROUP BY token_hash, user_id
+    """)
+    by_token: Dict[str, int] = {}
+    by_user: Dict[Any, int] = {}
+    for row in cursor.fetchall():
+        if row['token_hash']:
+            by_token[row['token_hash']] = by_token.get(row['token_hash'], 0) + row['active']
+        if row['user_id'] is not None:
+            by_user[row['user_id']] = by_user.get(row['user_id'], 0) + row['active']
+    return by_token, by_user
+
+
+def schedule_project(
+    project: Dict[str, Any],
+    cursor,
+    conn,
+    context: Any,
+    force_all: bool = False,
+    skip_unchanged: bool = False
+) -> int:
     '''
     Создаёт батчи кампаний для проекта и отправляет в Message Queue
+    skip_unchanged — плановый запуск: в батчи идут только кампании с новой статистикой (select_dirty_campaigns)
     Returns: количество созданных батчей
     '''
     project_id = project['project_id']
@@ -220,62 +397,92 @@ def schedule_project(project: Dict[str, Any], cursor, conn, context: Any, force_
     if not campaign_ids:
         print(f"⚠️ Project {project_id} has no campaigns")
         return 0
-    
-    if force_all:
-        cursor.execute("""
-            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-            WHERE project_id = %s
-        """, (project_id,))
-        print(f"🗑️ Project {project_id}: cleared existing batches (force_all)")
-    else:
-        # Не создаём новые батчи, если есть свежие (последние 5 минут)
+
+    if not force_all:
+        # Не создаём новый запуск, если предыдущий создан только что (последние 5 минут)
         cursor.execute("""
-            SELECT COUNT(*) as count 
-            FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches 
+            SELECT 1
+            FROM t_p97630513_yandex_cleaning_serv.rsya_project_runs
             WHERE project_id = %s AND created_at > NOW() - INTERVAL '5 minutes'
+            LIMIT 1
         """, (project_id,))
-        if cursor.fetchone()['count'] > 0:
-            print(f"⚠️ Project {project_id} already has batches in last 5 minutes, skipping")
+        if cursor.fetchone():
+            print(f"⚠️ Project {project_id} already has a run in last 5 minutes, skipping")
             return 0
-        # Удаляем ВСЕ батчи проекта, иначе при INSERT будет duplicate key
-        cursor.execute("""
-            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
-            WHERE project_id = %s
-        """, (project_id,))
-        if cursor.rowcount and cursor.rowcount > 0:
-            print(f"🗑️ Project {project_id}: cleared {cursor.rowcount} batches")
+
+    tasks_fingerprint = compute_tasks_fingerprint(project_id, cursor)
+    changes_timestamp = None
+    if skip_unchanged:
+        campaign_ids, changes_timestamp = select_dirty_campaigns(
+            project_id, campaign_ids, yandex_token, client_login, tasks_fingerprint, cursor
+        )
+        if not campaign_ids:
+            print(f"💤 Project {project_id}: no campaigns with new statistics since last run, nothing to schedule")
+            return 0
+    else:
+        changes_timestamp = fetch_changes_timestamp(yandex_token, client_login)
+
+    campaign_costs = estimate_campaign_costs(project_id, campaign_ids, cursor)
+    
+    # Незавершённые батчи прошлых запусков заменяет новый запуск; история батчей остаётся для оценки стоимости
+    superseded = supersede_active_runs(project_id, cursor)
+    if superseded:
+        print(f"♻️ Project {project_id}: superseded {superseded} unfinished batches of previous runs")
     
-    # Сбрасываем локи кампаний этого проекта, чтобы новый запуск не упирался в старые (от прошлого run/499)
-    if campaign_ids:
+    if force_all:
+        # Принудительный запуск сбрасывает и локи кампаний (от прошлого run/499); в остальных случаях
+        # acquire_campaign_lock сам перехватывает просроченные локи
         cursor.execute("""
             DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_locks
             WHERE campaign_id = ANY(%s)
         """, ([str(c) for c in campaign_ids],))
         if cursor.rowcount and cursor.rowcount > 0:
             print(f"🔓 Project {project_id}: cleared {cursor.rowcount} campaign locks")
-        conn.commit()
     
-    # Разбиваем на батчи
-    batches = []
-    for i in range(0, len(campaign_ids), BATCH_SIZE):
-        batch = campaign_ids[i:i + BATCH_SIZE]
-        batches.append(batch)
+    # Раскладываем кампании по батчам с учётом их стоимости
+    batches = pack_campaign_batches(campaign_ids, campaign_costs)
     
     total_batches = len(batches)
-    print(f"📦 Project {project_id}: {len(campaign_ids)} campaigns → {total_batches} batches")
+    run_type = 'force_all' if force_all else ('scheduled' if skip_unchanged else 'manual')
+    cursor.execute("""
+        INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_project_runs (project_id, run_type, total_batches, remaining_batches)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    """, (project_id, run_type, total_batches, total_batches))
+    run_id = cursor.fetchone()['id']
+    print(
+        f"📦 Project {project_id} run {run_id}: {len(campaign_ids)} campaigns → {total_batches} batches "
+        f"(~{sum(campaign_costs.values()):.0f}s estimated, budget {BATCH_TIME_BUDGET_SEC}s per batch)"
+    )
+    
+    # Виртуальное время завершения (WFQ): накопленная стоимость батчей проекта / вес проекта.
+    # MQ отправляет батчи всех проектов запуска по возрастанию emit_order — мелкие проекты не ждут крупные.
+    weight = max(1, int(project.get('weight') or 1))
+    token_hash = direct_budget_key(yandex_token, client_login)[0]
+    virtual_time = 0.0
     
     # Сохраняем батчи в БД
     for batch_number, batch_campaign_ids in enumerate(batches, start=1):
+        batch_cost = sum(campaign_costs.get(str(c), AVG_TIME_PER_CAMPAIGN) for c in batch_campaign_ids)
+        virtual_time += batch_cost / weight
         cursor.execute("""
             INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_campaign_batches 
-            (project_id, campaign_ids, batch_number, total_batches, status)
-            VALUES (%s, %s, %s, %s, 'pending')
+            (project_id, run_id, campaign_ids, batch_number, total_batches, status,
+             user_id, token_hash, estimated_cost_sec, emit_order, changes_timestamp, tasks_fingerprint)
+            VALUES (%s, %s, %s, %s, %s, 'pending', %s, %s, %s, %s, %s, %s)
             RETURNING id
         """, (
             project_id,
+            run_id,
             json.dumps(batch_campaign_ids),
             batch_number,
-            total_batches
+            total_batches,
+            project.get('user_id'),
+            token_hash,
+            round(batch_cost, 1),
+            virtual_time,
+            changes_timestamp,
+            tasks_fingerprint
         ))
         
         batch_id = cursor.fetchone()['id']
@@ -283,11 +490,15 @@ def schedule_project(project: Dict[str, Any], cursor, conn, context: Any, force_
         batch_data = {
             'batch_id': batch_id,
             'project_id': project_id,
+            'run_id': run_id,
             'campaign_ids': batch_campaign_ids,
             'yandex_token': yandex_token,
             'client_login': client_login,
             'batch_number': batch_number,
-            'total_batches': total_batches
+            'total_batches': total_batches,
+            'emit_order': virtual_time,
+            'changes_timestamp': changes_timestamp,
+            'tasks_fingerprint': tasks_fingerprint
         }
         
         # Отправляем в MQ — воркер вызовется триггером. HTTP с timeout=0.5 приводил к 499 (клиент рвал соединение → платформа отменяла вызов).
@@ -296,6 +507,200 @@ def schedule_project(project: Dict[str, Any], cursor, conn, context: Any, force_
     return total_batches
 
 
+def supersede_active_runs(project_id: int, cursor) -> int:
+    '''
+    Помечает pending/processing батчи прошлых запусков проекта как superseded (воркер их не заберёт,
+    а работающий воркер потеряет аренду), сами запуски — тоже superseded.
+    Returns: количество заменённых батчей
+    '''
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+        SET status = 'superseded',
+            lease_expires_at = NULL
+        WHERE project_id = %s
+          AND status IN ('pending', 'processing')
+    """, (project_id,))
+    superseded = cursor.rowcount or 0
+    cursor.execute("""
+        UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_runs
+        SET status = 'superseded',
+            completed_at = NOW()
+        WHERE project_id = %s
+          AND status = 'running'
+    """, (project_id,))
+    return superseded
+
+
+def prune_old_runs(cursor) -> None:
+    '''Удаляет запуски старше RUN_RETENTION_DAYS и их завершённые батчи (для оценки стоимости нужны последние COST_HISTORY_DAYS).'''
+    try:
+        cursor.execute("SAVEPOINT prune_runs")
+        cursor.execute("""
+            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+            WHERE created_at < NOW() - make_interval(days => %s)
+              AND status NOT IN ('pending', 'processing')
+        """, (RUN_RETENTION_DAYS,))
+        pruned_batches = cursor.rowcount or 0
+        cursor.execute("""
+            DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_project_runs
+            WHERE created_at < NOW() - make_interval(days => %s)
+              AND status <> 'running'
+        """, (RUN_RETENTION_DAYS,))
+        pruned_runs = cursor.rowcount or 0
+        cursor.execute("RELEASE SAVEPOINT prune_runs")
+        if pruned_runs or pruned_batches:
+            print(f"🧹 Pruned {pruned_runs} runs and {pruned_batches} batches older than {RUN_RETENTION_DAYS} days")
+    except Exception as e:
+        print(f"⚠️ Failed to prune old runs: {e}")
+        cursor.execute("ROLLBACK TO SAVEPOINT prune_runs")
+
+
+def compute_tasks_fingerprint(project_id: int, cursor) -> str:
+    '''Отпечаток включённых задач проекта: после правки правил кампании перечищаются без ожидания новой статистики.'''
+    cursor.execute("""
+        SELECT id, config::text AS config, combine_operator
+        FROM t_p97630513_yandex_cleaning_serv.rsya_tasks
+        WHERE project_id = %s AND enabled = TRUE
+        ORDER BY id
+    """, (project_id,))
+    tasks = [[row['id'], row['config'], row['combine_operator']] for row in cursor.fetchall()]
+    return hashlib.md5(json.dumps(tasks, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def fetch_changes_timestamp(yandex_token: str, client_login: str) -> Optional[str]:
+    '''Текущий Timestamp сервиса Changes (водяной знак батча); None — Директ недоступен, водяные знаки не пишутся.'''
+    try:
+        return _post_direct('changes', yandex_token, client_login, {
+            'method': 'checkDictionaries',
+            'params': {}
+        }).get('Timestamp')
+    except Exception as exc:
+        print(f"⚠️ Changes.checkDictionaries failed: {exc}")
+        return None
+
+
+def select_dirty_campaigns(
+    project_id: int,
+    campaign_ids: List[str],
+    yandex_token: str,
+    client_login: str,
+    tasks_fingerprint: str,
+    cursor
+) -> tuple:
+    '''
+    Pre-pass планового запуска: оставляет кампании, которые нужно чистить.
+    Чистая кампания — есть водяной знак (rsya_campaign_watermarks) не старше DIRTY_MAX_SKIP_HOURS,
+    задачи проекта с тех пор не менялись и Changes.checkCampaigns от её Timestamp не вернул STAT/SELF.
+    Returns: (кампании к обработке, текущий Timestamp Changes или None)
+    '''
+    cursor.execute("""
+        SELECT campaign_id, changes_timestamp
+        FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_watermarks
+        WHERE project_id = %s
+          AND campaign_id = ANY(%s)
+          AND tasks_fingerprint = %s
+          AND last_processed_at > NOW() - make_interval(hours => %s)
+    """, (project_id, [str(c) for c in campaign_ids], tasks_fingerprint, DIRTY_MAX_SKIP_HOURS))
+    watermarks = {str(row['campaign_id']): row['changes_timestamp'] for row in cursor.fetchall()}
+
+    if not watermarks:
+        return campaign_ids, fetch_changes_timestamp(yandex_token, client_login)
+
+    try:
+        # Timestamp в формате ISO 8601 UTC — строки сравниваются лексикографически
+        result = _post_direct('changes', yandex_token, client_login, {
+            'method': 'checkCampaigns',
+            'params': {'Timestamp': min(watermarks.values())}
+        })
+    except Exception as exc:
+        print(f"⚠️ Project {project_id}: Changes.checkCampaigns failed, scheduling all campaigns: {exc}")
+        return campaign_ids, fetch_changes_timestamp(yandex_token, client_login)
+
+    changed_ids = {
+        str(item['CampaignId'])
+        for item in (result.get('Campaigns') or [])
+        if DIRTY_CHANGES & set(item.get('ChangesIn') or [])
+    }
+    dirty_ids = [c for c in campaign_ids if str(c) not in watermarks or str(c) in changed_ids]
+    print(f"🧮 Project {project_id}: {len(dirty_ids)}/{len(campaign_ids)} campaigns changed since last run")
+    return dirty_ids, result.get('Timestamp')
+
+
+def estimate_campaign_costs(project_id: int, campaign_ids: List[str], cursor) -> Dict[str, float]:
+    '''
+    Оценка времени обработки кампаний (сек) по истории проекта.
+    Вес кампании — объём площадок и блокировок из rsya_cleaning_execution_logs,
+    processing_time_sec прошлых батчей делится между их кампаниями пропорционально весу.
+    Кампании без истории получают вес 1 и медианную скорость проекта (или AVG_TIME_PER_CAMPAIGN).
+    '''
+    weights = {str(campaign_id): 1.0 for campaign_id in campaign_ids}
+    cursor.execute("""
+        SELECT metadata->>'campaign_id' AS campaign_id,
+               MAX(placements_found) AS placements,
+               MAX(placements_blocked) AS blocked
+        FROM t_p97630513_yandex_cleaning_serv.rsya_cleaning_execution_logs
+        WHERE project_id = %s
+          AND execution_type = 'batch_worker'
+          AND started_at > NOW() - make_interval(days => %s)
+        GROUP BY metadata->>'campaign_id'
+    """, (project_id, COST_HISTORY_DAYS))
+    for row in cursor.fetchall():
+        campaign_id = str(row['campaign_id'] or '')
+        if campaign_id in weights:
+            weights[campaign_id] = (
+                1.0
+                + (row['placements'] or 0) / PLACEMENTS_PER_COST_UNIT
+                + (row['blocked'] or 0) / BLOCKED_PER_COST_UNIT
+            )
+
+    cursor.execute("""
+        SELECT campaign_ids, processing_time_sec
+        FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+        WHERE project_id = %s
+          AND status = 'completed'
+          AND processing_time_sec IS NOT NULL
+          AND completed_at > NOW() - make_interval(days => %s)
+        ORDER BY completed_at
+    """, (project_id, COST_HISTORY_DAYS))
+    shares = {}
+    rates = []
+    for row in cursor.fetchall():
+        batch_campaign_ids = parse_campaign_ids(row['campaign_ids'])
+        if not batch_campaign_ids:
+            continue
+        rate = row['processing_time_sec'] / sum(weights.get(campaign_id, 1.0) for campaign_id in batch_campaign_ids)
+        rates.append(rate)
+        for campaign_id in batch_campaign_ids:
+            if campaign_id in weights:
+                shares[campaign_id] = rate * weights[campaign_id]
+
+    default_rate = sorted(rates)[len(rates) // 2] if rates else AVG_TIME_PER_CAMPAIGN
+    return {
+        campaign_id: max(MIN_CAMPAIGN_COST_SEC, shares.get(campaign_id, default_rate * weight))
+        for campaign_id, weight in weights.items()
+    }
+
+
+def pack_campaign_batches(campaign_ids: List[str], campaign_costs: Dict[str, float]) -> List[List[str]]:
+    '''
+    First-fit decreasing: самые тяжёлые кампании первыми, каждая — в первый батч, где хватает
+    BATCH_TIME_BUDGET_SEC и места до MAX_CAMPAIGNS_PER_BATCH. Кампания тяжелее бюджета идёт отдельным батчем.
+    '''
+    batches: List[List[str]] = []
+    loads: List[float] = []
+    for campaign_id in sorted(campaign_ids, key=lambda c: campaign_costs.get(str(c), AVG_TIME_PER_CAMPAIGN), reverse=True):
+        cost = campaign_costs.get(str(campaign_id), AVG_TIME_PER_CAMPAIGN)
+        for index, load in enumerate(loads):
+            if load + cost <= BATCH_TIME_BUDGET_SEC and len(batches[index]) < MAX_CAMPAIGNS_PER_BATCH:
+                batches[index].append(campaign_id)
+                loads[index] += cost
+                break
+        else:
+            batches.append([campaign_id])
+            loads.append(cost)
+    return batches
+
+
 def parse_campaign_ids(raw_campaign_ids: Any) -> List[str]:
     '''Нормализует campaign_ids из БД и не даёт черновикам ломать scheduler.'''
     if raw_campaign_ids is None:
@@ -357,31 +762,20 @@ def is_network_enabled_campaign(campaign: Dict[str, Any]) -> bool:
     return bool(network_strategy and network_strategy != 'SERVING_OFF')
 
 
-def fetch_current_rsya_campaign_ids(yandex_token: str, client_login: str) -> List[str]:
+def _direct_headers(yandex_token: str, client_login: str) -> Dict[str, str]:
     headers = {
         'Authorization': f'Bearer {yandex_token}',
         'Accept-Language': 'ru'
     }
     if client_login:
         headers['Client-Login'] = client_login
+    return headers
 
-    payload = {
-        'method': 'get',
-        'params': {
-            'SelectionCriteria': {},
-            'FieldNames': ['Id', 'Name', 'Type', 'Status', 'State'],
-            'TextCampaignFieldNames': ['BiddingStrategy'],
-            'DynamicTextCampaignFieldNames': ['BiddingStrategy'],
-            'SmartCampaignFieldNames': ['BiddingStrategy'],
-            'UnifiedCampaignFieldNames': ['BiddingStrategy'],
-            'MobileAppCampaignFieldNames': ['BiddingStrategy'],
-            'CpmBannerCampaignFieldNames': ['BiddingStrategy']
-        }
-    }
 
-    response = requests.post(
-        'https://api.direct.yandex.com/json/v5/campaigns',
-        headers=headers,
+def _post_direct(service: str, yandex_token: str, client_login: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    response = http_session.post(
+        f'https://api.direct.yandex.com/json/v5/{service}',
+        headers=_direct_headers(yandex_token, client_login),
         json=payload,
         timeout=30
     )
@@ -389,18 +783,144 @@ def fetch_current_rsya_campaign_ids(yandex_token: str, client_login: str) -> Lis
     data = response.json()
     if data.get('error'):
         raise Exception(data['error'].get('error_detail') or data['error'].get('error_string') or 'Direct API error')
+    return data.get('result') or {}
 
-    campaigns = ((data.get('result') or {}).get('Campaigns') or [])
-    return [
-        str(campaign.get('Id')).strip()
-        for campaign in campaigns
-        if (
-            campaign.get('Id')
-            and is_network_enabled_campaign(campaign)
-            and campaign.get('Status') != 'DRAFT'
-            and campaign.get('State') == 'ON'
-        )
+
+def fetch_direct_campaigns(yandex_token: str, client_login: str, campaign_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    '''campaigns.get со стратегиями: весь аккаунт (campaign_ids=None) или только указанные кампании.'''
+    selections = [{}] if campaign_ids is None else [
+        {'Ids': [int(campaign_id) for campaign_id in campaign_ids[i:i + CAMPAIGNS_GET_CHUNK]]}
+        for i in range(0, len(campaign_ids), CAMPAIGNS_GET_CHUNK)
     ]
+    campaigns = []
+    for selection in selections:
+        result = _post_direct('campaigns', yandex_token, client_login, {
+            'method': 'get',
+            'params': {
+                'SelectionCriteria': selection,
+                'FieldNames': ['Id', 'Name', 'Type', 'Status', 'State'],
+                'TextCampaignFieldNames': ['BiddingStrategy'],
+                'DynamicTextCampaignFieldNames': ['BiddingStrategy'],
+                'SmartCampaignFieldNames': ['BiddingStrategy'],
+                'UnifiedCampaignFieldNames': ['BiddingStrategy'],
+                'MobileAppCampaignFieldNames': ['BiddingStrategy'],
+                'CpmBannerCampaignFieldNames': ['BiddingStrategy']
+            }
+        })
+        campaigns.extend(result.get('Campaigns') or [])
+    return campaigns
+
+
+def _catalog_row(token_hash: str, client_login: str, campaign: Dict[str, Any]) -> tuple:
+    return (
+        token_hash,
+        client_login,
+        int(campaign['Id']),
+        campaign.get('Name'),
+        campaign.get('Type'),
+        campaign.get('Status'),
+        campaign.get('State'),
+        is_network_enabled_campaign(campaign),
+    )
+
+
+def _upsert_catalog(cursor, rows: List[tuple]) -> None:
+    if not rows:
+        return
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog
+            (token_hash, client_login, campaign_id, name, type, status, state, network_enabled, updated_at)
+        VALUES %s
+        ON CONFLICT (token_hash, client_login, campaign_id) DO UPDATE SET
+            name = EXCLUDED.name,
+            type = EXCLUDED.type,
+            status = EXCLUDED.status,
+            state = EXCLUDED.state,
+            network_enabled = EXCLUDED.network_enabled,
+            updated_at = NOW()
+    """, rows, template='(%s, %s, %s, %s, %s, %s, %s, %s, NOW())', page_size=1000)
+
+
+def refresh_campaign_catalog(yandex_token: str, client_login: str, cursor) -> str:
+    '''
+    Обновляет кэш кампаний аккаунта (rsya_campaign_catalog).
+    Раз в CATALOG_FULL_REFRESH_HOURS (и при первом запуске) — полный campaigns.get,
+    в остальное время — Changes.checkCampaigns от сохранённого Timestamp и campaigns.get только по изменённым.
+    Returns: 'full' | 'incremental' | 'unchanged'
+    '''
+    token_hash = direct_budget_key(yandex_token, client_login)[0]
+    cursor.execute("""
+        SELECT changes_timestamp,
+               last_full_refresh_at > NOW() - make_interval(hours => %s) AS full_is_fresh
+        FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog_state
+        WHERE token_hash = %s AND client_login = %s
+    """, (CATALOG_FULL_REFRESH_HOURS, token_hash, client_login))
+    state = cursor.fetchone()
+
+    if state and state['changes_timestamp'] and state['full_is_fresh']:
+        try:
+            result = _post_direct('changes', yandex_token, client_login, {
+                'method': 'checkCampaigns',
+                'params': {'Timestamp': state['changes_timestamp']}
+            })
+            changed_ids = [
+                str(item['CampaignId'])
+                for item in (result.get('Campaigns') or [])
+                if 'SELF' in (item.get('ChangesIn') or [])
+            ]
+            if changed_ids:
+                _upsert_catalog(cursor, [
+                    _catalog_row(token_hash, client_login, campaign)
+                    for campaign in fetch_direct_campaigns(yandex_token, client_login, changed_ids)
+                ])
+            cursor.execute("""
+                UPDATE t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog_state
+                SET changes_timestamp = %s, last_refreshed_at = NOW()
+                WHERE token_hash = %s AND client_login = %s
+            """, (result.get('Timestamp') or state['changes_timestamp'], token_hash, client_login))
+            return 'incremental' if changed_ids else 'unchanged'
+        except Exception as exc:
+            print(f"⚠️ Changes.checkCampaigns failed, falling back to full campaign list: {exc}")
+
+    # Timestamp берём до выгрузки: изменения во время полного campaigns.get попадут в следующий checkCampaigns
+    timestamp = _post_direct('changes', yandex_token, client_login, {
+        'method': 'checkDictionaries',
+        'params': {}
+    }).get('Timestamp')
+    campaigns = fetch_direct_campaigns(yandex_token, client_login)
+    cursor.execute("""
+        DELETE FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog
+        WHERE token_hash = %s AND client_login = %s
+    """, (token_hash, client_login))
+    _upsert_catalog(cursor, [_catalog_row(token_hash, client_login, campaign) for campaign in campaigns if campaign.get('Id')])
+    cursor.execute("""
+        INSERT INTO t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog_state
+            (token_hash, client_login, changes_timestamp, last_full_refresh_at, last_refreshed_at)
+        VALUES (%s, %s, %s, NOW(), NOW())
+        ON CONFLICT (token_hash, client_login) DO UPDATE SET
+            changes_timestamp = EXCLUDED.changes_timestamp,
+            last_full_refresh_at = NOW(),
+            last_refreshed_at = NOW()
+    """, (token_hash, client_login, timestamp))
+    return 'full'
+
+
+def fetch_current_rsya_campaign_ids(yandex_token: str, client_login: str, cursor) -> List[str]:
+    '''Включённые РСЯ-кампании аккаунта из кэша rsya_campaign_catalog (кэш обновляется перед чтением).'''
+    mode = refresh_campaign_catalog(yandex_token, client_login, cursor)
+    cursor.execute("""
+        SELECT campaign_id
+        FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog
+        WHERE token_hash = %s
+          AND client_login = %s
+          AND network_enabled = TRUE
+          AND status <> 'DRAFT'
+          AND state = 'ON'
+        ORDER BY campaign_id
+    """, (direct_budget_key(yandex_token, client_login)[0], client_login))
+    campaign_ids = [str(row['campaign_id']) for row in cursor.fetchall()]
+    print(f"📚 Campaign catalog ({mode} refresh): {len(campaign_ids)} active RSYA campaigns")
+    return campaign_ids
 
 
 def merge_auto_added_rsya_campaigns(
@@ -411,9 +931,12 @@ def merge_auto_added_rsya_campaigns(
     cursor
 ) -> List[str]:
     try:
-        current_rsya_ids = fetch_current_rsya_campaign_ids(yandex_token, client_login)
+        cursor.execute("SAVEPOINT campaign_catalog")
+        current_rsya_ids = fetch_current_rsya_campaign_ids(yandex_token, client_login, cursor)
+        cursor.execute("RELEASE SAVEPOINT campaign_catalog")
     except Exception as exc:
         print(f"⚠️ Project {project_id}: failed to refresh RSYA campaigns for auto-add: {exc}")
+        cursor.execute("ROLLBACK TO SAVEPOINT campaign_catalog")
         return stored_campaign_ids
 
     merged_campaign_ids = list(dict.fromkeys([*stored_campaign_ids, *current_rsya_ids]))
@@ -430,36 +953,92 @@ def merge_auto_added_rsya_campaigns(
     return merged_campaign_ids
 
 
+# SQS-клиент живёт между вызовами тёплого контейнера; сообщения копятся за вызов и уходят пачками
+_sqs_client = None
+_mq_buffer: List[Dict[str, Any]] = []
+
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        from botocore.config import Config
+
+        access_key = os.environ.get('YANDEX_MQ_ACCESS_KEY_ID')
+        secret_key = os.environ.get('YANDEX_MQ_SECRET_KEY')
+        if not access_key or not secret_key:
+            raise Exception('Message Queue credentials not configured')
+
+        print(f"🔑 Using access key: {access_key[:8]}... (masked)")
+        _sqs_client = boto3.client(
+            'sqs',
+            endpoint_url='https://message-queue.api.cloud.yandex.net',
+            region_name='ru-central1',
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=Config(signature_version='v4')
+        )
+    return _sqs_client
+
+
 def send_to_mq(message: Dict[str, Any]) -> None:
-    '''Отправка батча в Message Queue'''
-    from botocore.config import Config
-    
-    queue_url = 'https://message-queue.api.cloud.yandex.net/b1gga4kkbv0csaelq94p/dj60000000b1egur05em/rsyacleaner'
-    access_key = os.environ.get('YANDEX_MQ_ACCESS_KEY_ID')
-    secret_key = os.environ.get('YANDEX_MQ_SECRET_KEY')
-    
-    if not access_key or not secret_key:
-        raise Exception('Message Queue credentials not configured')
-    
-    print(f"🔑 Using access key: {access_key[:8]}... (masked)")
-    
-    sqs = boto3.client(
-        'sqs',
-        endpoint_url='https://message-queue.api.cloud.yandex.net',
-        region_name='ru-central1',
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        config=Config(signature_version='v4')
-    )
-    
-    print(f"📤 Sending batch {message['batch_number']}/{message['total_batches']} to queue...")
-    
-    response = sqs.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(message)
-    )
-    
-    print(f"✅ Sent batch {message['batch_number']}/{message['total_batches']} to MQ (MessageId: {response.get('MessageId', 'N/A')})")
+    '''Ставит батч в очередь на отправку в Message Queue (уходит в flush_mq)'''
+    _mq_buffer.append(message)
+
+
+def flush_mq() -> Dict[str, int]:
+    '''
+    Отправляет накопленные батчи send_message_batch по MQ_BATCH_LIMIT записей.
+    Частично не принятые записи (не по вине отправителя) переотправляются с backoff.
+    Returns: {'sent': N, 'failed': M}
+    '''
+    # Чередование проектов по виртуальному времени (WFQ), внутри проекта порядок батчей сохраняется
+    messages = sorted(_mq_buffer, key=lambda message: message.get('emit_order', 0))
+    _mq_buffer.clear()
+    if not messages:
+        return {'sent': 0, 'failed': 0}
+
+    sqs = get_sqs_client()
+    sent = 0
+    failed = 0
+    for i in range(0, len(messages), MQ_BATCH_LIMIT):
+        pending = {
+            str(index): message
+            for index, message in enumerate(messages[i:i + MQ_BATCH_LIMIT])
+        }
+        for attempt in range(1, MQ_SEND_RETRIES + 1):
+            try:
+                response = sqs.send_message_batch(
+                    QueueUrl=MQ_QUEUE_URL,
+                    Entries=[
+                        {'Id': entry_id, 'MessageBody': json.dumps(message)}
+                        for entry_id, message in pending.items()
+                    ]
+                )
+            except Exception as e:
+                print(f"⚠️ MQ send_message_batch error (attempt {attempt}/{MQ_SEND_RETRIES}): {str(e)}")
+                response = {'Failed': [{'Id': entry_id, 'SenderFault': False} for entry_id in pending]}
+
+            sent += len(response.get('Successful', []))
+            retry = {}
+            for failure in response.get('Failed', []):
+                message = pending.get(failure.get('Id'))
+                if message is None:
+                    continue
+                if failure.get('SenderFault') or attempt == MQ_SEND_RETRIES:
+                    failed += 1
+                    print(
+                        f"❌ Batch {message['batch_id']} (project {message['project_id']}) not sent to MQ: "
+                        f"{failure.get('Code', '')} {failure.get('Message', '')}"
+                    )
+                else:
+                    retry[failure['Id']] = message
+            if not retry:
+                break
+            pending = retry
+            time.sleep(0.5 * 2 ** (attempt - 1))
+
+    print(f"✅ Sent {sent}/{len(messages)} batches to MQ in {(len(messages) + MQ_BATCH_LIMIT - 1) // MQ_BATCH_LIMIT} calls")
+    return {'sent': sent, 'failed': failed}
 
 
 def invoke_worker_sync(batch_data: Dict[str, Any]) -> None:
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def scheduler(load_function):
+    return load_function('rsya-scheduler')
+
+
+def test_default_batch_budget_fits_one_invocation(scheduler):
+    assert scheduler.BATCH_TIME_BUDGET_SEC <= scheduler.SAFE_TIMEOUT
+
+
+def test_pack_campaign_batches_first_fit_decreasing(scheduler, monkeypatch):
+    monkeypatch.setattr(scheduler, 'BATCH_TIME_BUDGET_SEC', 20)
+    monkeypatch.setattr(scheduler, 'MAX_CAMPAIGNS_PER_BATCH', 30)
+    costs = {'1': 12, '2': 9, '3': 8, '4': 7, '5': 4}
+    # 12 → [1]; 9 → [2]; 8 → к 12 (20); 7 → к 9 (16); 4 → к 9+7 (20)
+    assert scheduler.pack_campaign_batches(['5', '4', '3', '2', '1'], costs) == [['1', '3'], ['2', '4', '5']]
+
+
+def test_pack_campaign_batches_heavy_campaign_goes_alone(scheduler, monkeypatch):
+    monkeypatch.setattr(scheduler, 'BATCH_TIME_BUDGET_SEC', 20)
+    batches = scheduler.pack_campaign_batches(['1', '2', '3'], {'1': 45, '2': 5, '3': 5})
+    assert batches == [['1'], ['2', '3']]
+
+
+def test_pack_campaign_batches_respects_campaign_limit(scheduler, monkeypatch):
+    monkeypatch.setattr(scheduler, 'BATCH_TIME_BUDGET_SEC', 1000)
+    monkeypatch.setattr(scheduler, 'MAX_CAMPAIGNS_PER_BATCH', 3)
+    batches = scheduler.pack_campaign_batches([str(c) for c in range(7)], {})
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_pack_campaign_batches_random_invariants(scheduler):
+    rng = random.Random(12)
+    for _ in range(300):
+        campaign_ids = [str(c) for c in rng.sample(range(10_000), rng.randint(1, 60))]
+        costs = {c: rng.uniform(0.5, 30) for c in campaign_ids if rng.random() < 0.8}
+        batches = scheduler.pack_campaign_batches(campaign_ids, costs)
+
+        assert sorted(c for batch in batches for c in batch) == sorted(campaign_ids)
+        for batch in batches:
+            load = sum(costs.get(c, scheduler.AVG_TIME_PER_CAMPAIGN) for c in batch)
+            assert len(batch) <= scheduler.MAX_CAMPAIGNS_PER_BATCH
+            assert load <= scheduler.BATCH_TIME_BUDGET_SEC or len(batch) == 1
+
+
+def test_order_projects_fairly_interleaves_users(scheduler):
+    projects = [
+        {'id': 1, 'user_id': 'a'},
+        {'id': 2, 'user_id': 'a'},
+        {'id': 3, 'user_id': 'a'},
+        {'id': 4, 'user_id': 'b'},
+        {'id': 5, 'user_id': None},
+        {'id': 6, 'user_id': 'b'},
+    ]
+    ordered = [project['id'] for project in scheduler.order_projects_fairly(projects)]
+    assert ordered == [1, 4, 5, 2, 6, 3]
+    assert scheduler.order_projects_fairly([]) == []
@@ -2,7 +2,11 @@ import json
 import os
 import time
 from typing import Dict, Any, List
-import requests
+from direct_client import build_http_session
+
+
+http_session = build_http_session()
+
 
 WORDSTAT_API_URL = 'https://searchapi.api.cloud.yandex.net/v2/wordstat/topRequests'
 
@@ -116,7 +120,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 print(f"[WORDSTAT] Request to API: keyword_length={len(keyword)}, regions={regions}")
                 
-                response = requests.post(
+                response = http_session.post(
                     WORDSTAT_API_URL,
                     headers={
                         'Authorization': f'Api-Key {wordstat_token}',
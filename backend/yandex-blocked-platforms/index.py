@@ -1,6 +1,11 @@
 import json
 import requests
 from typing import Dict, Any, List
+from direct_client import build_http_session
+
+
+http_session = build_http_session()
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -74,7 +79,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     }
     
     try:
-        response = requests.post(campaigns_url, headers=headers, json=campaigns_payload, timeout=30)
+        response = http_session.post(campaigns_url, headers=headers, json=campaigns_payload, timeout=30)
         print(f'📡 Campaigns API response: {response.status_code}')
         print(f'📡 Response body: {response.text[:2000]}')
         
@@ -1,9 +1,33 @@
+import hashlib
 import json
 import os
 from datetime import datetime, timedelta
 from typing import Dict, Any, List
 import requests
 import time
+from direct_client import build_http_session
+from direct_reports import iter_report_lines, iter_tsv_rows
+
+REPORT_REUSE_TTL_SEC = int(os.environ.get('RSYA_REPORT_REUSE_TTL_SEC', '1800'))  # Окно переиспользования ReportName
+
+
+http_session = build_http_session()
+
+
+def shared_report_name(prefix: str, headers: Dict[str, str], params: Dict[str, Any]) -> str:
+    '''
+    Детерминированный ReportName: тот же запрос (параметры, заголовки формата, Client-Login / токен)
+    в пределах окна REPORT_REUSE_TTL_SEC получает то же имя, и Директ отдаёт уже заказанный отчёт.
+    '''
+    account = headers.get('Client-Login') or hashlib.sha256(headers.get('Authorization', '').encode('utf-8')).hexdigest()
+    canonical = {
+        'account': account,
+        'headers': {key: value for key, value in headers.items() if key not in ('Authorization', 'Client-Login', 'Accept-Language')},
+        'params': {key: value for key, value in params.items() if key != 'ReportName'},
+    }
+    report_hash = hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return f'{prefix}_{report_hash[:16]}_{int(time.time() // REPORT_REUSE_TTL_SEC)}'
+
 
 def extract_campaign_counter_ids(campaign: Dict[str, Any]) -> List[str]:
     counter_ids: List[str] = []
@@ -124,7 +148,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
 
         try:
-            clients_response = requests.post(
+            clients_response = http_session.post(
                 'https://api.direct.yandex.com/json/v501/clients',
                 headers=direct_headers,
                 json={
@@ -152,7 +176,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             errors.append(f'clients:{str(e)}')
 
         try:
-            agency_response = requests.post(
+            agency_response = http_session.post(
                 'https://api.direct.yandex.com/json/v5/agencyclients',
                 headers=direct_headers,
                 json={
@@ -232,7 +256,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 if is_sandbox else
                 'https://api.direct.yandex.com/json/v501/campaigns'
             )
-            response = requests.post(
+            response = http_session.post(
                 api_url,
                 headers=request_headers,
                 json={
@@ -340,7 +364,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             while True:
                 counters_url = f'https://api-metrika.yandex.net/management/v1/counters?per_page={per_page}&offset={offset}'
-                counters_response = requests.get(counters_url, headers=metrika_headers, timeout=10)
+                counters_response = http_session.get(counters_url, headers=metrika_headers, timeout=10)
                 
                 if counters_response.status_code != 200:
                     print(f'[ERROR] Failed to load counters: {counters_response.status_code}')
@@ -357,7 +381,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     if not counter_name:
                         try:
                             counter_detail_url = f'https://api-metrika.yandex.net/management/v1/counter/{counter_id}'
-                            counter_detail_response = requests.get(counter_detail_url, headers=metrika_headers, timeout=10)
+                            counter_detail_response = http_session.get(counter_detail_url, headers=metrika_headers, timeout=10)
                             if counter_detail_response.status_code == 200:
                                 counter_detail = counter_detail_response.json()
                                 counter_info = counter_detail.get('counter', {})
@@ -435,7 +459,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 try:
                     # Сначала получаем информацию о счётчике
                     counter_url = f'https://api-metrika.yandex.net/management/v1/counter/{counter_id}'
-                    counter_response = requests.get(counter_url, headers=metrika_headers, timeout=10)
+                    counter_response = http_session.get(counter_url, headers=metrika_headers, timeout=10)
                     
                     counter_name = f'Счётчик {counter_id}'
                     if counter_response.status_code == 200:
@@ -448,7 +472,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     
                     # Загружаем все цели из счётчика
                     goals_url = f'https://api-metrika.yandex.net/management/v1/counter/{counter_id}/goals'
-                    goals_response = requests.get(goals_url, headers=metrika_headers, timeout=10)
+                    goals_response = http_session.get(goals_url, headers=metrika_headers, timeout=10)
                     
                     if goals_response.status_code == 200:
                         goals_data = goals_response.json()
@@ -538,7 +562,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 request_headers['Client-Login'] = client_login
                 print(f'[DEBUG] Using Client-Login: {client_login}')
             
-            response = requests.post(
+            response = http_session.post(
                 api_url,
                 headers=request_headers,
                 json={
@@ -610,8 +634,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             report_headers_base['returnMoneyInMicros'] = 'false'
             report_headers_base['skipReportHeader'] = 'true'
             report_headers_base['skipReportSummary'] = 'true'
-            rid = getattr(context, 'request_id', None) or 'local'
-            rid_key = str(rid).replace('-', '')[:24]
 
             # Список кампаний берём через Reports API (CAMPAIGN_PERFORMANCE_REPORT).
             report_campaign_meta: Dict[int, Dict[str, str]] = {}
@@ -627,7 +649,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             'DateTo': date_to,
                         },
                         'FieldNames': ['CampaignId', 'CampaignName', 'CampaignType', 'Impressions'],
-                        'ReportName': f'AllCampaigns_{rid_key}_{int(time.time())}',
                         'ReportType': 'CAMPAIGN_PERFORMANCE_REPORT',
                         'DateRangeType': 'CUSTOM_DATE',
                         'Format': 'TSV',
@@ -635,16 +656,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'IncludeDiscount': 'NO',
                     }
                 }
-                pr = requests.post(reports_url, headers=report_headers_base, json=perf_body, timeout=120)
+                perf_body['params']['ReportName'] = shared_report_name('AllCampaigns', report_headers_base, perf_body['params'])
+                pr = http_session.post(reports_url, headers=report_headers_base, json=perf_body, timeout=120, stream=True)
                 print(f'[DEBUG] CAMPAIGN_PERFORMANCE_REPORT status: {pr.status_code}')
-                if pr.status_code == 200 and pr.text and '\t' in pr.text:
-                    lines = pr.text.strip().split('\n')
-                    hdr = lines[0].split('\t') if lines else []
-                    for line in lines[1:]:
-                        vals = line.split('\t')
-                        if len(vals) < len(hdr):
-                            continue
-                        row = dict(zip(hdr, vals))
+                if pr.status_code == 200:
+                    for row in iter_tsv_rows(iter_report_lines(pr)):
                         try:
                             cid = int(row.get('CampaignId') or 0)
                         except (TypeError, ValueError):
@@ -817,7 +833,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                     'Cost',
                                     'Conversions'
                                 ],
-                                'ReportName': f'Plat_{rid_key}_{chunk_start}_{int(time.time())}',
                                 'ReportType': 'CUSTOM_REPORT',
                                 'DateRangeType': 'CUSTOM_DATE',
                                 'Format': 'TSV',
@@ -825,56 +840,51 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 'IncludeDiscount': 'NO'
                             }
                         }
+                        report_body['params']['ReportName'] = shared_report_name('Plat', report_headers_base, report_body['params'])
 
-                        report_response = requests.post(
+                        report_response = http_session.post(
                             reports_url,
                             headers=report_headers_base,
                             json=report_body,
-                            timeout=120
+                            timeout=120,
+                            stream=True
                         )
 
                         print(f'[DEBUG] CUSTOM_REPORT Placement chunk {chunk_start}-{chunk_start + len(chunk_ids)} status: {report_response.status_code}')
 
                         if report_response.status_code == 200:
-                            report_text = report_response.text
-                            lines = report_text.strip().split('\n')
-                            if len(lines) > 1:
-                                headers_line = lines[0].split('\t')
-                                for line in lines[1:]:
-                                    values = line.split('\t')
-                                    if len(values) < len(headers_line):
-                                        continue
-                                    row = dict(zip(headers_line, values))
-                                    campaign_id_str = row.get('CampaignId', '')
-                                    platform_name = row.get('Placement', '--')
-                                    if not campaign_id_str or platform_name == '--':
-                                        continue
-                                    if campaign_id_str not in all_platforms_by_campaign:
-                                        all_platforms_by_campaign[campaign_id_str] = {}
-                                        all_goals_by_campaign[campaign_id_str] = {}
-                                    impressions = int(row.get('Impressions', 0) or 0)
-                                    clicks = int(row.get('Clicks', 0) or 0)
-                                    cost = float(row.get('Cost', 0) or 0)
-                                    conversions = int(row.get('Conversions', 0) or 0)
-                                    goal_id = row.get('GoalId', '')
-                                    if platform_name not in all_platforms_by_campaign[campaign_id_str]:
-                                        all_platforms_by_campaign[campaign_id_str][platform_name] = {
-                                            'impressions': 0,
-                                            'clicks': 0,
-                                            'cost': 0,
-                                            'conversions': 0,
-                                            'goals': {}
-                                        }
-                                    all_platforms_by_campaign[campaign_id_str][platform_name]['impressions'] += impressions
-                                    all_platforms_by_campaign[campaign_id_str][platform_name]['clicks'] += clicks
-                                    all_platforms_by_campaign[campaign_id_str][platform_name]['cost'] += cost
-                                    all_platforms_by_campaign[campaign_id_str][platform_name]['conversions'] += conversions
-                                    if goal_id and goal_id != '--':
-                                        if goal_id not in all_goals_by_campaign[campaign_id_str]:
-                                            all_goals_by_campaign[campaign_id_str][goal_id] = {'name': f'Цель {goal_id}', 'id': goal_id}
-                                        if goal_id not in all_platforms_by_campaign[campaign_id_str][platform_name]['goals']:
-                                            all_platforms_by_campaign[campaign_id_str][platform_name]['goals'][goal_id] = {'conversions': 0}
-                                        all_platforms_by_campaign[campaign_id_str][platform_name]['goals'][goal_id]['conversions'] += conversions
+                            # Отчёт за год по 250 кампаниям может весить сотни МБ — читаем потоком и сразу сворачиваем по площадкам
+                            for row in iter_tsv_rows(iter_report_lines(report_response)):
+                                campaign_id_str = row.get('CampaignId', '')
+                                platform_name = row.get('Placement', '--')
+                                if not campaign_id_str or platform_name == '--':
+                                    continue
+                                if campaign_id_str not in all_platforms_by_campaign:
+                                    all_platforms_by_campaign[campaign_id_str] = {}
+                                    all_goals_by_campaign[campaign_id_str] = {}
+                                impressions = int(row.get('Impressions', 0) or 0)
+                                clicks = int(row.get('Clicks', 0) or 0)
+                                cost = float(row.get('Cost', 0) or 0)
+                                conversions = int(row.get('Conversions', 0) or 0)
+                                goal_id = row.get('GoalId', '')
+                                if platform_name not in all_platforms_by_campaign[campaign_id_str]:
+                                    all_platforms_by_campaign[campaign_id_str][platform_name] = {
+                                        'impressions': 0,
+                                        'clicks': 0,
+                                        'cost': 0,
+                                        'conversions': 0,
+                                        'goals': {}
+                                    }
+                                all_platforms_by_campaign[campaign_id_str][platform_name]['impressions'] += impressions
+                                all_platforms_by_campaign[campaign_id_str][platform_name]['clicks'] += clicks
+                                all_platforms_by_campaign[campaign_id_str][platform_name]['cost'] += cost
+                                all_platforms_by_campaign[campaign_id_str][platform_name]['conversions'] += conversions
+                                if goal_id and goal_id != '--':
+                                    if goal_id not in all_goals_by_campaign[campaign_id_str]:
+                                        all_goals_by_campaign[campaign_id_str][goal_id] = {'name': f'Цель {goal_id}', 'id': goal_id}
+                                    if goal_id not in all_platforms_by_campaign[campaign_id_str][platform_name]['goals']:
+                                        all_platforms_by_campaign[campaign_id_str][platform_name]['goals'][goal_id] = {'conversions': 0}
+                                    all_platforms_by_campaign[campaign_id_str][platform_name]['goals'][goal_id]['conversions'] += conversions
                         else:
                             print(f'[DEBUG] Placement report chunk failed: {report_response.text[:300]}')
                     except Exception as e:
@@ -1203,7 +1213,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 print(f'[DEBUG] Creating campaign with data: {campaign_data}')
                 
-                response = requests.post(
+                response = http_session.post(
                     api_url,
                     headers=request_headers,
                     json=campaign_data,
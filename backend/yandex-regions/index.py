@@ -1,7 +1,11 @@
 import json
 import os
 from typing import Dict, Any, List
-import requests
+from direct_client import build_http_session
+
+
+http_session = build_http_session()
+
 
 def flatten_tree(node: Dict, parent_id: int = None) -> List[Dict]:
     '''Рекурсивно обходит дерево и собирает все регионы'''
@@ -75,7 +79,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     try:
         print('[REGIONS] Fetching regions tree from Yandex Wordstat API...')
         
-        response = requests.post(
+        response = http_session.post(
             'https://api.wordstat.yandex.net/v1/getRegionsTree',
             headers={
                 'Authorization': f'Bearer {wordstat_token}',
@@ -0,0 +1,13 @@
+-- Последний известный бюджет баллов API Директа по токену (заголовок Units: spent/available/daily).
+-- Пишет rsya-batch-worker, читает rsya-scheduler: проекты с исчерпанным бюджетом или в паузе после 429 не запускаются.
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_direct_api_budget (
+    token_hash VARCHAR(64) NOT NULL,
+    client_login VARCHAR(255) NOT NULL DEFAULT '',
+    units_spent INTEGER NULL,
+    units_available INTEGER NULL,
+    units_daily INTEGER NULL,
+    units_login VARCHAR(255) NULL,
+    cooldown_until TIMESTAMP NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (token_hash, client_login)
+);
@@ -0,0 +1,14 @@
+-- Fair share планировщика РСЯ: вес проекта и привязка батчей к пользователю / токену
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_project_schedule
+    ADD COLUMN IF NOT EXISTS weight INTEGER NOT NULL DEFAULT 1;
+
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+    ADD COLUMN IF NOT EXISTS user_id INTEGER NULL,
+    ADD COLUMN IF NOT EXISTS token_hash VARCHAR(64) NULL,
+    ADD COLUMN IF NOT EXISTS estimated_cost_sec NUMERIC(10, 1) NULL,
+    ADD COLUMN IF NOT EXISTS emit_order DOUBLE PRECISION NULL;
+
+-- Лимиты активных батчей на токен и пользователя считаются по pending/processing
+CREATE INDEX IF NOT EXISTS idx_rsya_batches_active_token_user
+    ON t_p97630513_yandex_cleaning_serv.rsya_campaign_batches(token_hash, user_id)
+    WHERE status IN ('pending', 'processing');
@@ -0,0 +1,23 @@
+-- Кэш кампаний аккаунта Директа для auto_add_campaigns (rsya-scheduler).
+-- Полная выгрузка раз в сутки, между ними — Changes.checkCampaigns от сохранённого Timestamp.
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog (
+    token_hash VARCHAR(64) NOT NULL,
+    client_login VARCHAR(255) NOT NULL DEFAULT '',
+    campaign_id BIGINT NOT NULL,
+    name TEXT NULL,
+    type VARCHAR(50) NULL,
+    status VARCHAR(50) NULL,
+    state VARCHAR(50) NULL,
+    network_enabled BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (token_hash, client_login, campaign_id)
+);
+
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_campaign_catalog_state (
+    token_hash VARCHAR(64) NOT NULL,
+    client_login VARCHAR(255) NOT NULL DEFAULT '',
+    changes_timestamp VARCHAR(32) NULL,
+    last_full_refresh_at TIMESTAMP NULL,
+    last_refreshed_at TIMESTAMP NULL,
+    PRIMARY KEY (token_hash, client_login)
+);
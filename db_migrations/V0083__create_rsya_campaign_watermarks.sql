@@ -0,0 +1,15 @@
+-- Водяные знаки кампаний: Changes Timestamp, на момент которого кампания последний раз успешно обработана.
+-- rsya-scheduler в плановом запуске ставит в очередь только кампании с новой статистикой (Changes.checkCampaigns, STAT/SELF)
+-- или изменёнными задачами проекта (tasks_fingerprint); пишет rsya-batch-worker.
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_campaign_watermarks (
+    project_id INTEGER NOT NULL,
+    campaign_id VARCHAR(32) NOT NULL,
+    changes_timestamp VARCHAR(32) NOT NULL,
+    tasks_fingerprint VARCHAR(32) NULL,
+    last_processed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (project_id, campaign_id)
+);
+
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+    ADD COLUMN IF NOT EXISTS changes_timestamp VARCHAR(32) NULL,
+    ADD COLUMN IF NOT EXISTS tasks_fingerprint VARCHAR(32) NULL;
@@ -0,0 +1,11 @@
+-- Аренда батчей rsya-batch-worker: claim через FOR UPDATE SKIP LOCKED, heartbeat продлевает lease_expires_at,
+-- батч с истёкшей арендой (воркер упал / 499) забирает следующий воркер
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+    ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(100) NULL,
+    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP NULL,
+    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP NULL;
+
+-- Очередь claim_batch: активные батчи в порядке created_at, emit_order
+CREATE INDEX IF NOT EXISTS idx_rsya_batches_claim
+    ON t_p97630513_yandex_cleaning_serv.rsya_campaign_batches(created_at, emit_order)
+    WHERE status IN ('pending', 'processing');
@@ -0,0 +1,32 @@
+-- Поколения запусков проекта: rsya-scheduler больше не удаляет батчи проекта на каждом запуске,
+-- а создаёт запуск (run) и привязывает к нему новые батчи. Незавершённые батчи прошлого запуска
+-- помечаются superseded, история хранится RSYA_RUN_RETENTION_DAYS и чистится по created_at.
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_project_runs (
+    id BIGSERIAL PRIMARY KEY,
+    project_id INTEGER NOT NULL,
+    run_type VARCHAR(20) NOT NULL DEFAULT 'scheduled',
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    total_batches INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_rsya_runs_project_created
+    ON t_p97630513_yandex_cleaning_serv.rsya_project_runs(project_id, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_rsya_runs_created
+    ON t_p97630513_yandex_cleaning_serv.rsya_project_runs(created_at);
+
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+    ADD COLUMN IF NOT EXISTS run_id BIGINT NULL;
+
+-- Номер батча уникален в пределах запуска, а не проекта (иначе новый запуск упирается в duplicate key)
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_campaign_batches
+    DROP CONSTRAINT IF EXISTS rsya_campaign_batches_project_id_batch_number_key;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_rsya_batches_run_batch_number
+    ON t_p97630513_yandex_cleaning_serv.rsya_campaign_batches(run_id, batch_number);
+
+-- Очистка истории по сроку хранения
+CREATE INDEX IF NOT EXISTS idx_rsya_batches_created_at
+    ON t_p97630513_yandex_cleaning_serv.rsya_campaign_batches(created_at);
@@ -0,0 +1,13 @@
+-- Счётчик незавершённых батчей запуска: rsya-batch-worker уменьшает его в одной транзакции со статусом батча
+-- (completed / failed), последний батч закрывает запуск без COUNT(*) по rsya_campaign_batches
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_project_runs
+    ADD COLUMN IF NOT EXISTS remaining_batches INTEGER NOT NULL DEFAULT 0;
+
+UPDATE t_p97630513_yandex_cleaning_serv.rsya_project_runs r
+SET remaining_batches = (
+    SELECT COUNT(*)
+    FROM t_p97630513_yandex_cleaning_serv.rsya_campaign_batches b
+    WHERE b.run_id = r.id
+      AND b.status IN ('pending', 'processing')
+)
+WHERE r.status = 'running';
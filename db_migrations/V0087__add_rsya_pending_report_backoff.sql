@@ -0,0 +1,9 @@
+-- rsya-async-poller: каждый pending отчёт проверяется в свой next_check_at
+-- (retryIn из ответа Директа или экспоненциальный backoff по check_attempts) вместо LIMIT 20 каждые 5 минут
+ALTER TABLE t_p97630513_yandex_cleaning_serv.rsya_pending_reports
+    ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    ADD COLUMN IF NOT EXISTS check_attempts INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_rsya_pending_reports_next_check
+    ON t_p97630513_yandex_cleaning_serv.rsya_pending_reports(next_check_at)
+    WHERE status = 'pending';
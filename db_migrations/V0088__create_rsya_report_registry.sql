@@ -0,0 +1,14 @@
+-- Общий реестр отчётов Reports API: канонический хэш запроса (кампании, даты, поля, цели, Client-Login) -> ReportName.
+-- Одинаковый запрос в пределах TTL получает то же имя, и Директ отдаёт уже заказанный или готовый отчёт
+-- вместо постановки нового в очередь. rsya-async-poller по report_name повторяет сохранённый запрос один в один.
+CREATE TABLE IF NOT EXISTS t_p97630513_yandex_cleaning_serv.rsya_report_registry (
+    report_hash VARCHAR(64) PRIMARY KEY,
+    report_name VARCHAR(255) NOT NULL,
+    request_headers JSONB NOT NULL DEFAULT '{}'::jsonb,
+    request_params JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_used_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_rsya_report_registry_report_name
+    ON t_p97630513_yandex_cleaning_serv.rsya_report_registry (report_name);
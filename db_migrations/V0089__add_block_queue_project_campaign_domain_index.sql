@@ -0,0 +1,4 @@
+-- rsya-block-worker сопоставляет площадки из сообщений MQ со строками очереди одним запросом
+-- по (project_id, campaign_id, domain), а затем удаляет / помечает failed пачкой по id = ANY(...).
+CREATE INDEX IF NOT EXISTS idx_block_queue_project_campaign_domain
+    ON t_p97630513_yandex_cleaning_serv.block_queue (project_id, campaign_id, domain);
@@ -0,0 +1,30 @@
+-- Очередь блокировки как приоритетная очередь: rsya-block-worker захватывает pending строки по priority_score
+-- (FOR UPDATE SKIP LOCKED) в аренду lease_owner до lease_expires_at — параллельные воркеры не делают
+-- повторных campaigns.update по одним и тем же площадкам; строки упавшего воркера возвращаются по истечении аренды.
+ALTER TABLE t_p97630513_yandex_cleaning_serv.block_queue
+    ADD COLUMN IF NOT EXISTS priority_score DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(64) NULL,
+    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP NULL;
+
+-- Приоритет существующих pending строк — та же формула, что calculate_priority_score в rsya-block-worker
+UPDATE t_p97630513_yandex_cleaning_serv.block_queue
+SET priority_score =
+    CASE WHEN LOWER(COALESCE(domain, '')) ~ '(\.com$|dsp|vpn|game|игр|казино|poker|casino|adult|xxx|porn|download|торрент)'
+         THEN 100
+              + CASE WHEN COALESCE(cost, 0) > 100 THEN 50 ELSE 0 END
+              + CASE WHEN COALESCE(clicks, 0) > 50 THEN 30 ELSE 0 END
+         ELSE 0 END
+    + CASE WHEN COALESCE(cost, 0) > 0 AND COALESCE(clicks, 0) > 10
+                AND cost / clicks < 5 AND COALESCE(conversions, 0) = 0
+           THEN 60 ELSE 0 END
+    + CASE WHEN COALESCE(cpa, 0) > 1000 THEN 70 ELSE 0 END
+    + CASE WHEN COALESCE(cost, 0) > 0 THEN LEAST(cost / 10, 50) ELSE 0 END
+WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_block_queue_pending_priority
+    ON t_p97630513_yandex_cleaning_serv.block_queue (priority_score DESC, cost DESC, clicks DESC)
+    WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_block_queue_processing_lease
+    ON t_p97630513_yandex_cleaning_serv.block_queue (lease_expires_at)
+    WHERE status = 'processing';
@@ -0,0 +1,14 @@
+-- Версия формулы, которой посчитан block_queue.priority_score. rsya-async-poller и rsya-automation пишут приоритет
+-- при постановке в очередь; rsya-block-worker пачкой пересчитывает pending строки со старой версией (или без неё),
+-- rsya-rotation читает сохранённый приоритет вместо пересчёта.
+ALTER TABLE t_p97630513_yandex_cleaning_serv.block_queue
+    ADD COLUMN IF NOT EXISTS priority_version SMALLINT NOT NULL DEFAULT 0;
+
+-- Pending строки уже посчитаны в V0090 той же формулой (версия 1)
+UPDATE t_p97630513_yandex_cleaning_serv.block_queue
+SET priority_version = 1
+WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_block_queue_pending_priority_version
+    ON t_p97630513_yandex_cleaning_serv.block_queue (priority_version)
+    WHERE status = 'pending';
@@ -0,0 +1,7 @@
+-- rsya-rotation читает метрики исключённых площадок кампании одним запросом: по каждому домену из
+-- unnest(...) WITH ORDINALITY берёт самую свежую строку через LEFT JOIN LATERAL
+-- (... WHERE campaign_id = %s AND domain = d.domain ORDER BY created_at DESC LIMIT 1) —
+-- равенство по (campaign_id, domain) и порядок created_at DESC совпадают с индексом, одна строка на домен
+-- читается без сортировки. Ротированные площадки удаляются одним DELETE по тому же ключу.
+CREATE INDEX IF NOT EXISTS idx_block_queue_campaign_domain_created
+    ON t_p97630513_yandex_cleaning_serv.block_queue (campaign_id, domain, created_at DESC);
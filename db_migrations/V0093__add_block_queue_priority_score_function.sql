@@ -0,0 +1,37 @@
+-- Формула приоритета блокировки живёт только в БД: rsya-async-poller и rsya-automation считают priority_score
+-- при постановке в очередь, rsya-block-worker пересчитывает pending строки со старой версией — все через
+-- block_queue_priority_score. rsya-rotation читает сохранённый приоритет и вызывает функцию только для строк
+-- со старой версией и площадок без строки в очереди.
+-- Изменение формулы: новая миграция с CREATE OR REPLACE обеих функций и увеличенной версией.
+CREATE OR REPLACE FUNCTION t_p97630513_yandex_cleaning_serv.block_queue_priority_score(
+    p_domain TEXT,
+    p_clicks NUMERIC,
+    p_cost NUMERIC,
+    p_conversions NUMERIC,
+    p_cpa NUMERIC
+) RETURNS DOUBLE PRECISION
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT (
+        CASE WHEN LOWER(COALESCE(p_domain, '')) ~ '(\.com$|dsp|vpn|game|игр|казино|poker|casino|adult|xxx|porn|download|торрент)'
+             THEN 100
+                  + CASE WHEN COALESCE(p_cost, 0) > 100 THEN 50 ELSE 0 END
+                  + CASE WHEN COALESCE(p_clicks, 0) > 50 THEN 30 ELSE 0 END
+             ELSE 0 END
+        + CASE WHEN COALESCE(p_cost, 0) > 0 AND COALESCE(p_clicks, 0) > 10
+                    AND p_cost / p_clicks < 5 AND COALESCE(p_conversions, 0) = 0
+               THEN 60 ELSE 0 END
+        + CASE WHEN COALESCE(p_cpa, 0) > 1000 THEN 70 ELSE 0 END
+        + CASE WHEN COALESCE(p_cost, 0) > 0 THEN LEAST(p_cost / 10, 50) ELSE 0 END
+    )::DOUBLE PRECISION
+$$;
+
+-- Версия формулы, которую пишут в block_queue.priority_version вместе с priority_score
+CREATE OR REPLACE FUNCTION t_p97630513_yandex_cleaning_serv.block_queue_priority_version()
+RETURNS SMALLINT
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT 1::SMALLINT
+$$;
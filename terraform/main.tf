@@ -330,6 +330,11 @@ locals {
   ]
 }
 
+# Copy shared modules (backend/_shared) into the functions that import them
+data "external" "shared_modules" {
+  program = ["sh", "-c", "python3 '${path.module}/../backend/_shared/sync.py' >&2 && echo '{}'"]
+}
+
 # Archive each function
 data "archive_file" "functions" {
   for_each = toset(local.functions)
@@ -337,7 +342,9 @@ data "archive_file" "functions" {
   type        = "zip"
   source_dir  = "${path.module}/../backend/${each.key}"
   output_path = "${path.module}/.terraform/tmp/${each.key}.zip"
-  excludes    = ["__pycache__", "*.pyc", ".pytest_cache", "tests.json"]
+  excludes    = ["__pycache__", "*.pyc", ".pytest_cache", "tests.json", "test_*.py"]
+
+  depends_on = [data.external.shared_modules]
 }
 
 # Create Cloud Functions